@@ -10,19 +10,31 @@ Perbaikan:
 - Penguatan /addmenu & /addmenulink error handling/logging
 """
 
-import os, json, math, logging, re, random
+import os, json, math, logging, re, random, threading, time, bisect, queue, atexit, hashlib, sqlite3, html
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import util as mp_util
 from contextlib import contextmanager
-from datetime import datetime
-from typing import Optional, List, Dict, Any, Tuple
+from functools import lru_cache
+from html.parser import HTMLParser
+from datetime import datetime, timezone
+from typing import Optional, List, Dict, Any, Tuple, NamedTuple
 
+import click
 import requests
+from requests.adapters import HTTPAdapter
 from flask import Flask, request, jsonify
 from dotenv import load_dotenv
 
 from sqlalchemy import (
     create_engine, Column, BigInteger, Integer, String, Text, Enum,
-    ForeignKey, DECIMAL, DateTime, TIMESTAMP, CheckConstraint, func
+    ForeignKey, DECIMAL, DateTime, TIMESTAMP, CheckConstraint, LargeBinary,
+    func, event, inspect, insert, delete, update, or_, text as sa_text
 )
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import DeclarativeBase, relationship, sessionmaker, Session
 
 # ============== Gemini (opsional) ==========
@@ -31,6 +43,18 @@ try:
 except Exception:
     genai = None
 
+# ============== NumPy (opsional, untuk retrieval embedding) ==========
+try:
+    import numpy as np
+except Exception:
+    np = None
+
+# ============== pypdf (opsional, untuk ingest buku PDF) ==========
+try:
+    from pypdf import PdfReader
+except Exception:
+    PdfReader = None
+
 # ============================================================
 #  LOGGING
 # ============================================================
@@ -67,6 +91,97 @@ if GEMINI_API_KEY and genai is not None:
 if not BOT_TOKEN:
     log.warning("BOT_TOKEN belum di-set di .env")
 
+# pengiriman pesan Telegram: "async" (antrian + worker, default) atau "sync" (langsung di request)
+TELEGRAM_SEND_MODE = os.getenv("TELEGRAM_SEND_MODE", "async").strip().lower()
+TELEGRAM_SEND_WORKERS = int(os.getenv("TELEGRAM_SEND_WORKERS", "4"))
+TELEGRAM_SEND_QUEUE_SIZE = int(os.getenv("TELEGRAM_SEND_QUEUE_SIZE", "1000"))
+TELEGRAM_SEND_MAX_RETRIES = int(os.getenv("TELEGRAM_SEND_MAX_RETRIES", "4"))
+# jawaban AI di-stream: pesan pertama secepatnya lalu editMessageText paling sering tiap N detik
+GEMINI_STREAM = os.getenv("GEMINI_STREAM", "1").strip().lower() in ("1", "true", "yes")
+GEMINI_STREAM_EDIT_SEC = float(os.getenv("GEMINI_STREAM_EDIT_SEC", "1.0"))
+
+# admission control panggilan AI: token bucket per user + batas panggilan bersamaan per proses
+USER_AI_RATE_PER_MIN = float(os.getenv("USER_AI_RATE_PER_MIN", "6"))
+USER_AI_BURST = int(os.getenv("USER_AI_BURST", "3"))
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "4"))
+AI_MAX_WAITING = int(os.getenv("AI_MAX_WAITING", "16"))
+AI_QUEUE_DEADLINE_SEC = float(os.getenv("AI_QUEUE_DEADLINE_SEC", "3.0"))
+EMBED_QUEUE_DEADLINE_SEC = float(os.getenv("EMBED_QUEUE_DEADLINE_SEC", "0.5"))
+
+# webhook: "async" = validasi, masukkan antrian, langsung ack; "inline" = proses di request
+WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", "async").strip().lower()
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+UPDATE_WORKER_KIND = os.getenv("UPDATE_WORKER_KIND", "thread").strip().lower()   # thread | process
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "500"))
+
+# dedup update Telegram (redelivery update_id / callback_query.id yang sama)
+UPDATE_DEDUP_BACKEND = os.getenv("UPDATE_DEDUP_BACKEND", "memory").strip().lower()   # memory | db
+UPDATE_DEDUP_TTL_SEC = int(os.getenv("UPDATE_DEDUP_TTL_SEC", "3600"))
+UPDATE_DEDUP_MAX = int(os.getenv("UPDATE_DEDUP_MAX", "100000"))
+
+# cache jawaban Gemini (LRU + TTL, opsional file SQLite agar bertahan saat restart)
+RESPONSE_CACHE_MAX = int(os.getenv("RESPONSE_CACHE_MAX", "2000"))
+RESPONSE_CACHE_TTL_SEC = int(os.getenv("RESPONSE_CACHE_TTL_SEC", "86400"))
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "").strip()
+# cache embedding kueri (float32), dibatasi total byte; opsional file SQLite
+EMBED_CACHE_MAX_BYTES = int(os.getenv("EMBED_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "").strip()
+# cache layar jadi (daftar menu per halaman); versi naik tiap menu ditulis, TTL untuk worker lain
+SCREEN_CACHE_MAX = int(os.getenv("SCREEN_CACHE_MAX", "500"))
+SCREEN_CACHE_TTL_SEC = int(os.getenv("SCREEN_CACHE_TTL_SEC", "300"))
+MENU_LIST_PAGE = int(os.getenv("MENU_LIST_PAGE", "50"))
+
+# budget konteks prompt (estimasi token ~ karakter/4)
+PROMPT_CONTEXT_TOKENS = int(os.getenv("PROMPT_CONTEXT_TOKENS", "1500"))
+LINK_CONTEXT_TOKENS = int(os.getenv("LINK_CONTEXT_TOKENS", "2500"))
+LINK_MAX_BYTES = int(os.getenv("LINK_MAX_BYTES", str(2 * 1024 * 1024)))
+
+# batas jumlah query DB per pesan; lewat batas dicatat (warning + /stats)
+MAX_QUERIES_PER_MESSAGE = int(os.getenv("MAX_QUERIES_PER_MESSAGE", "12"))
+
+# write-behind riwayat & rating: flush tiap N ms atau N baris (jendela data hilang saat crash = N ms);
+# 0 = tulis langsung
+WRITE_BEHIND_FLUSH_MS = int(os.getenv("WRITE_BEHIND_FLUSH_MS", "500"))
+WRITE_BEHIND_MAX_ROWS = int(os.getenv("WRITE_BEHIND_MAX_ROWS", "200"))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "10000"))
+
+# rekomendasi: tabel skor (rating bayesian) in-process, di-refresh berkala
+RECOM_REFRESH_SEC = int(os.getenv("RECOM_REFRESH_SEC", "300"))
+RECOM_SKIP_RECENT = int(os.getenv("RECOM_SKIP_RECENT", "10"))   # lewati N menu terakhir yang dilihat user
+RECOM_PRIOR_WEIGHT = float(os.getenv("RECOM_PRIOR_WEIGHT", "5"))
+
+# pencocokan bahan milik user ("aku punya telur, nasi, kecap")
+INGREDIENT_INDEX_REFRESH_SEC = int(os.getenv("INGREDIENT_INDEX_REFRESH_SEC", "600"))
+INGREDIENT_MAX_MISSING = int(os.getenv("INGREDIENT_MAX_MISSING", "2"))
+
+# pencarian nama bahan/menu toleran typo (trigram)
+NAME_INDEX_REFRESH_SEC = int(os.getenv("NAME_INDEX_REFRESH_SEC", "600"))
+FUZZY_BAHAN_MIN_SCORE = float(os.getenv("FUZZY_BAHAN_MIN_SCORE", "0.6"))    # /pantang bila tidak ada yang memuat
+FUZZY_BAHAN_REPORT_SCORE = float(os.getenv("FUZZY_BAHAN_REPORT_SCORE", "0.8"))  # simpan resep: laporkan bahan baru yang mirip
+FUZZY_MENU_MIN_SCORE = float(os.getenv("FUZZY_MENU_MIN_SCORE", "0.5"))
+
+# cache pantangan per user (LRU user aktif); TTL jaga-jaga bila ada proses lain yang mengubah
+PANTANG_CACHE_USERS = int(os.getenv("PANTANG_CACHE_USERS", "10000"))
+PANTANG_CACHE_TTL_SEC = int(os.getenv("PANTANG_CACHE_TTL_SEC", "600"))
+
+# index pencarian menu in-process; dibangun ulang di background bila lebih tua dari ini (detik)
+MENU_INDEX_REFRESH_SEC = int(os.getenv("MENU_INDEX_REFRESH_SEC", "600"))
+# hybrid retrieval (BM25 + embedding, digabung reciprocal rank fusion)
+HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K", "60"))
+HYBRID_MIN_REL = float(os.getenv("HYBRID_MIN_REL", "0.5"))           # buang dokumen < 50% skor fusi teratas
+HYBRID_SEMANTIC_BUDGET_MS = int(os.getenv("HYBRID_SEMANTIC_BUDGET_MS", "250"))  # lewati embedding bila waktu habis
+
+# retrieval knowledge_chunks (embedding buku resep)
+KNOWLEDGE_INDEX_REFRESH_SEC = int(os.getenv("KNOWLEDGE_INDEX_REFRESH_SEC", "1800"))
+KNOWLEDGE_TOP_K = int(os.getenv("KNOWLEDGE_TOP_K", "3"))
+KNOWLEDGE_MIN_SCORE = float(os.getenv("KNOWLEDGE_MIN_SCORE", "0.55"))
+# ingest knowledge: embedder "gemini" (produksi) atau "local" (hashing deterministik, offline)
+KNOWLEDGE_EMBEDDER = os.getenv("KNOWLEDGE_EMBEDDER", "gemini").strip().lower()
+KNOWLEDGE_CHUNK_CHARS = int(os.getenv("KNOWLEDGE_CHUNK_CHARS", "1200"))
+KNOWLEDGE_CHUNK_OVERLAP = int(os.getenv("KNOWLEDGE_CHUNK_OVERLAP", "200"))
+KNOWLEDGE_EMBED_BATCH = int(os.getenv("KNOWLEDGE_EMBED_BATCH", "64"))
+LOCAL_EMBED_DIM = int(os.getenv("LOCAL_EMBED_DIM", "256"))
+
 # ============================================================
 #  DB SETUP
 # ============================================================
@@ -158,9 +273,21 @@ class KnowledgeChunk(Base):
     title = Column(String(255), nullable=False)
     page_no = Column(Integer, nullable=True)
     chunk_text = Column(Text, nullable=False)
-    embedding_json = Column(Text, nullable=False)
+    embedding_json = Column(Text, nullable=True)   # format lama: array float sebagai teks JSON
+    # format biner: float32 ('f32') atau int8 terkuantisasi ('i8'), little-endian, sepanjang embedding_dim
+    embedding_bin = Column(LargeBinary(length=16777215), nullable=True)
+    embedding_dim = Column(Integer, nullable=True)
+    embedding_fmt = Column(Enum("f32","i8", name="embedding_fmt_enum"), nullable=True)
+    embedding_model = Column(String(100), nullable=True)   # nama embedder; NULL = data lama (Gemini)
+    chunk_no = Column(Integer, nullable=True)               # urutan chunk dalam satu halaman
+    content_hash = Column(String(64), nullable=True)        # sha256 chunk_text, untuk skip chunk yang tidak berubah
     created_at = Column(TIMESTAMP, nullable=False, server_default="CURRENT_TIMESTAMP")
 
+class TelegramUpdateSeen(Base):
+    __tablename__ = "telegram_update_seen"
+    update_key = Column(String(64), primary_key=True)   # "u:<update_id>" / "cq:<callback_query.id>"
+    seen_at = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
+
 engine = create_engine(DB_URL, pool_pre_ping=True, pool_recycle=3600, echo=False, future=True)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
 
@@ -177,25 +304,439 @@ def get_session() -> Session:
     finally:
         session.close()
 
+# ------- penghitung query per pesan -------
+_query_counter = threading.local()
+QUERY_STATS = {"messages": 0, "queries": 0, "max": 0, "over_cap": 0}
+_query_stats_lock = threading.Lock()
+
+@event.listens_for(engine, "before_cursor_execute")
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    n = getattr(_query_counter, "n", None)
+    if n is not None: _query_counter.n = n + 1
+
+@contextmanager
+def count_queries(label: str, cap: int = MAX_QUERIES_PER_MESSAGE):
+    outer = getattr(_query_counter, "n", None)
+    if outer is not None:
+        yield; return
+    _query_counter.n = 0
+    try:
+        yield
+    finally:
+        n, _query_counter.n = _query_counter.n, None
+        with _query_stats_lock:
+            QUERY_STATS["messages"] += 1; QUERY_STATS["queries"] += n
+            QUERY_STATS["max"] = max(QUERY_STATS["max"], n)
+            if n > cap: QUERY_STATS["over_cap"] += 1
+        if n > cap: log.warning("%s: %d query DB (batas %d)", label, n, cap)
+        else: log.debug("%s: %d query DB", label, n)
+
+# kolom/tabel tambahan di luar dump awal; ditambahkan otomatis (semua nullable)
+SCHEMA_ADDITIONS: Dict[str, List[str]] = {
+    "knowledge_chunks": ["embedding_bin", "embedding_dim", "embedding_fmt",
+                         "embedding_model", "chunk_no", "content_hash"],
+}
+
+def ensure_schema() -> None:
+    Base.metadata.create_all(engine, checkfirst=True)
+    insp = inspect(engine)
+    for table, cols in SCHEMA_ADDITIONS.items():
+        have = {c["name"] for c in insp.get_columns(table)}
+        for name in cols:
+            if name in have: continue
+            col_type = Base.metadata.tables[table].c[name].type.compile(dialect=engine.dialect)
+            with engine.begin() as conn:
+                conn.execute(sa_text(f"ALTER TABLE {table} ADD COLUMN {name} {col_type} NULL"))
+            log.info("Skema: kolom %s.%s ditambahkan", table, name)
+
+# hook yang dijalankan setelah transaksi sukses di-commit (sinkronisasi index/cache in-process)
+def run_after_commit(session: Session, fn) -> None:
+    session.info.setdefault("after_commit", []).append(fn)
+
+@event.listens_for(SessionLocal, "after_commit")
+def _run_after_commit_hooks(session: Session) -> None:
+    for fn in session.info.pop("after_commit", []):
+        try:
+            fn()
+        except Exception as e:
+            log.exception("after_commit hook error: %s", e)
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _drop_after_commit_hooks(session: Session) -> None:
+    session.info.pop("after_commit", None)
+
+def upsert_rows(session: Session, model, rows: List[Dict[str, Any]], update_cols=()) -> None:
+    """
+    INSERT multi-baris yang menimpa baris dengan primary key sama:
+    ON DUPLICATE KEY UPDATE di MySQL, ON CONFLICT di SQLite. Tanpa
+    `update_cols` baris yang sudah ada dibiarkan. Satu statement, tanpa
+    SELECT dulu, jadi aman dari balapan dua request dengan key yang sama.
+    Tidak melaporkan baris mana yang baru (rowcount MySQL untuk no-op
+    bergantung flag FOUND_ROWS); pemanggil yang perlu tahu, cek sendiri.
+    Dialect lain: jalur lama session.get + add/update per baris.
+    """
+    if not rows: return
+    table = model.__table__
+    pk = [c.name for c in table.primary_key.columns]
+    dialect = session.get_bind().dialect.name
+    if dialect == "mysql":
+        stmt = mysql_insert(table).values(rows)
+        stmt = stmt.on_duplicate_key_update({c: stmt.inserted[c] for c in update_cols} or {pk[0]: table.c[pk[0]]})
+    elif dialect == "sqlite":
+        stmt = sqlite_insert(table).values(rows)
+        stmt = (stmt.on_conflict_do_update(index_elements=pk, set_={c: stmt.excluded[c] for c in update_cols})
+                if update_cols else stmt.on_conflict_do_nothing(index_elements=pk))
+    else:
+        by_key = {tuple(r[c] for c in pk): r for r in rows}   # key ganda: baris terakhir menang
+        for key, row in by_key.items():
+            obj = session.get(model, key if len(key) > 1 else key[0])
+            if obj is None:
+                session.add(model(**row))
+            else:
+                for c in update_cols: setattr(obj, c, row[c])
+        return
+    session.execute(stmt)
+
+class WriteBehindBuffer:
+    """
+    Riwayat menu dan rating dikumpulkan di memori lalu ditulis per batch
+    (INSERT multi-baris + upsert rating) oleh satu thread, tiap flush_ms atau
+    begitu terkumpul max_rows baris. Banyak transaksi kecil per pesan/tap
+    jadi satu transaksi. Yang bisa hilang saat proses mati mendadak dibatasi
+    jendela flush_ms; shutdown normal selalu flush.
+
+    Pemanggil yang sedang memegang transaksi memberikan `session`-nya:
+    penulisan langsung (flush_ms=0) dan flush paksa memakai transaksi itu
+    (atau menunggu sampai commit), bukan membuka sesi kedua yang bisa
+    menunggu kunci baris milik transaksi pemanggil sendiri.
+    """
+    def __init__(self, flush_ms: int, max_rows: int, max_pending: int):
+        self.flush_ms = flush_ms
+        self.max_rows = max(1, max_rows)
+        self.max_pending = max_pending
+        self._history: List[Dict[str, Any]] = []
+        self._ratings: "OrderedDict[Tuple[int, int], Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pid = None
+        self.stats = {"history": 0, "ratings": 0, "flushes": 0, "rows_written": 0,
+                      "failed": 0, "sync_flushes": 0}
+
+    def _ensure_started(self) -> None:
+        # thread flusher per proses; buffer hasil fork milik parent, jangan ditulis dua kali
+        if self._pid == os.getpid(): return
+        with self._lock:
+            if self._pid == os.getpid(): return
+            self._pid = os.getpid()
+            self._history, self._ratings = [], OrderedDict()
+            threading.Thread(target=self._run, name="write-behind", daemon=True).start()
+
+    def add_history(self, session: Optional[Session], telegram_user_id: int, id_menu: int,
+                    keterangan: Optional[str]) -> None:
+        row = {"telegram_user_id": telegram_user_id, "id_menu": id_menu,
+               "waktu": datetime.utcnow(), "keterangan": keterangan}
+        if self.flush_ms <= 0:
+            self._write([row], [], session); return
+        self._ensure_started()
+        with self._lock:
+            self._history.append(row); self.stats["history"] += 1
+            n = len(self._history) + len(self._ratings)
+        self._after_add(n, session)
+
+    def add_rating(self, session: Optional[Session], telegram_user_id: int, id_menu: int, rating: int,
+                   review: Optional[str] = None, set_review: bool = False) -> None:
+        # set_review=False: review yang sudah ada tidak ditimpa (rating dari tombol)
+        row = {"telegram_user_id": telegram_user_id, "id_menu": id_menu, "rating_menu": rating,
+               "review": review, "set_review": set_review}
+        if self.flush_ms <= 0:
+            self._write([], [row], session); return
+        self._ensure_started()
+        key = (telegram_user_id, id_menu)
+        with self._lock:
+            prev = self._ratings.pop(key, None)
+            if prev is not None and prev["set_review"] and not set_review:
+                row["review"], row["set_review"] = prev["review"], True
+            self._ratings[key] = row; self.stats["ratings"] += 1
+            n = len(self._history) + len(self._ratings)
+        self._after_add(n, session)
+
+    def _after_add(self, n: int, session: Optional[Session]) -> None:
+        if n >= self.max_pending:
+            # backpressure: DB tertinggal jauh, tulis di thread pemanggil (setelah transaksinya selesai)
+            self.stats["sync_flushes"] += 1
+            if session is not None: run_after_commit(session, self.flush)
+            else: self.flush()
+        elif n >= self.max_rows:
+            self._wake.set()
+
+    def pending_menus(self, telegram_user_id: int) -> set:
+        with self._lock:
+            return {r["id_menu"] for r in self._history if r["telegram_user_id"] == telegram_user_id}
+
+    def has_pending(self, telegram_user_id: int) -> bool:
+        with self._lock:
+            return (any(r["telegram_user_id"] == telegram_user_id for r in self._history)
+                    or any(k[0] == telegram_user_id for k in self._ratings))
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(self.flush_ms / 1000.0); self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                log.exception("Write-behind flush error: %s", e)
+
+    def flush(self, session: Optional[Session] = None) -> None:
+        # session: tulis semua yang tertunda di transaksi pemanggil (mis. sebelum membaca riwayat)
+        with self._flush_lock:
+            with self._lock:
+                history, self._history = self._history, []
+                ratings, self._ratings = list(self._ratings.values()), OrderedDict()
+            if not history and not ratings: return
+            if session is not None:
+                try:
+                    self._write(history, ratings, session)
+                except Exception:
+                    self._requeue(history, ratings)   # dicoba lagi oleh thread flusher
+                    raise
+                return
+            try:
+                self._write(history, ratings)
+            except Exception as e:
+                # satu baris rusak tidak boleh membuang seluruh batch
+                log.warning("Batch write-behind gagal (%s), diulang per baris", e)
+                for row in history:
+                    try: self._write([row], [])
+                    except Exception: self.stats["failed"] += 1
+                for row in ratings:
+                    try: self._write([], [row])
+                    except Exception: self.stats["failed"] += 1
+
+    def _requeue(self, history: List[Dict[str, Any]], ratings: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            self._history[:0] = history
+            for r in ratings:   # rating yang lebih baru di buffer tetap menang
+                self._ratings.setdefault((r["telegram_user_id"], r["id_menu"]), r)
+
+    def _write(self, history: List[Dict[str, Any]], ratings: List[Dict[str, Any]],
+               session: Optional[Session] = None) -> None:
+        if session is None:
+            with get_session() as own:
+                self._write(history, ratings, own)
+            return
+        users = sorted({r["telegram_user_id"] for r in history + ratings})
+        upsert_rows(session, User, [{"telegram_user_id": u} for u in users])
+        for i in range(0, len(history), self.max_rows):
+            session.execute(insert(UserMenuRiwayat).values(history[i:i + self.max_rows]))
+        for set_review, cols in ((True, ("rating_menu", "review")), (False, ("rating_menu",))):
+            rows = [{k: v for k, v in r.items() if k != "set_review"}
+                    for r in ratings if r["set_review"] == set_review]
+            for i in range(0, len(rows), self.max_rows):
+                upsert_rows(session, UserMenuRating, rows[i:i + self.max_rows], cols)
+        self.stats["flushes"] += 1; self.stats["rows_written"] += len(history) + len(ratings)
+
+WRITE_BEHIND = WriteBehindBuffer(WRITE_BEHIND_FLUSH_MS, WRITE_BEHIND_MAX_ROWS, WRITE_BEHIND_MAX_PENDING)
+atexit.register(WRITE_BEHIND.flush)
+
+class RefreshingIndex:
+    # basis index in-process: build() saat pertama dipakai, lalu rebuild di background bila basi
+    name = "index"
+
+    def __init__(self, refresh_sec: int = 0):
+        self._lock = threading.RLock()
+        self._built_at = 0.0
+        self._rebuilding = False
+        self.refresh_sec = refresh_sec
+
+    def build(self) -> None:
+        raise NotImplementedError
+
+    def ensure_fresh(self) -> None:
+        if not self._built_at:
+            with self._lock:
+                if not self._built_at:
+                    self.build(); self._built_at = time.time()
+            return
+        if self.refresh_sec > 0 and time.time() - self._built_at > self.refresh_sec:
+            with self._lock:
+                if self._rebuilding: return
+                self._rebuilding = True
+            def _bg():
+                try:
+                    self.build(); self._built_at = time.time()
+                except Exception as e:
+                    log.exception("Rebuild %s gagal: %s", self.name, e)
+                finally:
+                    self._rebuilding = False
+            threading.Thread(target=_bg, name=f"{self.name}-rebuild", daemon=True).start()
+
 # ============================================================
 #  TELEGRAM HELPERS
 # ============================================================
 TELEGRAM_API_BASE = f"https://api.telegram.org/bot{BOT_TOKEN}" if BOT_TOKEN else ""
 
+class TelegramDispatcher:
+    """
+    Pengiriman keluar ke Bot API lewat antrian terbatas yang dikuras worker
+    thread di atas satu requests.Session (koneksi keep-alive). Antrian dibagi
+    per chat (shard = chat_id % worker) supaya urutan pesan satu chat terjaga.
+    429 diulang sesuai retry_after, 5xx/error jaringan dengan backoff.
+    """
+    def __init__(self, workers: int, queue_size: int, max_retries: int):
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.max_retries = max_retries
+        self.stats = {"sent": 0, "retried": 0, "failed": 0, "queued": 0, "sync_fallback": 0}
+        self._lock = threading.Lock()
+        self._pid = None
+        self._http: Optional[requests.Session] = None
+        self._queues: List[queue.Queue] = []
+
+    def _ensure_started(self, with_workers: bool = True) -> None:
+        # lazy + aman terhadap fork (worker gunicorn membuat pool sendiri)
+        if self._pid == os.getpid() and (self._queues or not with_workers): return
+        with self._lock:
+            if self._pid != os.getpid():
+                http = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers + 4)
+                http.mount("https://", adapter); http.mount("http://", adapter)
+                self._http, self._queues, self._pid = http, [], os.getpid()
+            if with_workers and not self._queues:
+                self._queues = [queue.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+                for i, q in enumerate(self._queues):
+                    threading.Thread(target=self._worker, args=(q,), name=f"tg-send-{i}", daemon=True).start()
+
+    def _count(self, key: str, n: int = 1) -> None:
+        with self._lock:
+            self.stats[key] += n
+
+    def _backoff(self, attempt: int) -> float:
+        return min(30.0, 0.5 * (2 ** attempt)) + random.uniform(0, 0.25)
+
+    def call(self, method: str, payload: Dict[str, Any], timeout: float = 15,
+             retries: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        # panggilan sinkron dengan retry; mengembalikan body JSON bila sukses
+        if not BOT_TOKEN:
+            log.error("BOT_TOKEN kosong, tidak bisa memanggil %s.", method)
+            return None
+        self._ensure_started(with_workers=False)
+        url = f"{TELEGRAM_API_BASE}/{method}"
+        retries = self.max_retries if retries is None else retries
+        for attempt in range(retries + 1):
+            last = attempt == retries
+            try:
+                resp = self._http.post(url, json=payload, timeout=timeout)
+            except requests.RequestException as e:
+                if last:
+                    log.warning("%s exception: %s", method, e); break
+                self._count("retried"); time.sleep(self._backoff(attempt)); continue
+            if resp.ok:
+                self._count("sent")
+                try: return resp.json()
+                except ValueError: return {}
+            if (resp.status_code == 429 or resp.status_code >= 500) and not last:
+                delay = self._backoff(attempt)
+                if resp.status_code == 429:
+                    try: delay = float(resp.json().get("parameters", {}).get("retry_after") or delay)
+                    except ValueError: pass
+                self._count("retried"); time.sleep(delay); continue
+            log.warning("%s gagal: %s - %s", method, resp.status_code, resp.text)
+            break
+        self._count("failed")
+        return None
+
+    def submit(self, chat_id: Optional[int], calls: List[Tuple[str, Dict[str, Any], float]]) -> None:
+        # calls dikirim berurutan oleh satu worker (reply + keyboard lanjutan tidak terpisah)
+        if not calls: return
+        if TELEGRAM_SEND_MODE != "async":
+            for method, payload, timeout in calls: self.call(method, payload, timeout)
+            return
+        self._ensure_started()
+        q = self._queues[hash(chat_id) % len(self._queues)]
+        try:
+            q.put_nowait(calls); self._count("queued")
+        except queue.Full:
+            # backpressure: antrian penuh, kirim langsung di thread pemanggil
+            self._count("sync_fallback")
+            for method, payload, timeout in calls: self.call(method, payload, timeout)
+
+    def call_in_order(self, chat_id: Optional[int], method: str, payload: Dict[str, Any],
+                      timeout: float = 15, retries: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        # seperti call(), tapi lewat shard chat ini: menunggu pesan chat yang sama yang sudah
+        # antre lebih dulu, lalu mengembalikan hasilnya (dipakai pesan stream yang butuh message_id)
+        if TELEGRAM_SEND_MODE != "async":
+            return self.call(method, payload, timeout, retries)
+        self._ensure_started()
+        done, result = threading.Event(), {}
+        def job():
+            try: result["body"] = self.call(method, payload, timeout, retries)
+            finally: done.set()
+        q = self._queues[hash(chat_id) % len(self._queues)]
+        try:
+            q.put_nowait(job); self._count("queued")
+        except queue.Full:
+            self._count("sync_fallback")
+            return self.call(method, payload, timeout, retries)
+        done.wait()
+        return result.get("body")
+
+    def _worker(self, q: queue.Queue) -> None:
+        while True:
+            job = q.get()
+            try:
+                if callable(job):
+                    job()
+                else:
+                    for method, payload, timeout in job:
+                        self.call(method, payload, timeout)
+            except Exception as e:
+                log.exception("Worker kirim Telegram error: %s", e)
+            finally:
+                q.task_done()
+
+    def queue_depth(self) -> int:
+        return sum(q.qsize() for q in self._queues) if self._pid == os.getpid() else 0
+
+    def flush(self, timeout: float = 10.0) -> None:
+        # tunggu antrian habis (dipanggil saat shutdown)
+        deadline = time.time() + timeout
+        while self.queue_depth() and time.time() < deadline:
+            time.sleep(0.05)
+
+TELEGRAM = TelegramDispatcher(TELEGRAM_SEND_WORKERS, TELEGRAM_SEND_QUEUE_SIZE, TELEGRAM_SEND_MAX_RETRIES)
+atexit.register(TELEGRAM.flush)
+
+_outbox = threading.local()
+
+@contextmanager
+def telegram_batch(chat_id: Optional[int]):
+    # kumpulkan pesan satu update lalu kirim sebagai satu job di akhir blok
+    outer = getattr(_outbox, "calls", None)
+    if outer is not None:
+        yield; return
+    _outbox.calls = []
+    try:
+        yield
+    finally:
+        calls, _outbox.calls = _outbox.calls, None
+        TELEGRAM.submit(chat_id, calls)
+
+def _send(chat_id: Optional[int], method: str, payload: Dict[str, Any], timeout: float, batchable: bool = True) -> None:
+    calls = getattr(_outbox, "calls", None)
+    if batchable and calls is not None:
+        calls.append((method, payload, timeout))
+    else:
+        TELEGRAM.submit(chat_id, [(method, payload, timeout)])
+
 def send_message(chat_id: int, text: str, parse_mode: Optional[str] = "Markdown") -> None:
     if not BOT_TOKEN:
         log.error("BOT_TOKEN kosong, tidak bisa kirim pesan.")
         return
-    url = f"{TELEGRAM_API_BASE}/sendMessage"
     payload = {"chat_id": chat_id, "text": text}
     if parse_mode:
         payload["parse_mode"] = parse_mode
-    try:
-        resp = requests.post(url, json=payload, timeout=15)
-        if not resp.ok:
-            log.warning("sendMessage gagal: %s - %s", resp.status_code, resp.text)
-    except Exception as e:
-        log.exception("sendMessage exception: %s", e)
+    _send(chat_id, "sendMessage", payload, 15)
 
 def send_message_with_inline_keyboard(chat_id: int, text: str,
                                       keyboard: List[List[Dict[str,str]]],
@@ -203,65 +744,977 @@ def send_message_with_inline_keyboard(chat_id: int, text: str,
     if not BOT_TOKEN:
         log.error("BOT_TOKEN kosong.")
         return
-    url = f"{TELEGRAM_API_BASE}/sendMessage"
     payload = {"chat_id": chat_id, "text": text, "reply_markup": {"inline_keyboard": keyboard}}
     if parse_mode:
         payload["parse_mode"] = parse_mode
-    try:
-        resp = requests.post(url, json=payload, timeout=15)
-        if not resp.ok:
-            log.warning("sendMessage (inline) gagal: %s - %s", resp.status_code, resp.text)
-    except Exception as e:
-        log.exception("sendMessage_with_inline_keyboard exception: %s", e)
+    _send(chat_id, "sendMessage", payload, 15)
 
 def send_chat_action(chat_id: int, action: str = "typing") -> None:
     if not BOT_TOKEN: return
-    url = f"{TELEGRAM_API_BASE}/sendChatAction"
-    try:
-        requests.post(url, json={"chat_id": chat_id, "action": action}, timeout=5)
-    except Exception:
-        pass
+    # tidak ikut batch: indikator "typing" harus langsung terlihat
+    _send(chat_id, "sendChatAction", {"chat_id": chat_id, "action": action}, 5, batchable=False)
 
 def answer_callback_query(callback_query_id: str, text: Optional[str] = None, show_alert: bool=False) -> None:
     if not BOT_TOKEN: return
-    url = f"{TELEGRAM_API_BASE}/answerCallbackQuery"
     payload = {"callback_query_id": callback_query_id}
     if text: payload["text"]=text
     if show_alert: payload["show_alert"]=True
-    try:
-        requests.post(url, json=payload, timeout=5)
-    except Exception:
-        pass
+    _send(None, "answerCallbackQuery", payload, 5, batchable=False)
+
+# ------- Streaming jawaban panjang -------
+TELEGRAM_TEXT_LIMIT = 4096
+STREAM_STATS = {"streams": 0, "edits": 0, "first_token_ms_total": 0.0, "first_token_ms_max": 0.0}
+
+def to_telegram_markdown(text: str) -> str:
+    # Markdown gaya LLM (**tebal**, # judul, * butir) -> Markdown lama Telegram
+    out = []
+    for line in (text or "").split("\n"):
+        m = re.match(r"^\s*#{1,6}\s+(.*)$", line)
+        if m: line = f"*{m.group(1).strip('* ')}*"
+        else: line = re.sub(r"^(\s*)[*-]\s+", r"\1• ", line)
+        line = re.sub(r"\*\*(.+?)\*\*", r"*\1*", line)
+        line = re.sub(r"__(.+?)__", r"_\1_", line)
+        out.append(line)
+    return "\n".join(out)
+
+class StreamingReply:
+    """
+    Tampilkan jawaban yang masih di-generate: potongan pertama langsung dikirim
+    (sendMessage untuk dapat message_id), berikutnya editMessageText paling
+    sering tiap `min_interval` detik. Panggilan Telegram lewat shard antrian
+    chat yang sama (TELEGRAM.call_in_order) supaya tidak menyalip balasan
+    yang sudah antre, dan ditunggu thread milik stream ini; update() hanya
+    mencatat teks terbaru, jadi generator
+    (yang memegang slot AI) tidak pernah menunggu Telegram. finish() mengedit
+    sekali lagi dengan teks final ber-Markdown (fallback teks polos bila
+    Markdown ditolak).
+    """
+    CURSOR = " ▌"
+
+    def __init__(self, chat_id: int, min_interval: float = 1.0):
+        self.chat_id = chat_id
+        self.min_interval = min_interval
+        self.message_id: Optional[int] = None
+        self._shown = ""
+        self._latest = ""
+        self._closed = False
+        self._cv = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._started = time.perf_counter()
+        self._disabled = not BOT_TOKEN
+
+    def update(self, text: str) -> None:
+        if self._disabled: return
+        shown = text[:TELEGRAM_TEXT_LIMIT - len(self.CURSOR)]
+        if not shown.strip(): return
+        with self._cv:
+            self._latest = shown; self._cv.notify()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f"stream-{self.chat_id}", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            with self._cv:
+                self._cv.wait_for(lambda: self._closed or self._latest != self._shown)
+                if self._closed: return   # teks final dikirim finish()
+                shown = self._latest
+            if self.message_id is None:
+                now = time.perf_counter()
+                res = TELEGRAM.call_in_order(self.chat_id, "sendMessage",
+                                            {"chat_id": self.chat_id, "text": shown + self.CURSOR}, 15, retries=1)
+                self.message_id = ((res or {}).get("result") or {}).get("message_id")
+                if self.message_id is None:
+                    self._disabled = True; return
+                ttft = (now - self._started) * 1000
+                STREAM_STATS["streams"] += 1; STREAM_STATS["first_token_ms_total"] += ttft
+                STREAM_STATS["first_token_ms_max"] = max(STREAM_STATS["first_token_ms_max"], ttft)
+                log.info("Stream chat %s: potongan pertama tampil setelah %.0f ms", self.chat_id, ttft)
+            else:
+                # edit antara tidak diulang: kalau gagal/kena 429, edit berikutnya yang menyusul
+                TELEGRAM.call_in_order(self.chat_id, "editMessageText",
+                                       {"chat_id": self.chat_id, "message_id": self.message_id,
+                                        "text": shown + self.CURSOR}, 15, retries=0)
+                STREAM_STATS["edits"] += 1
+            self._shown = shown
+            with self._cv:
+                self._cv.wait_for(lambda: self._closed, timeout=self.min_interval)
+
+    def finish(self, text: str) -> bool:
+        # False bila belum ada pesan yang di-stream (pemanggil kirim jawaban seperti biasa)
+        if self._thread is not None:
+            with self._cv:
+                self._closed = True; self._cv.notify()
+            self._thread.join(timeout=35)
+        if self.message_id is None: return False
+        head, rest = text[:TELEGRAM_TEXT_LIMIT], text[TELEGRAM_TEXT_LIMIT:]
+        payload = {"chat_id": self.chat_id, "message_id": self.message_id,
+                   "text": to_telegram_markdown(head), "parse_mode": "Markdown"}
+        if TELEGRAM.call_in_order(self.chat_id, "editMessageText", payload, 15) is None:
+            TELEGRAM.call_in_order(self.chat_id, "editMessageText",
+                                   {"chat_id": self.chat_id, "message_id": self.message_id, "text": head}, 15)
+        STREAM_STATS["edits"] += 1
+        if rest: send_message(self.chat_id, rest, parse_mode=None)
+        return True
 
 # ============================================================
 #  GEMINI HELPERS (opsional)
 # ============================================================
-def ask_gemini(prompt: str) -> str:
+GEMINI_NOT_CONFIGURED_REPLY = "Maaf, AI belum dikonfigurasi (GEMINI_API_KEY belum di-set)."
+GEMINI_EMPTY_REPLY = "Maaf, aku tidak mendapatkan jawaban dari model."
+GEMINI_ERROR_REPLY = "Maaf, sedang ada kendala saat menghubungi AI."
+GEMINI_OVERLOADED_REPLY = "Maaf, AI sedang sibuk. Coba lagi sebentar lagi ya."
+GEMINI_FAILURE_REPLIES = {GEMINI_NOT_CONFIGURED_REPLY, GEMINI_EMPTY_REPLY, GEMINI_ERROR_REPLY, GEMINI_OVERLOADED_REPLY}
+
+class AdmissionControl:
+    """
+    Penjaga panggilan AI (generate + embedding):
+    - token bucket per telegram_user_id (rate/menit + burst) untuk permintaan AI baru;
+    - semaphore global per proses untuk panggilan yang sedang berjalan;
+    - antrian tunggu terbatas (AI_MAX_WAITING) dengan deadline; lewat deadline -> ditolak.
+    Penolakan tidak melempar error: pemanggil memakai jalur DB-only.
+    """
+    def __init__(self, rate_per_min: float, burst: int, max_concurrency: int, max_waiting: int,
+                 max_users: int = 50000):
+        self.rate = rate_per_min / 60.0
+        self.burst = max(1, burst)
+        self.max_waiting = max_waiting
+        self.max_users = max_users
+        self._slots = threading.BoundedSemaphore(max(1, max_concurrency))
+        self._buckets: "OrderedDict[int, Tuple[float, float]]" = OrderedDict()   # user -> (token, waktu)
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.in_flight = 0
+        self.stats = {"admitted": 0, "throttled_user": 0, "rejected_queue_full": 0,
+                      "timed_out": 0, "max_waiting": 0, "max_in_flight": 0}
+
+    def allow_user(self, telegram_user_id: Optional[int]) -> bool:
+        if telegram_user_id is None or self.rate <= 0: return True
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(telegram_user_id, (float(self.burst), now))
+            tokens = min(float(self.burst), tokens + (now - last) * self.rate)
+            ok = tokens >= 1.0
+            if ok: tokens -= 1.0
+            else: self.stats["throttled_user"] += 1
+            self._buckets[telegram_user_id] = (tokens, now)
+            while len(self._buckets) > self.max_users: self._buckets.popitem(last=False)
+        return ok
+
+    @contextmanager
+    def slot(self, deadline_sec: float):
+        # yield True bila dapat slot sebelum deadline; False bila antrian penuh / lewat deadline
+        with self._lock:
+            if self.waiting >= self.max_waiting:
+                self.stats["rejected_queue_full"] += 1
+                admitted = None
+            else:
+                self.waiting += 1
+                self.stats["max_waiting"] = max(self.stats["max_waiting"], self.waiting)
+                admitted = False
+        if admitted is None:
+            yield False; return
+        try:
+            admitted = self._slots.acquire(timeout=max(0.0, deadline_sec))
+        finally:
+            with self._lock:
+                self.waiting -= 1
+                if admitted:
+                    self.in_flight += 1; self.stats["admitted"] += 1
+                    self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.in_flight)
+                else:
+                    self.stats["timed_out"] += 1
+        if not admitted:
+            yield False; return
+        try:
+            yield True
+        finally:
+            with self._lock: self.in_flight -= 1
+            self._slots.release()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self.stats, waiting=self.waiting, in_flight=self.in_flight, users=len(self._buckets))
+
+ADMISSION = AdmissionControl(USER_AI_RATE_PER_MIN, USER_AI_BURST, AI_MAX_CONCURRENCY, AI_MAX_WAITING)
+
+PROMPT_STATS = {"prompts": 0, "tokens": 0, "max_tokens": 0, "context_trimmed_tokens": 0}
+
+def estimate_tokens(text: str) -> int:
+    # perkiraan kasar tokenizer Gemini untuk teks Indonesia/Inggris: ~4 karakter per token
+    return (len(text or "") + 3) // 4
+
+def ask_gemini(prompt: str, on_text=None) -> str:
+    # on_text(teks_sejauh_ini) -> mode streaming; dipanggil tiap potongan baru dari model
     if GEMINI_MODEL is None:
-        return "Maaf, AI belum dikonfigurasi (GEMINI_API_KEY belum di-set)."
-    try:
-        resp = GEMINI_MODEL.generate_content(prompt)
-        return (getattr(resp, "text", "") or "").strip() or "Maaf, aku tidak mendapatkan jawaban dari model."
-    except Exception as e:
-        log.exception("Gemini.generate_content error: %s", e)
-        return "Maaf, sedang ada kendala saat menghubungi AI."
+        return GEMINI_NOT_CONFIGURED_REPLY
+    tokens = estimate_tokens(prompt)
+    PROMPT_STATS["prompts"] += 1; PROMPT_STATS["tokens"] += tokens
+    PROMPT_STATS["max_tokens"] = max(PROMPT_STATS["max_tokens"], tokens)
+    log.info("Prompt Gemini: %d karakter, ~%d token", len(prompt), tokens)
+    with ADMISSION.slot(AI_QUEUE_DEADLINE_SEC) as admitted:
+        if not admitted:
+            log.warning("Gemini penuh (%d berjalan, %d antre), prompt ditolak", ADMISSION.in_flight, ADMISSION.waiting)
+            return GEMINI_OVERLOADED_REPLY
+        try:
+            if on_text is None:
+                resp = GEMINI_MODEL.generate_content(prompt)
+                return (getattr(resp, "text", "") or "").strip() or GEMINI_EMPTY_REPLY
+            parts: List[str] = []
+            for chunk in GEMINI_MODEL.generate_content(prompt, stream=True):
+                try:
+                    piece = getattr(chunk, "text", "") or ""
+                except ValueError:   # potongan tanpa teks (mis. diblok safety filter)
+                    piece = ""
+                if piece:
+                    parts.append(piece)
+                    try: on_text("".join(parts))
+                    except Exception as e: log.warning("Callback stream error: %s", e)
+            return "".join(parts).strip() or GEMINI_EMPTY_REPLY
+        except Exception as e:
+            log.exception("Gemini.generate_content error: %s", e)
+            return GEMINI_ERROR_REPLY
 
 def embed_text(text: str) -> Optional[List[float]]:
     if GEMINI_MODEL is None or genai is None: return None
+    # embedding hanya pelengkap retrieval: tunggu slot sebentar saja, selebihnya lewati
+    with ADMISSION.slot(EMBED_QUEUE_DEADLINE_SEC) as admitted:
+        if not admitted: return None
+        try:
+            res = genai.embed_content(model=GEMINI_EMBED_MODEL, content=text)
+            if isinstance(res, dict) and "embedding" in res: return res["embedding"]
+            if hasattr(res, "embedding"): return res.embedding
+            return None
+        except Exception as e:
+            log.exception("Gemini.embed_content error: %s", e)
+            return None
+
+# ------- Budget konteks prompt -------
+class ContextPiece(NamedTuple):
+    group: str           # blok asal, mis. "menu:12" atau "ref"
+    order: int           # urutan di dalam blok saat dirakit ulang
+    score: float         # relevansi; makin tinggi makin dulu masuk budget
+    text: str
+    divisible: bool = False   # boleh dipotong per baris bila tidak muat utuh
+
+def fit_context(pieces: List[ContextPiece], budget_tokens: int) -> Tuple[Dict[str, str], int, int]:
+    """
+    Pilih potongan konteks berdasar skor sampai budget token habis; potongan
+    yang boleh dipotong diambil baris depannya saja. Hasil: teks per blok
+    (urutan asli di dalam blok), token terpakai, token yang dibuang.
+    """
+    chosen: List[ContextPiece] = []
+    used = dropped = 0
+    for piece in sorted(pieces, key=lambda p: -p.score):
+        cost = estimate_tokens(piece.text) + 1
+        if used + cost <= budget_tokens:
+            chosen.append(piece); used += cost
+            continue
+        if piece.divisible:
+            kept, kept_cost = [], 0
+            for line in piece.text.split("\n"):
+                c = estimate_tokens(line) + 1
+                room = budget_tokens - used - kept_cost
+                if c > room:
+                    if room > 16:   # baris panjang (mis. halaman buku): ambil awalnya saja
+                        kept.append(line[:(room - 1) * 4]); kept_cost += room
+                    break
+                kept.append(line); kept_cost += c
+            if kept and (len(kept) > 1 or len(kept[0]) > 64):   # judul blok saja tidak berguna
+                kept.append("(dipotong)")
+                chosen.append(piece._replace(text="\n".join(kept))); used += kept_cost
+                cost -= kept_cost
+        dropped += cost
+    blocks: Dict[str, List[ContextPiece]] = {}
+    for piece in chosen: blocks.setdefault(piece.group, []).append(piece)
+    return ({g: "\n".join(p.text for p in sorted(ps, key=lambda p: p.order)) for g, ps in blocks.items()},
+            used, dropped)
+
+# ------- Ekstraksi teks resep dari halaman web -------
+JSONLD_RE = re.compile(r"<script[^>]+type=[\"']application/ld\+json[\"'][^>]*>(.*?)</script>", re.I | re.S)
+HTML_DROP_RE = re.compile(r"<(script|style|noscript|svg|nav|header|footer|aside|form|iframe)\b.*?</\1\s*>", re.I | re.S)
+HTML_BREAK_RE = re.compile(r"<(br|/p|/div|/li|/h[1-6]|/tr|li|h[1-6])\b[^>]*>", re.I)
+HTML_TAG_RE = re.compile(r"<[^>]+>")
+
+def _jsonld_nodes(data):
+    # ratakan JSON-LD: list, @graph, dan objek bersarang
+    if isinstance(data, list):
+        for item in data: yield from _jsonld_nodes(item)
+    elif isinstance(data, dict):
+        yield data
+        if "@graph" in data: yield from _jsonld_nodes(data["@graph"])
+
+def find_jsonld_recipe(page_html: str) -> Optional[dict]:
+    # blok schema.org Recipe pertama di halaman (bila ada)
+    for raw in JSONLD_RE.findall(page_html or ""):
+        try:
+            data = json.loads(html.unescape(raw.strip()))
+        except ValueError:
+            continue
+        for node in _jsonld_nodes(data):
+            types = node.get("@type")
+            types = types if isinstance(types, list) else [types]
+            if any(str(t).rsplit("/", 1)[-1].rsplit(":", 1)[-1] == "Recipe" for t in types): return node
+    return None
+
+def _jsonld_instructions(value) -> List[str]:
+    # recipeInstructions bisa string, list string, HowToStep, atau HowToSection berisi itemListElement
+    if isinstance(value, str):
+        return [ln.strip() for ln in re.split(r"\n+|(?<=\.)\s+(?=\d+\.)", html.unescape(HTML_TAG_RE.sub(" ", value))) if ln.strip()]
+    if isinstance(value, dict):
+        if "itemListElement" in value: return _jsonld_instructions(value["itemListElement"])
+        return _jsonld_instructions(value.get("text") or value.get("name") or "")
+    if isinstance(value, list):
+        return [step for item in value for step in _jsonld_instructions(item)]
+    return []
+
+# ---- resep terstruktur (JSON-LD / microdata) -> skema save_generated_menu_to_db ----
+UNICODE_FRACTIONS = {"½": 0.5, "¼": 0.25, "¾": 0.75, "⅓": 1/3, "⅔": 2/3, "⅛": 0.125}
+INGREDIENT_UNITS = {
+    "gram": "gram", "gr": "gram", "g": "gram", "grm": "gram", "kg": "kg", "kilogram": "kg", "ons": "ons",
+    "ml": "ml", "liter": "liter", "ltr": "liter", "l": "liter", "sdm": "sdm", "sendok makan": "sdm",
+    "tbsp": "sdm", "sdt": "sdt", "sendok teh": "sdt", "tsp": "sdt", "buah": "buah", "bh": "buah",
+    "siung": "siung", "butir": "butir", "btr": "butir", "batang": "batang", "btg": "batang",
+    "lembar": "lembar", "lbr": "lembar", "cm": "cm", "ruas": "ruas", "ikat": "ikat", "bungkus": "bungkus",
+    "bks": "bungkus", "sachet": "sachet", "saset": "sachet", "gelas": "gelas", "cangkir": "cangkir",
+    "cup": "cangkir", "mangkuk": "mangkuk", "potong": "potong", "ekor": "ekor", "papan": "papan",
+    "tangkai": "tangkai", "genggam": "genggam", "piring": "piring", "kaleng": "kaleng", "pack": "bungkus",
+}
+QTY_PATTERN = r"\d+(?:[.,]\d+)?(?:\s*(?:\d+/\d+|[½¼¾⅓⅔⅛]))?|\d+/\d+|[½¼¾⅓⅔⅛]"
+INGREDIENT_QTY_RE = re.compile(rf"^\s*({QTY_PATTERN})(?:\s*(?:-|–|s/d|sampai)\s*(?:{QTY_PATTERN}))?\s*")
+INGREDIENT_UNIT_RE = re.compile(
+    r"^(" + "|".join(sorted((re.escape(u) for u in INGREDIENT_UNITS), key=len, reverse=True)) + r")\b\.?\s*", re.I)
+TO_TASTE_RE = re.compile(r"\b(secukupnya|sckpnya|sesuai selera|to taste)\b", re.I)
+
+def _parse_qty(token: str) -> float:
+    total = 0.0
+    for part in re.findall(r"\d+/\d+|\d+(?:[.,]\d+)?|[½¼¾⅓⅔⅛]", token):
+        if part in UNICODE_FRACTIONS: total += UNICODE_FRACTIONS[part]
+        elif "/" in part:
+            num, den = part.split("/"); total += float(num) / float(den) if float(den) else 0.0
+        else: total += float(part.replace(",", "."))
+    return round(total, 2)
+
+def parse_ingredient_line(line: str) -> Optional[dict]:
+    """
+    "1 1/2 sdm kecap manis", "500 gr daging sapi, potong dadu", "garam secukupnya"
+    -> {"nama", "jumlah", "satuan"}. Rentang ("2-3 siung") memakai angka pertama.
+    """
+    text = " ".join(html.unescape(HTML_TAG_RE.sub(" ", line or "")).split())
+    text = re.sub(r"\([^)]*\)", " ", text).strip(" -•*\t")
+    if not text: return None
+    jumlah, satuan = 0.0, ""
+    m = INGREDIENT_QTY_RE.match(text)
+    if m:
+        jumlah = _parse_qty(m.group(1)); text = text[m.end():]
+        u = INGREDIENT_UNIT_RE.match(text)
+        if u: satuan = INGREDIENT_UNITS[u.group(1).lower()]; text = text[u.end():]
+        else: satuan = "buah"
+    if TO_TASTE_RE.search(text):
+        text = TO_TASTE_RE.sub(" ", text)
+        if not m: satuan = "secukupnya"
+    nama = " ".join(text.split(",")[0].split()).strip(" .:-")
+    if not nama: return None
+    return {"nama": nama[:120], "jumlah": jumlah, "satuan": satuan or "unit"}
+
+def _iso_minutes(value) -> Optional[int]:
+    m = re.fullmatch(r"P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:\d+S)?)?", str(value or "").strip(), re.I)
+    if not m or not any(m.groups()): return None
+    d, h, mi = (int(x or 0) for x in m.groups())
+    return d * 1440 + h * 60 + mi
+
+def _guess_difficulty(total_minutes: Optional[int], n_steps: int) -> str:
+    if total_minutes is not None:
+        return "easy" if total_minutes <= 30 else "medium" if total_minutes <= 90 else "hard"
+    return "easy" if n_steps <= 6 else "medium" if n_steps <= 12 else "hard"
+
+def _as_text(value) -> str:
+    if isinstance(value, list): value = value[0] if value else ""
+    if isinstance(value, dict): value = value.get("name") or value.get("text") or ""
+    return " ".join(html.unescape(HTML_TAG_RE.sub(" ", str(value or ""))).split())
+
+def recipe_from_structured(data: dict) -> Optional[dict]:
+    # node Recipe (JSON-LD atau hasil microdata) -> skema /addmenu; None bila tidak lengkap
+    nama = _as_text(data.get("name"))[:200]
+    raw_bahan = data.get("recipeIngredient") or data.get("ingredients") or []
+    if isinstance(raw_bahan, str): raw_bahan = [ln for ln in raw_bahan.splitlines() if ln.strip()]
+    bahan = [b for b in (parse_ingredient_line(_as_text(x)) for x in raw_bahan) if b]
+    langkah = _jsonld_instructions(data.get("recipeInstructions"))
+    if not nama or not (bahan or langkah): return None
+    minutes = _iso_minutes(data.get("totalTime"))
+    if minutes is None:
+        prep, cook = _iso_minutes(data.get("prepTime")), _iso_minutes(data.get("cookTime"))
+        if prep is not None or cook is not None: minutes = (prep or 0) + (cook or 0)
+    return {"nama_masakan": nama, "tingkat_kesulitan": _guess_difficulty(minutes, len(langkah)),
+            "bahan": bahan, "langkah": langkah}
+
+class MicrodataRecipeParser(HTMLParser):
+    # kumpulkan itemprop name/recipeIngredient/recipeInstructions/waktu di dalam itemscope schema.org/Recipe
+    VOID = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+    PROPS = {"name", "recipeIngredient", "ingredients", "recipeInstructions", "totalTime", "prepTime", "cookTime"}
+    BLOCK = {"p", "li", "div", "br", "tr", "h1", "h2", "h3", "h4", "h5", "h6"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.depth = 0
+        self.recipe_depth: Optional[int] = None
+        self.nested_scopes: List[int] = []           # itemscope lain di dalam Recipe (HowToStep, Person, ...)
+        self.capture: Optional[Tuple[str, int, List[str]]] = None
+        self.props: Dict[str, List[str]] = {}
+        self.done = False
+
+    def _emit(self, prop: str, value: str) -> None:
+        value = value.strip()
+        if value: self.props.setdefault(prop, []).append(value)
+
+    def handle_starttag(self, tag, attrs):
+        if self.done: return
+        a = dict(attrs)
+        void = tag in self.VOID
+        if not void: self.depth += 1
+        if self.capture is not None:
+            if tag in self.BLOCK: self.capture[2].append("\n")
+            return
+        if self.recipe_depth is None:
+            if "schema.org/recipe" in (a.get("itemtype") or "").lower(): self.recipe_depth = self.depth
+            return
+        props = set((a.get("itemprop") or "").split()) & self.PROPS
+        if "itemscope" in a and not void and not props & {"recipeInstructions"}:
+            self.nested_scopes.append(self.depth)
+        if not props or (self.nested_scopes and not props & {"recipeInstructions"}): return
+        prop = props.pop()
+        content = a.get("content") or a.get("datetime")
+        if content is not None or void: self._emit(prop, content or "")
+        else: self.capture = (prop, self.depth, [])
+
+    def handle_endtag(self, tag):
+        if self.done or tag in self.VOID: return
+        if self.capture is not None and self.depth == self.capture[1]:
+            prop, _, parts = self.capture; self.capture = None
+            text = "".join(parts)
+            if prop == "recipeInstructions":
+                for ln in text.splitlines(): self._emit(prop, " ".join(ln.split()))
+            else:
+                self._emit(prop, " ".join(text.split()))
+        if self.nested_scopes and self.depth == self.nested_scopes[-1]: self.nested_scopes.pop()
+        if self.recipe_depth is not None and self.depth == self.recipe_depth: self.done = True
+        self.depth -= 1
+
+    def handle_data(self, data):
+        if self.capture is not None: self.capture[2].append(data)
+
+def find_microdata_recipe(page_html: str) -> Optional[dict]:
+    if "schema.org/recipe" not in (page_html or "").lower(): return None
+    parser = MicrodataRecipeParser()
     try:
-        res = genai.embed_content(model=GEMINI_EMBED_MODEL, content=text)
-        if isinstance(res, dict) and "embedding" in res: return res["embedding"]
-        if hasattr(res, "embedding"): return res.embedding
-        return None
+        parser.feed(page_html); parser.close()
     except Exception as e:
-        log.exception("Gemini.embed_content error: %s", e)
+        log.debug("Microdata tidak bisa di-parse: %s", e)
+    if not parser.props: return None
+    p = parser.props
+    return {"name": (p.get("name") or [""])[0],
+            "recipeIngredient": p.get("recipeIngredient") or p.get("ingredients") or [],
+            "recipeInstructions": p.get("recipeInstructions") or [],
+            "totalTime": (p.get("totalTime") or [None])[0], "prepTime": (p.get("prepTime") or [None])[0],
+            "cookTime": (p.get("cookTime") or [None])[0]}
+
+def extract_structured_recipe(page_html: str) -> Optional[dict]:
+    # JSON-LD dulu (paling umum), lalu microdata; None -> perlu Gemini
+    for node in (find_jsonld_recipe(page_html), find_microdata_recipe(page_html)):
+        if node is not None:
+            recipe = recipe_from_structured(node)
+            if recipe is not None: return recipe
+    return None
+
+def html_to_text(page_html: str) -> str:
+    text = HTML_DROP_RE.sub(" ", page_html or "")
+    text = HTML_BREAK_RE.sub("\n", text)
+    text = html.unescape(HTML_TAG_RE.sub(" ", text))
+    lines = [" ".join(ln.split()) for ln in text.splitlines()]
+    return "\n".join(ln for ln in lines if ln)
+
+def build_link_context(page_html: str, budget_tokens: int = 2500) -> Tuple[str, str]:
+    """
+    Ringkas halaman resep untuk prompt: blok JSON-LD Recipe (nama, bahan,
+    langkah) bila ada, selain itu teks halaman tanpa tag/script/navigasi.
+    Hasil dipotong ke budget token. Mengembalikan (jenis, teks).
+    """
+    recipe = find_jsonld_recipe(page_html)
+    if recipe is not None:
+        compact = {"name": recipe.get("name"), "recipeYield": recipe.get("recipeYield"),
+                   "totalTime": recipe.get("totalTime"),
+                   "recipeIngredient": recipe.get("recipeIngredient") or recipe.get("ingredients") or [],
+                   "recipeInstructions": _jsonld_instructions(recipe.get("recipeInstructions"))}
+        kind, text = "json-ld", json.dumps({k: v for k, v in compact.items() if v}, ensure_ascii=False)
+    else:
+        kind, text = "text", html_to_text(page_html)
+    return kind, text[:budget_tokens * 4]
+
+# ------- Cache jawaban Gemini -------
+class ResponseCache:
+    """
+    Cache jawaban LLM: LRU + TTL di memori, opsional tabel di file SQLite
+    (RESPONSE_CACHE_PATH) supaya tetap hangat setelah restart. Tiap entri
+    ditandai id menu konteksnya agar bisa diinvalidasi saat menu berubah.
+    """
+    def __init__(self, max_items: int, ttl_sec: int, path: str = ""):
+        self.max_items = max_items
+        self.ttl_sec = ttl_sec
+        self._mem: "OrderedDict[str, Tuple[float, str, Tuple[int, ...]]]" = OrderedDict()
+        self._by_menu: Dict[int, set] = {}
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self.stats = {"hits": 0, "misses": 0, "disk_hits": 0, "invalidated": 0}
+        if path:
+            try:
+                self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute("CREATE TABLE IF NOT EXISTS response_cache ("
+                                 "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                                 "menu_ids TEXT NOT NULL, expires_at REAL NOT NULL)")
+            except Exception as e:
+                log.warning("Cache jawaban SQLite (%s) tidak bisa dibuka: %s", path, e)
+                self._db = None
+
+    def _mem_put(self, key: str, expires_at: float, value: str, menu_ids: Tuple[int, ...]) -> None:
+        self._mem[key] = (expires_at, value, menu_ids); self._mem.move_to_end(key)
+        for mid in menu_ids: self._by_menu.setdefault(mid, set()).add(key)
+        while len(self._mem) > self.max_items:
+            self._mem_drop(next(iter(self._mem)))
+
+    def _mem_drop(self, key: str) -> None:
+        entry = self._mem.pop(key, None)
+        if entry is None: return
+        for mid in entry[2]:
+            keys = self._by_menu.get(mid)
+            if keys is not None:
+                keys.discard(key)
+                if not keys: del self._by_menu[mid]
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._mem.move_to_end(key); self.stats["hits"] += 1
+                    return entry[1]
+                self._mem_drop(key)
+            if self._db is not None:
+                row = self._db.execute("SELECT value, menu_ids, expires_at FROM response_cache WHERE key=?",
+                                       (key,)).fetchone()
+                if row and row[2] > now:
+                    menu_ids = tuple(int(x) for x in row[1].strip(",").split(",") if x)
+                    self._mem_put(key, row[2], row[0], menu_ids)
+                    self.stats["hits"] += 1; self.stats["disk_hits"] += 1
+                    return row[0]
+            self.stats["misses"] += 1
         return None
 
-def cosine_similarity(a: List[float], b: List[float]) -> float:
-    if not a or not b or len(a)!=len(b): return 0.0
-    dot = sum(x*y for x,y in zip(a,b))
-    na = math.sqrt(sum(x*x for x in a)); nb = math.sqrt(sum(x*x for x in b))
-    return 0.0 if (na==0.0 or nb==0.0) else dot/(na*nb)
+    def put(self, key: str, value: str, menu_ids: List[int]) -> None:
+        expires_at, ids = time.time() + self.ttl_sec, tuple(menu_ids)
+        with self._lock:
+            self._mem_put(key, expires_at, value, ids)
+            if self._db is not None:
+                try:
+                    self._db.execute("INSERT OR REPLACE INTO response_cache VALUES (?,?,?,?)",
+                                     (key, value, "," + ",".join(map(str, ids)) + ",", expires_at))
+                    self._db.execute("DELETE FROM response_cache WHERE expires_at < ?", (time.time(),))
+                except Exception as e:
+                    log.warning("Gagal menulis cache jawaban: %s", e)
+
+    def invalidate_menu(self, id_menu: int) -> None:
+        with self._lock:
+            keys = list(self._by_menu.get(id_menu, ()))
+            for key in keys: self._mem_drop(key)
+            self.stats["invalidated"] += len(keys)
+            if self._db is not None:
+                try:
+                    self._db.execute("DELETE FROM response_cache WHERE menu_ids LIKE ?", (f"%,{id_menu},%",))
+                except Exception as e:
+                    log.warning("Gagal invalidasi cache jawaban: %s", e)
+
+RESPONSE_CACHE = ResponseCache(RESPONSE_CACHE_MAX, RESPONSE_CACHE_TTL_SEC, RESPONSE_CACHE_PATH)
+
+def response_cache_key(user_text: str, menu_blocks: List[Tuple[int, str]], knowledge_ids: List[int]) -> str:
+    # query ter-normalisasi + (id, digest isi konteks) per menu: isi menu berubah -> key berubah
+    q_norm = _normalize_name(user_text) or (user_text or "").strip().lower()
+    menus = [(mid, hashlib.sha1(block.encode("utf-8")).hexdigest()[:16]) for mid, block in menu_blocks]
+    raw = json.dumps([q_norm, menus, knowledge_ids, getattr(GEMINI_MODEL, "model_name", "")])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+# ============================================================
+#  RETRIEVAL knowledge_chunks (NumPy, opsional)
+# ============================================================
+def encode_embedding(vec, fmt: str = "f32") -> Tuple[bytes, int]:
+    arr = np.asarray(vec, dtype=np.float32).ravel()
+    if fmt == "i8":
+        # skala per-vektor tidak disimpan: retrieval hanya butuh arah (cosine)
+        peak = float(np.abs(arr).max()) or 1.0
+        return np.round(arr * (127.0 / peak)).astype(np.int8).tobytes(), int(arr.size)
+    return arr.astype("<f4").tobytes(), int(arr.size)
+
+def decode_embedding(blob: bytes, dim: int, fmt: Optional[str] = "f32"):
+    # zero-copy: array read-only yang langsung menunjuk buffer blob
+    arr = np.frombuffer(blob, dtype=np.int8 if fmt == "i8" else np.dtype("<f4"))
+    if dim and arr.size != dim:
+        raise ValueError(f"dimensi embedding {arr.size} != {dim}")
+    return arr
+
+# ------- Embedder (bisa diganti) -------
+class GeminiEmbedder:
+    # embedding produksi; satu panggilan API per batch teks
+    def __init__(self, model: str):
+        self.model = model
+        self.name = f"gemini:{model}"
+
+    @property
+    def available(self) -> bool:
+        return GEMINI_MODEL is not None and genai is not None
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        if not self.available: raise RuntimeError("Gemini belum dikonfigurasi (GEMINI_API_KEY).")
+        res = genai.embed_content(model=self.model, content=list(texts))
+        vecs = res["embedding"] if isinstance(res, dict) else res.embedding
+        if len(texts) == 1 and vecs and not isinstance(vecs[0], (list, tuple)): vecs = [vecs]
+        if len(vecs) != len(texts): raise RuntimeError(f"Gemini mengembalikan {len(vecs)} embedding untuk {len(texts)} teks")
+        return [list(v) for v in vecs]
+
+class LocalHashEmbedder:
+    """
+    Pengganti offline yang deterministik: feature hashing kata + trigram huruf
+    ke vektor berdimensi tetap, dinormalisasi L2. Tidak sebagus model sungguhan,
+    tetapi stabil antar proses sehingga ingest/test bisa jalan tanpa API.
+    """
+    available = True
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.name = f"local-hash:{dim}"
+
+    def _features(self, text: str):
+        for w in _normalize_name(text).split():
+            yield "w:" + w
+            padded = f" {w} "
+            for i in range(len(padded) - 2): yield "g:" + padded[i:i+3]
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        out = []
+        for text in texts:
+            vec = [0.0] * self.dim
+            for f in self._features(text):
+                h = int.from_bytes(hashlib.blake2b(f.encode("utf-8"), digest_size=8).digest(), "little")
+                vec[h % self.dim] += 1.0 if (h >> 63) else -1.0
+            norm = math.sqrt(sum(x * x for x in vec)) or 1.0
+            out.append([x / norm for x in vec])
+        return out
+
+EMBEDDERS = {
+    "gemini": lambda: GeminiEmbedder(GEMINI_EMBED_MODEL),
+    "local": lambda: LocalHashEmbedder(LOCAL_EMBED_DIM),
+}
+
+def get_embedder(name: Optional[str] = None):
+    key = (name or KNOWLEDGE_EMBEDDER).lower()
+    if key not in EMBEDDERS:
+        raise ValueError(f"Embedder tidak dikenal: {key} (pilihan: {', '.join(EMBEDDERS)})")
+    return EMBEDDERS[key]()
+
+class EmbeddingCache:
+    """
+    Cache embedding kueri: key = nama model embedder + teks ter-normalisasi
+    (_normalize_name), nilai = float32 mentah (4 byte/dimensi). LRU dengan
+    batas total byte, opsional tabel di file SQLite (EMBED_CACHE_PATH).
+    Embedding deterministik per model, jadi tidak perlu TTL.
+    """
+    def __init__(self, max_bytes: int, path: str = ""):
+        self.max_bytes = max_bytes
+        self._mem: "OrderedDict[str, bytes]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self.stats = {"hits": 0, "misses": 0, "disk_hits": 0, "evicted": 0}
+        if path:
+            try:
+                self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute("CREATE TABLE IF NOT EXISTS embedding_cache (key TEXT PRIMARY KEY, vec BLOB NOT NULL)")
+            except Exception as e:
+                log.warning("Cache embedding SQLite (%s) tidak bisa dibuka: %s", path, e)
+                self._db = None
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        norm = _normalize_name(text) or " ".join((text or "").lower().split())
+        return f"{model}|{norm}"
+
+    @staticmethod
+    def _decode(blob: bytes) -> array:
+        vec = array("f"); vec.frombytes(blob)
+        return vec
+
+    def _mem_put(self, key: str, blob: bytes) -> None:
+        old = self._mem.pop(key, None)
+        if old is not None: self._bytes -= len(key) + len(old)
+        self._mem[key] = blob; self._bytes += len(key) + len(blob)
+        while self._bytes > self.max_bytes and self._mem:
+            k, v = self._mem.popitem(last=False)
+            self._bytes -= len(k) + len(v); self.stats["evicted"] += 1
+
+    def get(self, key: str) -> Optional[array]:
+        with self._lock:
+            blob = self._mem.get(key)
+            if blob is not None:
+                self._mem.move_to_end(key); self.stats["hits"] += 1
+                return self._decode(blob)
+            if self._db is not None:
+                row = self._db.execute("SELECT vec FROM embedding_cache WHERE key=?", (key,)).fetchone()
+                if row:
+                    self._mem_put(key, bytes(row[0]))
+                    self.stats["hits"] += 1; self.stats["disk_hits"] += 1
+                    return self._decode(row[0])
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, key: str, vec) -> array:
+        arr = array("f", vec)
+        blob = arr.tobytes()
+        with self._lock:
+            self._mem_put(key, blob)
+            if self._db is not None:
+                try:
+                    self._db.execute("INSERT OR REPLACE INTO embedding_cache VALUES (?,?)", (key, blob))
+                except Exception as e:
+                    log.warning("Gagal menulis cache embedding: %s", e)
+        return arr
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.stats["hits"] + self.stats["misses"]
+            return dict(self.stats, entries=len(self._mem), bytes=self._bytes, max_bytes=self.max_bytes,
+                        hit_rate=round(self.stats["hits"] / total, 4) if total else 0.0)
+
+EMBED_CACHE = EmbeddingCache(EMBED_CACHE_MAX_BYTES, EMBED_CACHE_PATH)
+
+def embed_query(text: str) -> Optional[array]:
+    # embedding kueri harus dari embedder yang sama dengan isi knowledge_chunks
+    embedder = get_embedder()
+    key = EmbeddingCache.key(embedder.name, text)
+    vec = EMBED_CACHE.get(key)
+    if vec is not None: return vec
+    if isinstance(embedder, GeminiEmbedder):
+        vec = embed_text(text)
+    else:
+        vec = embedder.embed([text])[0]
+    return EMBED_CACHE.put(key, vec) if vec else None
+
+class KnowledgeIndex(RefreshingIndex):
+    """
+    Semua embedding knowledge_chunks dimuat sekali ke satu matriks float32
+    kontigu yang barisnya sudah dinormalisasi, sehingga top-k cosine cukup
+    satu perkalian matriks-vektor. Teks chunk tidak disimpan di memori,
+    hanya diambil dari DB untuk hasil top-k.
+    """
+    name = "knowledge-index"
+
+    def __init__(self, refresh_sec: int = 0):
+        super().__init__(refresh_sec)
+        # (matrix (n, dim) float32, ids (n,) int64) diganti utuh dengan satu assignment supaya
+        # pencarian yang berjalan saat rebuild tidak memasangkan matriks baru dengan ids lama
+        self._data = None
+
+    @property
+    def size(self) -> int:
+        data = self._data
+        return 0 if data is None else int(data[1].shape[0])
+
+    def build(self) -> None:
+        if np is None:
+            log.warning("NumPy tidak tersedia, retrieval knowledge_chunks dimatikan.")
+            return
+        # hanya vektor dari embedder yang juga dipakai untuk kueri (NULL = data lama Gemini)
+        embedder = get_embedder()
+        same_model = KnowledgeChunk.embedding_model == embedder.name
+        if isinstance(embedder, GeminiEmbedder):
+            same_model = same_model | KnowledgeChunk.embedding_model.is_(None)
+        with get_session() as session:
+            total = session.query(func.count(KnowledgeChunk.id)).filter(same_model).scalar() or 0
+            matrix, ids, dim, n = None, None, 0, 0
+            q = (session.query(KnowledgeChunk.id, KnowledgeChunk.embedding_bin,
+                               KnowledgeChunk.embedding_dim, KnowledgeChunk.embedding_fmt,
+                               KnowledgeChunk.embedding_json)
+                 .filter(same_model,
+                         (KnowledgeChunk.embedding_bin.isnot(None)) | (KnowledgeChunk.embedding_json.isnot(None)))
+                 .order_by(KnowledgeChunk.id.asc()).yield_per(1000))
+            for chunk_id, emb_bin, emb_dim, emb_fmt, emb_json in q:
+                try:
+                    if emb_bin is not None:
+                        vec = decode_embedding(emb_bin, emb_dim or 0, emb_fmt)
+                    else:
+                        vec = np.asarray(json.loads(emb_json), dtype=np.float32)
+                except Exception:
+                    continue
+                if vec.ndim != 1 or vec.size == 0: continue
+                if matrix is None:
+                    dim = int(vec.size)
+                    matrix = np.empty((total, dim), dtype=np.float32)
+                    ids = np.empty(total, dtype=np.int64)
+                if vec.size != dim or n >= total: continue
+                matrix[n] = vec; ids[n] = chunk_id; n += 1
+        if matrix is None or n == 0:
+            matrix, ids = np.zeros((0, 0), dtype=np.float32), np.zeros(0, dtype=np.int64)
+        else:
+            matrix, ids = matrix[:n], ids[:n]
+            norms = np.linalg.norm(matrix, axis=1)
+            keep = norms > 0
+            matrix = np.ascontiguousarray(matrix[keep] / norms[keep, None], dtype=np.float32)
+            ids = ids[keep]
+        self._data = (matrix, ids)
+        log.info("Index knowledge dibangun: %d chunk, dim=%d, %.1f KB",
+                 ids.shape[0], dim, matrix.nbytes / 1024)
+
+    def search(self, query_vec: List[float], k: int = 3, min_score: float = 0.0) -> List[Tuple[int, float]]:
+        if np is None or not query_vec: return []
+        self.ensure_fresh()
+        data = self._data
+        if data is None: return []
+        matrix, ids = data
+        if ids.shape[0] == 0: return []
+        q = np.asarray(query_vec, dtype=np.float32)
+        if q.shape != (matrix.shape[1],): return []
+        norm = float(np.linalg.norm(q))
+        if norm == 0.0: return []
+        scores = matrix @ (q / norm)
+        k = min(k, scores.shape[0])
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(ids[i]), float(scores[i])) for i in top if scores[i] >= min_score]
+
+KNOWLEDGE_INDEX = KnowledgeIndex(KNOWLEDGE_INDEX_REFRESH_SEC)
+
+def build_knowledge_context(chunks: List[Tuple[KnowledgeChunk, float]], max_chars: int = 1200) -> str:
+    lines=[]
+    for c, score in chunks:
+        page = f" hal. {c.page_no}" if c.page_no is not None else ""
+        lines.append(f"[{c.source}{page} | skor {score:.3f}]")
+        lines.append((c.chunk_text or "").strip()[:max_chars])
+        lines.append("")
+    return "\n".join(lines).strip()
+
+# ------- Ingest dokumen sumber -> knowledge_chunks -------
+def iter_document_pages(path: str):
+    """
+    Baca dokumen halaman per halaman (streaming): PDF (butuh pypdf), JSON Lines
+    {"page_no", "text"}, atau teks biasa dengan pemisah halaman form feed (\\f).
+    """
+    lower = path.lower()
+    if lower.endswith(".pdf"):
+        if PdfReader is None: raise RuntimeError("pypdf dibutuhkan untuk membaca PDF.")
+        for i, page in enumerate(PdfReader(path).pages, start=1):
+            yield i, page.extract_text() or ""
+        return
+    with open(path, "r", encoding="utf-8") as fh:
+        if lower.endswith((".jsonl", ".ndjson")):
+            for i, line in enumerate(fh, start=1):
+                if not line.strip(): continue
+                obj = json.loads(line)
+                yield int(obj.get("page_no") or i), str(obj.get("text") or "")
+            return
+        page_no, buf = 1, []
+        for line in fh:
+            while "\f" in line:
+                head, line = line.split("\f", 1)
+                buf.append(head)
+                yield page_no, "".join(buf)
+                page_no, buf = page_no + 1, []
+            buf.append(line)
+        if "".join(buf).strip(): yield page_no, "".join(buf)
+
+def chunk_page_text(text: str, max_chars: int = 1200, overlap: int = 200) -> List[str]:
+    # jendela per kata (teks asli dipertahankan), tiap jendela <= max_chars, tumpang tindih ~overlap huruf
+    spans = [m.span() for m in re.finditer(r"\S+", text or "")]
+    chunks, start = [], 0
+    while start < len(spans):
+        end = start
+        while end + 1 < len(spans) and spans[end + 1][1] - spans[start][0] <= max_chars:
+            end += 1
+        chunks.append(text[spans[start][0]:spans[end][1]])
+        if end + 1 >= len(spans): break
+        nxt = end + 1
+        while nxt - 1 > start and spans[end][1] - spans[nxt - 1][0] <= overlap:
+            nxt -= 1
+        start = nxt
+    return chunks
+
+def _chunk_hash(chunk_text: str) -> str:
+    return hashlib.sha256(chunk_text.encode("utf-8")).hexdigest()
+
+def ingest_knowledge_document(source: str, pages, embedder, batch_size: int = 64,
+                              max_chars: int = 1200, overlap: int = 200, fmt: str = "f32") -> Dict[str, int]:
+    """
+    Sinkronkan knowledge_chunks satu sumber dengan dokumen `pages` ((page_no, teks)).
+    Chunk yang hash isinya (dan embedder-nya) sama dengan baris yang ada dilewati;
+    hanya chunk baru/berubah yang di-embed, per batch, lalu ditulis multi-row.
+    Chunk lama yang tidak muncul lagi dihapus.
+    """
+    stats = {"pages": 0, "chunks": 0, "unchanged": 0, "embedded": 0, "deleted": 0}
+    legacy_model = f"gemini:{GEMINI_EMBED_MODEL}"
+    # (page_no) -> {hash: [id, ...]} untuk baris yang embedding-nya masih cocok; sisanya kandidat hapus
+    existing: Dict[int, Dict[str, List[int]]] = {}
+    other_rows: Dict[int, List[int]] = {}
+    with get_session() as session:
+        backfill = []
+        for cid, page_no, h, model, chunk_text in (
+                session.query(KnowledgeChunk.id, KnowledgeChunk.page_no, KnowledgeChunk.content_hash,
+                              KnowledgeChunk.embedding_model, KnowledgeChunk.chunk_text)
+                .filter(KnowledgeChunk.source == source).yield_per(1000)):
+            if h is None:
+                h = _chunk_hash(chunk_text or ""); backfill.append({"id": cid, "content_hash": h})
+            if (model or legacy_model) == embedder.name:
+                existing.setdefault(page_no, {}).setdefault(h, []).append(cid)
+            else:
+                other_rows.setdefault(page_no, []).append(cid)
+        if backfill: session.execute(update(KnowledgeChunk), backfill)
+
+    pending: List[dict] = []
+    stale: List[int] = []
+    def flush():
+        nonlocal pending, stale
+        if pending:
+            vecs = embedder.embed([r["chunk_text"] for r in pending])
+            for r, vec in zip(pending, vecs):
+                r["embedding_bin"], r["embedding_dim"] = encode_embedding(vec, fmt)
+        with get_session() as session:
+            if stale: session.execute(delete(KnowledgeChunk).where(KnowledgeChunk.id.in_(stale)))
+            if pending: session.execute(insert(KnowledgeChunk), pending)
+        stats["embedded"] += len(pending); stats["deleted"] += len(stale)
+        pending, stale = [], []
+
+    seen_pages = set()
+    for page_no, text in pages:
+        stats["pages"] += 1; seen_pages.add(page_no)
+        have = existing.pop(page_no, {})
+        stale.extend(other_rows.pop(page_no, []))
+        for chunk_no, chunk_text in enumerate(chunk_page_text(text, max_chars, overlap), start=1):
+            stats["chunks"] += 1
+            h = _chunk_hash(chunk_text)
+            if have.get(h):
+                have[h].pop(); stats["unchanged"] += 1
+                continue
+            title = next((ln.strip() for ln in chunk_text.splitlines() if ln.strip()), "")[:255]
+            pending.append({"source": source, "title": title, "page_no": page_no, "chunk_no": chunk_no,
+                            "chunk_text": chunk_text, "content_hash": h, "embedding_model": embedder.name,
+                            "embedding_fmt": fmt})
+        for ids in have.values(): stale.extend(ids)
+        if len(pending) >= batch_size: flush()
+    # halaman yang sudah tidak ada di dokumen
+    for page_no, by_hash in existing.items():
+        if page_no not in seen_pages:
+            for ids in by_hash.values(): stale.extend(ids)
+    for page_no, ids in other_rows.items():
+        if page_no not in seen_pages: stale.extend(ids)
+    flush()
+    return stats
 
 # ============================================================
 #  DOMAIN LOGIC
@@ -278,42 +1731,686 @@ def _normalize_name(s: str) -> str:
     tokens = [w for w in s.split() if w and w not in MENU_SEARCH_STOPWORDS]
     return " ".join(tokens).strip()
 
-def find_relevant_menus(session: Session, query_text: str, limit: int = 3) -> List[Menu]:
-    q_raw = (query_text or "").strip()
-    if not q_raw: return []
-    q_norm = _normalize_name(q_raw)
-    if not q_norm: return []
-    q_tokens = set(q_norm.split())
-    candidates: List[Menu] = session.query(Menu).all()
-    if not candidates: return []
-    def score(menu: Menu)->int:
-        name_norm = _normalize_name(menu.nama_masakan or "")
-        if not name_norm: return 0
-        s=0
-        if name_norm==q_norm: s+=1000
-        s+= 20*len(q_tokens & set(name_norm.split()))
-        if q_norm in name_norm or name_norm in q_norm: s+=50
-        return s
-    scored=[(m,score(m)) for m in candidates]
-    scored=[x for x in scored if x[1]>0]
-    scored.sort(key=lambda x:(-x[1], (x[0].nama_masakan or "").lower()))
-    return [m for m,_ in scored[:limit]]
-
-def ensure_user(session: Session, telegram_user_id: int) -> User:
-    user = session.get(User, telegram_user_id)
-    if not user:
-        user = User(telegram_user_id=telegram_user_id)
-        session.add(user)
+# ------- Index pencarian menu -------
+class MenuSearchIndex(RefreshingIndex):
+    """
+    Inverted index token -> id_menu + nama ter-normalisasi, dibangun sekali lalu
+    di-update inkremental. Skor identik dengan scoring lama:
+    exact +1000, +20 per token sama, +50 bila salah satu substring yang lain.
+    """
+    name = "menu-index"
+
+    def __init__(self, refresh_sec: int = 0):
+        super().__init__(refresh_sec)
+        self._norm: Dict[int, str] = {}          # id_menu -> nama ter-normalisasi
+        self._lower: Dict[int, str] = {}         # id_menu -> nama lowercase (tie-break)
+        self._tokens: Dict[str, set] = {}        # token -> {id_menu}
+        self._by_norm: Dict[str, set] = {}       # nama ter-normalisasi -> {id_menu}
+        self._lengths: Dict[int, int] = {}       # panjang nama -> jumlah nama
+        self._blob = ""; self._offsets: List[int] = []; self._blob_ids: List[int] = []
+        self._blob_dirty = True
+
+    # ---- build / update ----
+    def build(self) -> None:
+        with get_session() as session:
+            rows = session.query(Menu.id_menu, Menu.nama_masakan).all()
+        fresh = MenuSearchIndex()
+        for id_menu, nama in rows:
+            fresh._add(id_menu, nama)
+        with self._lock:
+            (self._norm, self._lower, self._tokens, self._by_norm, self._lengths) = (
+                fresh._norm, fresh._lower, fresh._tokens, fresh._by_norm, fresh._lengths)
+            self._blob_dirty = True
+        log.info("Index menu dibangun: %d menu, %d token", len(fresh._norm), len(fresh._tokens))
+
+    def _add(self, id_menu: int, nama: str) -> None:
+        norm = _normalize_name(nama or "")
+        self._lower[id_menu] = (nama or "").lower()
+        if not norm: return
+        self._norm[id_menu] = norm
+        for t in set(norm.split()):
+            self._tokens.setdefault(t, set()).add(id_menu)
+        self._by_norm.setdefault(norm, set()).add(id_menu)
+        self._lengths[len(norm)] = self._lengths.get(len(norm), 0) + 1
+
+    def _remove(self, id_menu: int) -> None:
+        self._lower.pop(id_menu, None)
+        norm = self._norm.pop(id_menu, None)
+        if not norm: return
+        for t in set(norm.split()):
+            ids = self._tokens.get(t)
+            if ids is not None:
+                ids.discard(id_menu)
+                if not ids: del self._tokens[t]
+        ids = self._by_norm.get(norm)
+        if ids is not None:
+            ids.discard(id_menu)
+            if not ids: del self._by_norm[norm]
+        n = self._lengths.get(len(norm), 0) - 1
+        if n > 0: self._lengths[len(norm)] = n
+        else: self._lengths.pop(len(norm), None)
+
+    def upsert(self, id_menu: int, nama: str) -> None:
+        with self._lock:
+            self._remove(id_menu)
+            self._add(id_menu, nama)
+            self._blob_dirty = True
+
+    def remove(self, id_menu: int) -> None:
+        with self._lock:
+            self._remove(id_menu)
+            self._blob_dirty = True
+
+    # ---- query ----
+    def _ids_containing(self, q_norm: str) -> set:
+        # semua nama yang memuat q_norm sebagai substring (scan string gabungan di C)
+        if self._blob_dirty:
+            ids = sorted(self._norm)
+            offsets, pos = [], 0
+            for i in ids:
+                offsets.append(pos); pos += len(self._norm[i]) + 1
+            self._blob = "\n".join(self._norm[i] for i in ids)
+            self._offsets, self._blob_ids, self._blob_dirty = offsets, ids, False
+        found, blob, offsets = set(), self._blob, self._offsets
+        start = blob.find(q_norm)
+        while start != -1:
+            k = bisect.bisect_right(offsets, start) - 1
+            found.add(self._blob_ids[k])
+            nxt = offsets[k+1] if k+1 < len(offsets) else len(blob)
+            start = blob.find(q_norm, nxt)
+        return found
+
+    def _ids_within(self, q_norm: str) -> set:
+        # semua nama yang merupakan substring dari q_norm (lookup per panjang nama)
+        found, n = set(), len(q_norm)
+        lengths = [l for l in self._lengths if l <= n]
+        for i in range(n):
+            for l in lengths:
+                if i + l <= n:
+                    ids = self._by_norm.get(q_norm[i:i+l])
+                    if ids: found |= ids
+        return found
+
+    def search(self, query_text: str, limit: int = 3) -> List[int]:
+        return [mid for mid, _ in self.search_scored(query_text, limit)]
+
+    def search_scored(self, query_text: str, limit: int = 3) -> List[Tuple[int, int]]:
+        # skor: +20 per token sama, +50 nama memuat/termuat kueri, +1000 nama persis
+        q_norm = _normalize_name((query_text or "").strip())
+        if not q_norm: return []
+        q_tokens = set(q_norm.split())
+        self.ensure_fresh()
+        with self._lock:
+            scores: Dict[int, int] = {}
+            for t in q_tokens:
+                for mid in self._tokens.get(t, ()):
+                    scores[mid] = scores.get(mid, 0) + 20
+            for mid in self._ids_containing(q_norm) | self._ids_within(q_norm):
+                scores[mid] = scores.get(mid, 0) + 50
+            for mid in self._by_norm.get(q_norm, ()):
+                scores[mid] += 1000
+            ranked = sorted(scores.items(), key=lambda x: (-x[1], self._lower.get(x[0], "")))
+        return ranked[:limit]
+
+MENU_INDEX = MenuSearchIndex(MENU_INDEX_REFRESH_SEC)
+
+# ------- Detail menu (bulk, read-only) -------
+class MenuBahanInfo(NamedTuple):
+    id_bahan: int
+    nama_bahan: str
+    satuan_bahan: str
+    banyak_bahan: Any
+    catatan: Optional[str]
+
+class MenuDetail(NamedTuple):
+    id_menu: int
+    nama_masakan: str
+    tingkat_kesulitan: Optional[str]
+    source_url: Optional[str]
+    bahan: Tuple[MenuBahanInfo, ...]
+    langkah: Tuple[Tuple[int, str], ...]   # (langkah_no, deskripsi), urut
+
+def load_menu_details(session: Session, ids: List[int]) -> List[MenuDetail]:
+    # selalu 3 query (menu, bahan, langkah) berapa pun jumlah menunya; urutan mengikuti ids
+    if not ids: return []
+    menus = {r.id_menu: r for r in session.query(Menu.id_menu, Menu.nama_masakan, Menu.tingkat_kesulitan,
+                                                 Menu.source_url).filter(Menu.id_menu.in_(ids)).all()}
+    if not menus: return []
+    bahan: Dict[int, List[MenuBahanInfo]] = {}
+    for r in (session.query(MenuBahan.id_menu, MenuBahan.id_bahan, Bahan.nama_bahan, Bahan.satuan_bahan,
+                            MenuBahan.banyak_bahan, MenuBahan.catatan)
+              .join(Bahan, MenuBahan.id_bahan==Bahan.id_bahan)
+              .filter(MenuBahan.id_menu.in_(list(menus)))
+              .order_by(MenuBahan.id_menu.asc(), MenuBahan.id_bahan.asc()).all()):
+        bahan.setdefault(r.id_menu, []).append(
+            MenuBahanInfo(r.id_bahan, r.nama_bahan, r.satuan_bahan, r.banyak_bahan, r.catatan))
+    langkah: Dict[int, List[Tuple[int, str]]] = {}
+    for r in (session.query(MenuLangkah.id_menu, MenuLangkah.langkah_no, MenuLangkah.deskripsi)
+              .filter(MenuLangkah.id_menu.in_(list(menus)))
+              .order_by(MenuLangkah.id_menu.asc(), MenuLangkah.langkah_no.asc()).all()):
+        langkah.setdefault(r.id_menu, []).append((r.langkah_no, r.deskripsi))
+    out = []
+    for mid in ids:
+        m = menus.get(mid)
+        if m is None: continue
+        out.append(MenuDetail(m.id_menu, m.nama_masakan, m.tingkat_kesulitan, m.source_url,
+                              tuple(bahan.get(mid, ())), tuple(langkah.get(mid, ()))))
+    return out
+
+# ------- Bahan yang dimiliki user -------
+# hanya frasa yang jelas menyebut daftar bahan; "ada"/"sisa"/"bahan" polos juga muncul di
+# pertanyaan biasa ("ada resep nasi goreng?") dan akan menggeser pencarian nama menu
+INGREDIENT_TRIGGER_RE = re.compile(
+    r"\b(?:punya|tersedia|(?:ada|sisa)\s+bahan(?:nya|ku)?|bahan(?:nya|ku)?\s*:)(?!\s*(?:resep|menu)\b)\s*:?", re.I)
+INGREDIENT_SPLIT_RE = re.compile(r"\s*(?:,|;|/|&|\+|\n|\bdan\b|\bsama\b|\bserta\b)\s*", re.I)
+INGREDIENT_FILLER = {"aku","saya","cuma","hanya","juga","sedikit","ada","punya","bahan","nih","dong","lagi",
+                     "mau","masak","apa","yang","bisa","di","kulkas","rumah"}
+# bumbu dasar yang dianggap selalu ada di dapur
+PANTRY_STAPLES = {"garam","gula","gula pasir","air","minyak","minyak goreng","merica","lada","penyedap"}
+
+# variasi ejaan/daerah -> bentuk baku (per kata)
+NAME_SYNONYMS = {
+    "cabe": "cabai", "lombok": "cabai", "telor": "telur", "sereh": "serai", "bombay": "bombai",
+    "toge": "tauge", "taoge": "tauge", "sledri": "seledri", "bawput": "bawang putih",
+    "bamer": "bawang merah", "kol": "kubis", "kobis": "kubis", "santen": "santan",
+    "laos": "lengkuas", "pete": "petai", "micin": "msg", "vetsin": "msg",
+}
+
+def _normalize_bahan(s: str) -> str:
+    words = re.sub(r"[^a-z0-9]+", " ", (s or "").lower()).split()
+    return " ".join(NAME_SYNONYMS.get(w, w) for w in words)
+
+def parse_ingredient_list(text: str) -> List[str]:
+    # "aku punya telur, nasi, kecap" -> ["telur","nasi","kecap"]; [] bila bukan daftar bahan
+    m = INGREDIENT_TRIGGER_RE.search(text or "")
+    if not m: return []
+    items = []
+    for part in INGREDIENT_SPLIT_RE.split(text[m.end():]):
+        words = [w for w in _normalize_bahan(part).split() if w not in INGREDIENT_FILLER]
+        if words: items.append(" ".join(words))
+    return items
+
+class IngredientMatch(NamedTuple):
+    id_menu: int
+    matched: int
+    total: int
+    missing: Tuple[int, ...]   # id_bahan yang belum dimiliki
+
+class IngredientIndex(RefreshingIndex):
+    """
+    Inverted index bahan -> menu (array id_menu terurut per id_bahan) untuk
+    meranking menu berdasarkan cakupan bahan yang dimiliki user. Biaya query
+    sebanding jumlah posting bahan yang disebut, bukan ukuran katalog.
+    """
+    name = "ingredient-index"
+
+    def __init__(self, refresh_sec: int = 0):
+        super().__init__(refresh_sec)
+        self._postings: Dict[int, array] = {}        # id_bahan -> array('q') id_menu terurut
+        self._menu_bahan: Dict[int, frozenset] = {}  # id_menu -> {id_bahan}
+        self._bahan_norm: Dict[str, int] = {}        # nama bahan ter-normalisasi -> id_bahan
+        self._bahan_tokens: Dict[str, set] = {}      # token -> {id_bahan}
+        self._staples: set = set()
+
+    def build(self) -> None:
+        with get_session() as session:
+            bahan_rows = session.query(Bahan.id_bahan, Bahan.nama_bahan).all()
+            pairs = (session.query(MenuBahan.id_menu, MenuBahan.id_bahan)
+                     .order_by(MenuBahan.id_bahan.asc(), MenuBahan.id_menu.asc()).all())
+        fresh = IngredientIndex()
+        for id_bahan, nama in bahan_rows: fresh._add_bahan(id_bahan, nama)
+        menu_bahan: Dict[int, set] = {}
+        for id_menu, id_bahan in pairs:
+            fresh._postings.setdefault(id_bahan, array("q")).append(id_menu)
+            menu_bahan.setdefault(id_menu, set()).add(id_bahan)
+        fresh._menu_bahan = {mid: frozenset(b) for mid, b in menu_bahan.items()}
+        with self._lock:
+            (self._postings, self._menu_bahan, self._bahan_norm, self._bahan_tokens, self._staples) = (
+                fresh._postings, fresh._menu_bahan, fresh._bahan_norm, fresh._bahan_tokens, fresh._staples)
+        log.info("Index bahan dibangun: %d bahan, %d menu", len(bahan_rows), len(fresh._menu_bahan))
+
+    def _add_bahan(self, id_bahan: int, nama: str) -> None:
+        norm = _normalize_bahan(nama)
+        if not norm: return
+        self._bahan_norm.setdefault(norm, id_bahan)
+        for t in norm.split(): self._bahan_tokens.setdefault(t, set()).add(id_bahan)
+        if norm in PANTRY_STAPLES: self._staples.add(id_bahan)
+
+    def update_menu(self, id_menu: int, bahan: List[Tuple[int, str]]) -> None:
+        with self._lock:
+            for id_bahan, nama in bahan:
+                if _normalize_bahan(nama) not in self._bahan_norm: self._add_bahan(id_bahan, nama)
+            for id_bahan in self._menu_bahan.get(id_menu, ()):
+                arr = self._postings.get(id_bahan)
+                if arr is not None and id_menu in arr: arr.remove(id_menu)
+            new_ids = frozenset(b for b, _ in bahan)
+            for id_bahan in new_ids:
+                bisect.insort(self._postings.setdefault(id_bahan, array("q")), id_menu)
+            self._menu_bahan[id_menu] = new_ids
+
+    def menu_bahan(self, id_menu: int) -> frozenset:
+        self.ensure_fresh()
+        return self._menu_bahan.get(id_menu, frozenset())
+
+    def resolve(self, name: str) -> set:
+        # semua bahan yang memuat semua token (telur -> telur, telur ayam); frasa tanpa
+        # pemisah yang tidak cocok utuh ("telur cabai") dipecah per kata
+        norm = _normalize_bahan(name)
+        if not norm: return set()
+        tokens = norm.split()
+        found = set.intersection(*[self._bahan_tokens.get(t, set()) for t in tokens])
+        if norm in self._bahan_norm: found.add(self._bahan_norm[norm])
+        if not found and len(tokens) > 1:
+            for t in tokens: found |= self._bahan_tokens.get(t, set())
+        return found
+
+    def match(self, names: List[str], max_missing: int = 2, limit: int = 10) -> Tuple[List[IngredientMatch], set]:
+        self.ensure_fresh()
+        with self._lock:
+            have = set()
+            for n in names: have |= self.resolve(n)
+            if not have: return [], have
+            # hanya posting bahan user yang dijelajahi; bumbu dasar ada di hampir semua menu,
+            # jadi dihitung per kandidat lewat irisan set, bukan lewat postingnya
+            counts: Dict[int, int] = {}
+            for id_bahan in have:
+                for mid in self._postings.get(id_bahan, ()):
+                    counts[mid] = counts.get(mid, 0) + 1
+            staples = self._staples - have
+            owned = have | staples
+            results = []
+            for mid, n in counts.items():
+                menu_bahan = self._menu_bahan.get(mid, frozenset())
+                matched = n + len(menu_bahan & staples)
+                if len(menu_bahan) - matched > max_missing: continue
+                results.append(IngredientMatch(mid, matched, len(menu_bahan),
+                                               tuple(sorted(menu_bahan - owned))))
+        results.sort(key=lambda r: (len(r.missing), -r.matched / max(r.total, 1), -r.matched, r.id_menu))
+        return results[:limit], have
+
+INGREDIENT_INDEX = IngredientIndex(INGREDIENT_INDEX_REFRESH_SEC)
+
+# ------- Nama toleran typo (trigram) -------
+def _trigrams(norm: str) -> set:
+    padded = f"  {norm} "
+    return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+class TrigramIndex(RefreshingIndex):
+    """
+    Index trigram in-process atas nama (bahan / menu) setelah folding sinonim.
+    Dipakai untuk lookup persis, "memuat" (pengganti ilike '%x%') dan fuzzy
+    berperingkat (koefisien Dice), semuanya tanpa scan tabel.
+    """
+    def __init__(self, name: str, loader, refresh_sec: int = 0):
+        super().__init__(refresh_sec)
+        self.name = name
+        self._loader = loader                    # () -> List[(id, nama)]
+        self._names: Dict[int, str] = {}
+        self._norm: Dict[int, str] = {}
+        self._by_norm: Dict[str, set] = {}
+        self._grams: Dict[str, set] = {}         # trigram -> {id}
+
+    def build(self) -> None:
+        rows = self._loader()
+        fresh = TrigramIndex(self.name, self._loader)
+        for id_, nama in rows: fresh._add(id_, nama)
+        with self._lock:
+            self._names, self._norm, self._by_norm, self._grams = (
+                fresh._names, fresh._norm, fresh._by_norm, fresh._grams)
+        log.info("Index trigram %s dibangun: %d nama, %d trigram", self.name, len(rows), len(fresh._grams))
+
+    def _add(self, id_: int, nama: str) -> None:
+        norm = _normalize_bahan(nama)
+        if not norm: return
+        self._names[id_] = nama; self._norm[id_] = norm
+        self._by_norm.setdefault(norm, set()).add(id_)
+        for g in _trigrams(norm): self._grams.setdefault(g, set()).add(id_)
+
+    def _remove(self, id_: int) -> None:
+        norm = self._norm.pop(id_, None); self._names.pop(id_, None)
+        if norm is None: return
+        ids = self._by_norm.get(norm)
+        if ids is not None:
+            ids.discard(id_)
+            if not ids: del self._by_norm[norm]
+        for g in _trigrams(norm):
+            ids = self._grams.get(g)
+            if ids is not None:
+                ids.discard(id_)
+                if not ids: del self._grams[g]
+
+    def upsert(self, id_: int, nama: str) -> None:
+        with self._lock:
+            self._remove(id_); self._add(id_, nama)
+
+    def exact(self, nama: str) -> Optional[int]:
+        self.ensure_fresh()
+        ids = self._by_norm.get(_normalize_bahan(nama))
+        return min(ids) if ids else None
+
+    def contains(self, nama: str) -> List[int]:
+        # semua nama yang memuat `nama` (setelah folding), urut alfabet
+        self.ensure_fresh()
+        q = _normalize_bahan(nama)
+        if not q: return []
+        with self._lock:
+            inner = {q[i:i+3] for i in range(len(q) - 2)}
+            if inner:
+                sets = sorted((self._grams.get(g, set()) for g in inner), key=len)
+                cand = set.intersection(*sets) if sets else set()
+            else:
+                cand = self._norm.keys()   # kueri < 3 huruf: cek semua nama di memori
+            ids = [i for i in cand if q in self._norm[i]]
+            return sorted(ids, key=lambda i: self._names[i].lower())
+
+    def fuzzy(self, nama: str, limit: int = 5, min_score: float = 0.5) -> List[Tuple[int, float]]:
+        self.ensure_fresh()
+        q = _normalize_bahan(nama)
+        if not q: return []
+        q_grams = _trigrams(q)
+        with self._lock:
+            common: Dict[int, int] = {}
+            for g in q_grams:
+                for id_ in self._grams.get(g, ()):
+                    common[id_] = common.get(id_, 0) + 1
+            scored = []
+            for id_, c in common.items():
+                score = 2.0 * c / (len(q_grams) + len(_trigrams(self._norm[id_])))
+                if score >= min_score: scored.append((id_, score))
+        scored.sort(key=lambda x: (-x[1], self._names.get(x[0], "").lower()))
+        return scored[:limit]
+
+    def name_of(self, id_: int) -> str:
+        return self._names.get(id_, "")
+
+    def clusters(self, threshold: float = 0.6) -> List[List[int]]:
+        # kelompok nama yang mirip (union-find atas pasangan fuzzy >= threshold)
+        self.ensure_fresh()
+        parent: Dict[int, int] = {}
+        def find(x):
+            while parent.get(x, x) != x:
+                x = parent[x]
+            return x
+        for id_ in list(self._norm):
+            for other, _ in self.fuzzy(self._names[id_], limit=20, min_score=threshold):
+                if other != id_:
+                    a, b = find(id_), find(other)
+                    if a != b: parent[max(a, b)] = min(a, b)
+        groups: Dict[int, List[int]] = {}
+        for id_ in self._norm:
+            groups.setdefault(find(id_), []).append(id_)
+        return sorted((sorted(g) for g in groups.values() if len(g) > 1), key=lambda g: g[0])
+
+def _load_bahan_names() -> List[Tuple[int, str]]:
+    with get_session() as session:
+        return [(r[0], r[1]) for r in session.query(Bahan.id_bahan, Bahan.nama_bahan).all()]
+
+def _load_menu_names() -> List[Tuple[int, str]]:
+    with get_session() as session:
+        return [(r[0], r[1]) for r in session.query(Menu.id_menu, Menu.nama_masakan).all()]
+
+BAHAN_NAMES = TrigramIndex("bahan-trigram", _load_bahan_names, NAME_INDEX_REFRESH_SEC)
+MENU_NAMES = TrigramIndex("menu-trigram", _load_menu_names, NAME_INDEX_REFRESH_SEC)
+
+def find_bahan_by_name(session: Session, nama: str) -> Optional[Bahan]:
+    # index dulu; bila belum ada (proses lain baru menambah) cek unique key nama_bahan, bukan scan
+    id_bahan = BAHAN_NAMES.exact(nama)
+    if id_bahan is not None:
+        b = session.get(Bahan, id_bahan)
+        if b is not None: return b
+    return session.query(Bahan).filter(Bahan.nama_bahan==nama).one_or_none()
+
+def build_ingredient_summary(matches: List[IngredientMatch], details: Dict[int, MenuDetail]) -> str:
+    ready = [m for m in matches if not m.missing and m.id_menu in details]
+    almost = [m for m in matches if m.missing and m.id_menu in details]
+    if not ready and not almost: return ""
+    lines = ["🧺 *Berdasarkan bahan yang kamu punya:*"]
+    if ready:
+        lines.append("✅ Bisa dimasak sekarang:")
+        for m in ready[:5]:
+            lines.append(f"- [{m.id_menu}] {details[m.id_menu].nama_masakan}")
+    if almost:
+        lines.append("🛒 Kurang 1–2 bahan:")
+        for m in almost[:5]:
+            d = details[m.id_menu]
+            names = {b.id_bahan: b.nama_bahan for b in d.bahan}
+            kurang = ", ".join(names.get(b, str(b)) for b in m.missing)
+            lines.append(f"- [{m.id_menu}] {d.nama_masakan} (kurang: {kurang})")
+    lines.append("_(bumbu dasar seperti garam, gula, minyak dianggap sudah ada)_")
+    return "\n".join(lines)
+
+# ------- Hybrid retrieval (BM25 + embedding) -------
+def _bm25_tokens(text: str) -> List[str]:
+    return [w for w in _normalize_bahan(text).split() if len(w) > 1 and w not in MENU_SEARCH_STOPWORDS]
+
+class BM25Index(RefreshingIndex):
+    """
+    Index leksikal BM25 in-process atas dokumen (id, teks) dari `loader`.
+    Yang disimpan hanya posting term -> {id: tf} dan panjang dokumen;
+    teks aslinya tetap di DB.
+    """
+    K1, B = 1.2, 0.75
+
+    def __init__(self, name: str, loader, refresh_sec: int = 0):
+        super().__init__(refresh_sec)
+        self.name = name
+        self._loader = loader                   # () -> iterable (id, teks)
+        self._postings: Dict[str, Dict[int, int]] = {}
+        self._doc_len: Dict[int, int] = {}
+        self._total_len = 0
+
+    def build(self) -> None:
+        fresh = BM25Index(self.name, self._loader)
+        for doc_id, text in self._loader(): fresh._add(doc_id, text)
+        with self._lock:
+            self._postings, self._doc_len, self._total_len = fresh._postings, fresh._doc_len, fresh._total_len
+        log.info("Index BM25 %s dibangun: %d dokumen, %d term", self.name, len(fresh._doc_len), len(fresh._postings))
+
+    def _add(self, doc_id: int, text: str) -> None:
+        tokens = _bm25_tokens(text)
+        if not tokens: return
+        tf: Dict[str, int] = {}
+        for t in tokens: tf[t] = tf.get(t, 0) + 1
+        for t, n in tf.items(): self._postings.setdefault(t, {})[doc_id] = n
+        self._doc_len[doc_id] = len(tokens); self._total_len += len(tokens)
+
+    def _remove(self, doc_id: int) -> None:
+        n = self._doc_len.pop(doc_id, None)
+        if n is None: return
+        self._total_len -= n
+        for t in [t for t, docs in self._postings.items() if doc_id in docs]:
+            del self._postings[t][doc_id]
+            if not self._postings[t]: del self._postings[t]
+
+    def upsert(self, doc_id: int, text: str) -> None:
+        with self._lock:
+            self._remove(doc_id); self._add(doc_id, text)
+
+    def search(self, text: str, k: int = 5) -> List[Tuple[int, float]]:
+        self.ensure_fresh()
+        terms = set(_bm25_tokens(text))
+        with self._lock:
+            n_docs = len(self._doc_len)
+            if not terms or not n_docs: return []
+            avgdl = self._total_len / n_docs
+            scores: Dict[int, float] = {}
+            for t in terms:
+                docs = self._postings.get(t)
+                if not docs: continue
+                idf = math.log(1.0 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+                for doc_id, tf in docs.items():
+                    norm = tf + self.K1 * (1.0 - self.B + self.B * self._doc_len[doc_id] / avgdl)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.K1 + 1.0) / norm
+        return sorted(scores.items(), key=lambda x: (-x[1], x[0]))[:k]
+
+def menu_document_text(nama: str, bahan_names: List[str]) -> str:
+    # nama masakan dihitung dua kali supaya lebih berbobot daripada daftar bahan
+    return f"{nama} {nama} " + " ".join(bahan_names)
+
+def _load_menu_documents():
+    with get_session() as session:
+        bahan: Dict[int, List[str]] = {}
+        for id_menu, nama in (session.query(MenuBahan.id_menu, Bahan.nama_bahan)
+                              .join(Bahan, MenuBahan.id_bahan == Bahan.id_bahan).all()):
+            bahan.setdefault(id_menu, []).append(nama)
+        menus = session.query(Menu.id_menu, Menu.nama_masakan).all()
+    return [(mid, menu_document_text(nama, bahan.get(mid, []))) for mid, nama in menus]
+
+def _load_chunk_documents():
+    with get_session() as session:
+        return [(cid, f"{title or ''} {text}") for cid, title, text in
+                session.query(KnowledgeChunk.id, KnowledgeChunk.title, KnowledgeChunk.chunk_text).yield_per(1000)]
+
+MENU_BM25 = BM25Index("menu-bm25", _load_menu_documents, MENU_INDEX_REFRESH_SEC)
+CHUNK_BM25 = BM25Index("chunk-bm25", _load_chunk_documents, KNOWLEDGE_INDEX_REFRESH_SEC)
+HYBRID_STATS = {"queries": 0, "semantic_used": 0, "skipped_confident": 0, "skipped_budget": 0}
+
+def rrf_fuse(rankings: List[List[int]], k: int = 60) -> List[Tuple[int, float]]:
+    # reciprocal rank fusion: skor = sum 1/(k + rank) atas semua daftar
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda x: -x[1])
+
+def _tight(fused: List[Tuple[int, float]], limit: int) -> List[int]:
+    # potong konteks: hanya dokumen dengan skor fusi >= HYBRID_MIN_REL x skor teratas
+    if not fused: return []
+    floor = fused[0][1] * HYBRID_MIN_REL
+    return [doc_id for doc_id, score in fused[:limit] if score >= floor]
+
+class HybridContext(NamedTuple):
+    menu_ids: List[int]                 # urut skor fusi
+    chunks: List[Tuple[Any, float]]     # (row knowledge_chunks, skor fusi)
+    semantic_used: bool
+
+def hybrid_retrieve(session: Session, text: str, menu_ids: Optional[List[int]] = None,
+                    menu_limit: int = 3, chunk_limit: int = 3, with_chunks: bool = True,
+                    avoid_bahan: Optional[set] = None) -> HybridContext:
+    """
+    Gabungkan leg leksikal (MENU_INDEX, BM25 menu, BM25 chunk) dan leg semantik
+    (embedding knowledge_chunks) dengan RRF. Leg semantik dilewati bila leg
+    leksikal sudah yakin (nama menu cocok) atau anggaran waktu habis.
+    `menu_ids` yang sudah pasti (mis. hasil cocok bahan) dipakai apa adanya;
+    menu yang memuat `avoid_bahan` (pantangan user) disisihkan bila ada alternatif.
+    """
+    t0 = time.perf_counter()
+    HYBRID_STATS["queries"] += 1
+    confident = False
+    if menu_ids is None:
+        by_name = MENU_INDEX.search_scored(text, limit=5)
+        by_bm25 = MENU_BM25.search(text, k=5)
+        confident = bool(by_name) and (by_name[0][1] >= 1000 or
+                                       (by_name[0][1] >= 50 and bool(by_bm25) and by_bm25[0][0] == by_name[0][0]))
+        fused = rrf_fuse([[m for m, _ in by_name], [m for m, _ in by_bm25]], HYBRID_RRF_K)
+        if avoid_bahan:
+            safe = set(without_pantang_conflicts([m for m, _ in fused], avoid_bahan))
+            fused = [(m, sc) for m, sc in fused if m in safe]
+        menu_ids = _tight(fused, menu_limit)
+    else:
+        confident = bool(menu_ids)
+    if not with_chunks or chunk_limit <= 0:
+        return HybridContext(menu_ids, [], False)
+
+    rankings = [[c for c, _ in CHUNK_BM25.search(text, k=chunk_limit * 3)]]
+    semantic_used = False
+    if confident:
+        HYBRID_STATS["skipped_confident"] += 1
+    elif (time.perf_counter() - t0) * 1000 > HYBRID_SEMANTIC_BUDGET_MS:
+        HYBRID_STATS["skipped_budget"] += 1
+    elif np is not None:
+        vec = embed_query(text)
+        if vec:
+            hits = KNOWLEDGE_INDEX.search(vec, k=chunk_limit * 3, min_score=KNOWLEDGE_MIN_SCORE)
+            rankings.append([c for c, _ in hits]); semantic_used = True
+            HYBRID_STATS["semantic_used"] += 1
+    fused = rrf_fuse(rankings, HYBRID_RRF_K)
+    keep = _tight(fused, chunk_limit)
+    score = dict(fused)
+    rows = {c.id: c for c in session.query(KnowledgeChunk.id, KnowledgeChunk.source, KnowledgeChunk.title,
+                                           KnowledgeChunk.page_no, KnowledgeChunk.chunk_text)
+            .filter(KnowledgeChunk.id.in_(keep)).all()} if keep else {}
+    return HybridContext(menu_ids, [(rows[c], score[c]) for c in keep if c in rows], semantic_used)
+
+# user yang sudah pasti ada di DB (per proses); ensure_user untuk mereka tidak menyentuh DB
+KNOWN_USERS: set = set()
+KNOWN_USERS_MAX = 100000
+
+def _remember_user(telegram_user_id: int) -> None:
+    if len(KNOWN_USERS) >= KNOWN_USERS_MAX: KNOWN_USERS.clear()
+    KNOWN_USERS.add(telegram_user_id)
+
+def ensure_user(session: Session, telegram_user_id: int) -> None:
+    if telegram_user_id in KNOWN_USERS: return
+    # sekali per user per proses; insert lewat upsert supaya dua pesan pertama yang bersamaan
+    # tidak bentrok duplicate key
+    if session.get(User, telegram_user_id) is None:
+        upsert_rows(session, User, [{"telegram_user_id": telegram_user_id}])
         log.info("User baru: %s", telegram_user_id)
-    return user
+    run_after_commit(session, lambda: _remember_user(telegram_user_id))
+
+class PantangInfo(NamedTuple):
+    id_bahan: int
+    nama_bahan: str
+    jenis: str
+    note: Optional[str]
+
+class PantangCache:
+    """
+    Pantangan per user (id_bahan -> PantangInfo) untuk user aktif, LRU.
+    Jarang berubah tapi dibaca tiap pesan; /pantang tambah/hapus
+    menginvalidasi entri user itu setelah commit.
+    """
+    def __init__(self, max_users: int, ttl_sec: int):
+        self.max_users = max_users
+        self.ttl_sec = ttl_sec
+        self._mem: "OrderedDict[int, Tuple[float, Dict[int, PantangInfo]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "invalidated": 0}
+
+    def get(self, telegram_user_id: int) -> Optional[Dict[int, PantangInfo]]:
+        with self._lock:
+            entry = self._mem.get(telegram_user_id)
+            if entry is not None and entry[0] > time.time():
+                self._mem.move_to_end(telegram_user_id); self.stats["hits"] += 1
+                return entry[1]
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, telegram_user_id: int, pantang: Dict[int, PantangInfo]) -> None:
+        with self._lock:
+            self._mem[telegram_user_id] = (time.time() + self.ttl_sec, pantang)
+            self._mem.move_to_end(telegram_user_id)
+            while len(self._mem) > self.max_users: self._mem.popitem(last=False)
+
+    def invalidate(self, telegram_user_id: int) -> None:
+        with self._lock:
+            if self._mem.pop(telegram_user_id, None) is not None: self.stats["invalidated"] += 1
 
-def get_user_pantang_map(session: Session, telegram_user_id: int) -> Dict[int, UserBahanPantang]:
-    rows = (session.query(UserBahanPantang)
+PANTANG_CACHE = PantangCache(PANTANG_CACHE_USERS, PANTANG_CACHE_TTL_SEC)
+
+def get_user_pantang_map(session: Session, telegram_user_id: int) -> Dict[int, PantangInfo]:
+    cached = PANTANG_CACHE.get(telegram_user_id)
+    if cached is not None: return cached
+    rows = (session.query(UserBahanPantang.id_bahan, Bahan.nama_bahan, UserBahanPantang.jenis, UserBahanPantang.note)
             .join(Bahan, UserBahanPantang.id_bahan==Bahan.id_bahan)
             .filter(UserBahanPantang.telegram_user_id==telegram_user_id).all())
-    return {p.id_bahan:p for p in rows}
-
-def build_pantang_warning_for_menus(menus: List[Menu], pantang_map: Optional[Dict[int,UserBahanPantang]])->str:
+    pantang = {r[0]: PantangInfo(*r) for r in rows}
+    PANTANG_CACHE.put(telegram_user_id, pantang)
+    return pantang
+
+def menu_conflicts(id_menu: int, pantang_ids) -> set:
+    # bahan pantangan yang ada di menu: irisan set dari INGREDIENT_INDEX, tanpa DB
+    if not pantang_ids: return set()
+    return INGREDIENT_INDEX.menu_bahan(id_menu) & set(pantang_ids)
+
+def without_pantang_conflicts(menu_ids: List[int], pantang_ids) -> List[int]:
+    # buang menu yang bentrok dengan pantangan; bila semua bentrok, biarkan (peringatan tetap tampil)
+    if not pantang_ids or not menu_ids: return menu_ids
+    safe = [i for i in menu_ids if not menu_conflicts(i, pantang_ids)]
+    return safe or menu_ids
+
+def build_pantang_warning_for_menus(menus: List[MenuDetail], pantang_map: Optional[Dict[int,PantangInfo]])->str:
     if not pantang_map or not menus: return ""
     lines=[]
     for menu in menus:
@@ -322,71 +2419,202 @@ def build_pantang_warning_for_menus(menus: List[Menu], pantang_map: Optional[Dic
         for mb in menu.bahan:
             p = pantang_map.get(mb.id_bahan)
             if p and mb.id_bahan not in seen:
-                seen.add(mb.id_bahan); matched.append(p)
+                seen.add(mb.id_bahan); matched.append((mb.nama_bahan, p))
         if matched:
             lines.append(f"⚠️ *Pantangan/alergi untuk {menu.nama_masakan}* (ID {menu.id_menu}):")
-            for p in matched:
+            for nama_bahan, p in matched:
                 note=f", catatan: {p.note}" if p.note else ""
-                lines.append(f"- {p.bahan.nama_bahan} ({p.jenis}{note})")
+                lines.append(f"- {nama_bahan} ({p.jenis}{note})")
             lines.append("")
     if not lines: return ""
     lines.append("⚠️ *Catatan:* pilih resep lain atau ganti bahan yang menjadi pantangan/alergi.")
     return "\n".join(lines)
 
-def build_history_text(session: Session, telegram_user_id: int, limit:int=5)->str:
-    rows=(session.query(UserMenuRiwayat)
-          .join(Menu, UserMenuRiwayat.id_menu==Menu.id_menu)
-          .filter(UserMenuRiwayat.telegram_user_id==telegram_user_id)
-          .order_by(UserMenuRiwayat.waktu.desc()).limit(limit).all())
+def build_history_page(session: Session, telegram_user_id: int, limit:int=5,
+                       before_id: Optional[int]=None) -> Tuple[str, List[List[Dict[str,str]]]]:
+    # satu query (riwayat ⟕ menu ⟕ rating), keyset pada id_riwayat (urut waktu simpan);
+    # memakai index (telegram_user_id, id_riwayat) jadi halaman lama sama murahnya dengan halaman pertama
+    if WRITE_BEHIND.has_pending(telegram_user_id): WRITE_BEHIND.flush(session)
+    q=(session.query(UserMenuRiwayat.id_riwayat, UserMenuRiwayat.waktu, Menu.id_menu, Menu.nama_masakan,
+                     UserMenuRating.rating_menu)
+       .join(Menu, UserMenuRiwayat.id_menu==Menu.id_menu)
+       .outerjoin(UserMenuRating, (UserMenuRating.telegram_user_id==UserMenuRiwayat.telegram_user_id)
+                                  & (UserMenuRating.id_menu==UserMenuRiwayat.id_menu))
+       .filter(UserMenuRiwayat.telegram_user_id==telegram_user_id))
+    if before_id is not None:
+        q=q.filter(UserMenuRiwayat.id_riwayat < before_id)
+    rows=q.order_by(UserMenuRiwayat.id_riwayat.desc()).limit(limit+1).all()
     if not rows:
+        if before_id is not None:
+            return "Tidak ada riwayat yang lebih lama.", []
         return ("Belum ada riwayat masakan yang pernah kamu lihat.\n"
-                "Coba kirim nama masakan atau bahan dulu ya 😊")
-    lines=["*Riwayat masakan terakhir kamu:*"]
+                "Coba kirim nama masakan atau bahan dulu ya 😊"), []
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    lines=["*Riwayat masakan terakhir kamu:*" if before_id is None else "*Riwayat masakan (lanjutan):*"]
     for r in rows:
-        rating=(session.query(UserMenuRating)
-                .filter(UserMenuRating.telegram_user_id==telegram_user_id,
-                        UserMenuRating.id_menu==r.id_menu).one_or_none())
-        rating_str=f"{rating.rating_menu}/5" if rating else "-"
-        lines.append(f"- [{r.menu.id_menu}] {r.menu.nama_masakan} (⭐ {rating_str}, {r.waktu.strftime('%d-%m-%Y %H:%M')})")
+        rating_str=f"{r.rating_menu}/5" if r.rating_menu is not None else "-"
+        lines.append(f"- [{r.id_menu}] {r.nama_masakan} (⭐ {rating_str}, {r.waktu.strftime('%d-%m-%Y %H:%M')})")
     lines.append("\nUntuk memberi rating manual:\n`/rating <id_menu> <1-5> [review]`")
-    return "\n".join(lines)
+    kb = [[{"text":f"➡️ {limit} berikutnya","callback_data":f"history:{rows[-1].id_riwayat}"}]] if has_more else []
+    return "\n".join(lines), kb
 
-def build_menu_list_text(session: Session, limit:int=50)->str:
-    menus=(session.query(Menu).order_by(Menu.id_menu.asc()).limit(limit+1).all())
-    lines=[]
-    if menus:
-        lines.append("*Daftar menu di database ChefBot (urut ID):*")
-        for m in menus[:limit]:
-            src = f", sumber: {m.source_url}" if m.source_url else ""
-            lines.append(f"- ID {m.id_menu}: {m.nama_masakan} (kesulitan: {m.tingkat_kesulitan}{src})")
-        if len(menus)>limit: lines.append(f"... dan {len(menus)-limit} menu lainnya.")
-        lines.append("")
-    if not lines:
-        lines.append("Belum ada data menu tersimpan di ChefBot.")
-    return "\n".join(lines)
+class ScreenCache:
+    """
+    Cache layar bot yang sudah dirender (teks + keyboard), mis. tiap halaman
+    daftar menu. Entri ditandai versi data; penulisan menu menaikkan versi
+    (bump) sehingga semua halaman lama otomatis basi tanpa perlu dicari satu
+    per satu. TTL menjaga worker lain yang tidak melihat bump.
+    """
+    def __init__(self, max_items: int, ttl_sec: int):
+        self.max_items = max_items
+        self.ttl_sec = ttl_sec
+        self.version = 0
+        self._mem: "OrderedDict[str, Tuple[int, float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "invalidated": 0}
+
+    def render(self, key: str, builder) -> Any:
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry is not None and entry[0] == self.version and entry[1] > time.time():
+                self._mem.move_to_end(key); self.stats["hits"] += 1
+                return entry[2]
+            self.stats["misses"] += 1
+            version = self.version
+        value = builder()
+        with self._lock:
+            self._mem[key] = (version, time.time() + self.ttl_sec, value); self._mem.move_to_end(key)
+            while len(self._mem) > self.max_items: self._mem.popitem(last=False)
+        return value
+
+    def bump(self) -> None:
+        with self._lock:
+            self.version += 1; self.stats["invalidated"] += len(self._mem)
+            self._mem.clear()
+
+SCREEN_CACHE = ScreenCache(SCREEN_CACHE_MAX, SCREEN_CACHE_TTL_SEC)
+
+def build_menu_list_page(session: Session, after_id: int = 0,
+                         limit: int = MENU_LIST_PAGE) -> Tuple[str, List[List[Dict[str,str]]]]:
+    # keyset: id_menu > after_id, tanpa OFFSET
+    rows=(session.query(Menu.id_menu, Menu.nama_masakan, Menu.tingkat_kesulitan, Menu.source_url)
+          .filter(Menu.id_menu > after_id).order_by(Menu.id_menu.asc()).limit(limit+1).all())
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    kb = [[{"text":"➕ Tambah menu (Gemini)","callback_data":"menu_add"}],
+          [{"text":"➕ Tambah dari link","callback_data":"menu_add_link"}]]
+    if not rows:
+        return ("Belum ada data menu tersimpan di ChefBot." if not after_id else "Tidak ada menu lagi."), kb
+    lines=["*Daftar menu di database ChefBot (urut ID):*" if not after_id else
+           f"*Daftar menu (lanjutan, setelah ID {after_id}):*"]
+    for r in rows:
+        src = f", sumber: {r.source_url}" if r.source_url else ""
+        lines.append(f"- ID {r.id_menu}: {r.nama_masakan} (kesulitan: {r.tingkat_kesulitan}{src})")
+    if has_more:
+        kb.insert(0, [{"text":f"➡️ {limit} menu berikutnya","callback_data":f"menu_list:{rows[-1].id_menu}"}])
+    return "\n".join(lines), kb
 
-# ------- Rekomendasi -------
-RECOM_INTENT_PATTERNS = [
-    r"\bbingung\b.*\bmasak\b",
-    r"\bkasih(kan)?\s*ide\b",
-    r"\brekom(endasi)?\b",
-    r"\bmasak apa\b",
-]
+def menu_list_screen(after_id: int = 0) -> Tuple[str, List[List[Dict[str,str]]]]:
+    # halaman populer dilayani dari cache; DB hanya disentuh saat cache kosong/basi
+    def build():
+        with get_session() as session:
+            return build_menu_list_page(session, after_id)
+    return SCREEN_CACHE.render(f"menu_list:{after_id}", build)
 
-def is_recommendation_intent(text: str) -> bool:
-    t=(text or "").lower()
-    return any(re.search(p, t) for p in RECOM_INTENT_PATTERNS)
-
-def get_recommendation_list(session: Session, limit:int=5) -> List[Menu]:
-    # ambil menu acak; kalau DB besar bisa ganti ke rating terbanyak
-    count = session.query(func.count(Menu.id_menu)).scalar() or 0
-    if count==0: return []
-    # ambil id range, lalu sample random
-    ids = [m.id_menu for m in session.query(Menu.id_menu).all()]
-    random.shuffle(ids); ids = ids[:min(limit*2, len(ids))]
-    menus = (session.query(Menu).filter(Menu.id_menu.in_(ids)).all())
-    random.shuffle(menus)
-    return menus[:limit]
+# ------- Rekomendasi -------
+class RecommendationEngine(RefreshingIndex):
+    """
+    Tabel skor menu in-process: rata-rata rating bayesian
+    (prior * rata2_global + jumlah) / (prior + n) sebagai bobot sampling,
+    disimpan sebagai alias table (Vose) sehingga tiap sampel O(1) dan satu
+    rekomendasi O(limit), tidak bergantung ukuran katalog.
+    """
+    name = "recommendation"
+
+    def __init__(self, refresh_sec: int = 0):
+        super().__init__(refresh_sec)
+        # (ids, prob, alias) diganti utuh dengan satu assignment; pembaca mengambilnya sekali
+        # tanpa lock, jadi tidak pernah melihat ids baru dengan prob/alias lama
+        self._table: Tuple[List[int], List[float], List[int]] = ([], [], [])
+
+    def build(self) -> None:
+        with get_session() as session:
+            ids = [r[0] for r in session.query(Menu.id_menu).all()]
+            agg = (session.query(UserMenuRating.id_menu, func.sum(UserMenuRating.rating_menu),
+                                 func.count(UserMenuRating.rating_menu))
+                   .group_by(UserMenuRating.id_menu).all())
+        total = sum(float(r[1] or 0) for r in agg); n_all = sum(int(r[2] or 0) for r in agg)
+        mean = total / n_all if n_all else 3.0
+        stats = {r[0]: (float(r[1] or 0), int(r[2] or 0)) for r in agg}
+        weights = []
+        for mid in ids:
+            rsum, rn = stats.get(mid, (0.0, 0))
+            score = (RECOM_PRIOR_WEIGHT * mean + rsum) / (RECOM_PRIOR_WEIGHT + rn)
+            weights.append(score * score)
+        self.set_table(ids, weights)
+        log.info("Tabel rekomendasi dibangun: %d menu, %d menu ber-rating", len(ids), len(stats))
+
+    def set_table(self, ids: List[int], weights: List[float]) -> None:
+        n = len(ids)
+        total = sum(weights) or 1.0
+        prob = [w * n / total for w in weights]
+        alias = [0] * n
+        small = [i for i, p in enumerate(prob) if p < 1.0]
+        large = [i for i, p in enumerate(prob) if p >= 1.0]
+        while small and large:
+            lo, hi = small.pop(), large.pop()
+            alias[lo] = hi
+            prob[hi] = prob[hi] + prob[lo] - 1.0
+            (small if prob[hi] < 1.0 else large).append(hi)
+        for i in small + large: prob[i] = 1.0
+        self._table = (list(ids), prob, alias)
+
+    def sample(self, limit: int, exclude: Optional[set] = None, max_tries: int = 0) -> List[int]:
+        self.ensure_fresh()
+        ids, prob, alias = self._table
+        n = len(ids)
+        if n == 0 or limit <= 0: return []
+        exclude = exclude or set()
+        picked: List[int] = []; seen = set()
+        for _ in range(max_tries or limit * 20):
+            i = random.randrange(n)
+            if random.random() >= prob[i]: i = alias[i]
+            mid = ids[i]
+            if mid in seen or mid in exclude: continue
+            seen.add(mid); picked.append(mid)
+            if len(picked) >= limit: break
+        return picked
+
+RECOMMENDER = RecommendationEngine(RECOM_REFRESH_SEC)
+
+def get_recommendation_list(session: Session, limit:int=5, telegram_user_id: Optional[int]=None) -> List[Menu]:
+    # sampling berbobot rating; lewati menu yang baru dilihat user dan yang memuat bahan pantangannya
+    recent: set = set()
+    pantang_ids: set = set()
+    if telegram_user_id is not None:
+        if RECOM_SKIP_RECENT > 0:
+            recent = {r[0] for r in session.query(UserMenuRiwayat.id_menu)
+                      .filter(UserMenuRiwayat.telegram_user_id==telegram_user_id)
+                      .order_by(UserMenuRiwayat.id_riwayat.desc()).limit(RECOM_SKIP_RECENT).all()}
+            recent |= WRITE_BEHIND.pending_menus(telegram_user_id)
+        pantang_ids = set(get_user_pantang_map(session, telegram_user_id))
+    ids: List[int] = []
+    rejected = set(recent)
+    for round_no in range(3):
+        if round_no == 2:
+            rejected -= recent   # katalog kecil / semua sudah dilihat: boleh ulangi menu terakhir
+        cand = RECOMMENDER.sample(limit * 2, exclude=rejected | set(ids))
+        if not cand: continue
+        if pantang_ids:
+            conflict = {i for i in cand if menu_conflicts(i, pantang_ids)}
+            rejected |= conflict
+            cand = [i for i in cand if i not in conflict]
+        ids += cand[:limit - len(ids)]
+        if len(ids) >= limit: break
+    if not ids: return []
+    rows = {m.id_menu: m for m in session.query(Menu).filter(Menu.id_menu.in_(ids)).all()}
+    return [rows[i] for i in ids if i in rows]
 
 def build_recommendation_message(menus: List[Menu]) -> Tuple[str, List[List[Dict[str,str]]]]:
     if not menus:
@@ -398,20 +2626,61 @@ def build_recommendation_message(menus: List[Menu]) -> Tuple[str, List[List[Dict
         [{"text":"📋 Daftar menu","callback_data":"menu_list"}]]
     return "\n".join(lines), kb
 
-# ------- Smalltalk -------
+# ------- Intent (rekomendasi + smalltalk) -------
+RECOM_INTENT_PATTERNS = [
+    r"\bbingung\b.*\bmasak\b",
+    r"\bkasih(kan)?\s*(ide|saran)\b",
+    r"\brekom(endasi|en|in|enin|endasiin)?\b",
+    r"\bmasak apa\b",
+    r"\benaknya masak\b",
+    r"\bide (masak(an)?|menu)\b",
+    r"\bsaran (menu|masakan)\b",
+]
+
 SMALLTALK_PATTERNS = {
-    "halo": [r"\bhalo+\b", r"\bhai+\b", r"\bhallo+\b", r"\bselamat\s*(pagi|siang|sore|malam)\b"],
-    "bye":  [r"\bbye+\b", r"\bdada(h)?\b", r"\bsampai jumpa\b", r"\bsee you\b"],
-    "thanks":[r"\bterima kasih\b", r"\bmakasih\b", r"\bthank(s| you)\b"],
+    "halo": [r"\bhalo+\b", r"\bhai+\b", r"\bhallo+\b", r"\bhel+o\b", r"\bhi\b", r"\bhey\b",
+             r"\b(selamat|met)\s*(pagi|siang|sore|malam)\b", r"\bpagi (min|kak|bot)\b"],
+    "bye":  [r"\bbye+\b", r"\bdada(h)?\b", r"\bbabay\b", r"\bsampai jumpa\b", r"\bsee you\b", r"\bcu\b"],
+    "thanks":[r"\bterima ?kasih\b", r"\bmakasih?\b", r"\bmksh\b", r"\bthank(s| you)\b", r"\bthx\b",
+              r"\btq\b", r"\btengkyu\b", r"\btrims\b", r"\bsuwun\b", r"\bnuhun\b"],
 }
 
+# urutan = prioritas: rekomendasi menang atas sapaan ("halo, rekomendasi dong")
+INTENT_PATTERNS: List[Tuple[str, List[str]]] = [("rekomendasi", RECOM_INTENT_PATTERNS)] + list(SMALLTALK_PATTERNS.items())
+INTENT_REPEAT_RE = re.compile(r"([a-z])\1{2,}")
+
+class IntentRouter:
+    """
+    Semua pola intent dikompilasi sekali jadi satu regex: per label satu
+    lookahead opsional dengan named group, sehingga satu kali match
+    memberi tahu label mana saja yang cocok. Lookahead tidak memakan teks,
+    jadi pola label lain tidak bisa "menelan" kata yang dibutuhkan label
+    berprioritas lebih tinggi; hasilnya sama dengan cek berurutan per label.
+    Tambah intent/slang cukup dengan menambah pola di INTENT_PATTERNS.
+    """
+    def __init__(self, intents: List[Tuple[str, List[str]]]):
+        self.labels = [label for label, _ in intents]
+        self.regex = re.compile("".join(f"(?:(?=(?s:.*?)(?P<{label}>{'|'.join(pats)}))|)"
+                                        for label, pats in intents))
+
+    def classify(self, text: str) -> Optional[str]:
+        t = INTENT_REPEAT_RE.sub(r"\1", (text or "").lower())   # "makasiiih" -> "makasih"
+        m = self.regex.match(t)
+        return next((label for label in self.labels if m.group(label) is not None), None)
+
+INTENT_ROUTER = IntentRouter(INTENT_PATTERNS)
+
+def classify_intent(text: str) -> Optional[str]:
+    return INTENT_ROUTER.classify(text)
+
+def is_recommendation_intent(text: str) -> bool:
+    return classify_intent(text) == "rekomendasi"
+
 def is_smalltalk(text:str) -> Optional[str]:
-    t=(text or "").lower()
-    for label, pats in SMALLTALK_PATTERNS.items():
-        if any(re.search(p, t) for p in pats):
-            return label
-    return None
+    label = classify_intent(text)
+    return label if label in SMALLTALK_PATTERNS else None
 
+@lru_cache(maxsize=None)
 def smalltalk_reply(label:str) -> Tuple[str, List[List[Dict[str,str]]]]:
     if label=="halo":
         text=("Halo! 👋 Aku *ChefBot*.\n"
@@ -443,7 +2712,12 @@ def save_generated_menu_to_db(session: Session, recipe: dict, source_url: Option
         if not nama_masakan: return None, "Nama masakan kosong di JSON resep."
         if tingkat not in ("easy","medium","hard"): tingkat="easy"
 
-        existing = (session.query(Menu).filter(Menu.nama_masakan.ilike(nama_masakan)).one_or_none())
+        existing = None
+        menu_id_known = MENU_NAMES.exact(nama_masakan)
+        if menu_id_known is not None:
+            existing = session.get(Menu, menu_id_known)
+        if existing is None:
+            existing = session.query(Menu).filter(Menu.nama_masakan==nama_masakan).one_or_none()
         if existing:
             menu_obj = existing
             menu_obj.tingkat_kesulitan = tingkat
@@ -458,44 +2732,249 @@ def save_generated_menu_to_db(session: Session, recipe: dict, source_url: Option
             session.query(MenuBahan).filter(MenuBahan.id_menu==menu_obj.id_menu).delete()
             session.query(MenuLangkah).filter(MenuLangkah.id_menu==menu_obj.id_menu).delete()
 
+        menu_bahan_pairs: List[Tuple[int, str]] = []
+        created_now: Dict[str, Bahan] = {}
+        near: List[str] = []
         for b in bahan_list:
             nama = (b.get("nama") or "").strip()
             satuan = (b.get("satuan") or "").strip() or "unit"
             jumlah = b.get("jumlah") or 0
             if not nama: continue
-            bahan_obj = (session.query(Bahan).filter(Bahan.nama_bahan.ilike(nama)).one_or_none())
+            # hanya nama yang sama setelah normalisasi + sinonim yang dipakai ulang; yang sekadar mirip
+            # ("bawang merah goreng" vs "bawang merah") bisa bahan lain, jadi cuma dilaporkan
+            bahan_obj = created_now.get(_normalize_bahan(nama)) or find_bahan_by_name(session, nama)
             if not bahan_obj:
+                close = BAHAN_NAMES.fuzzy(nama, limit=1, min_score=FUZZY_BAHAN_REPORT_SCORE)
+                if close: near.append(f"{nama} ~ {BAHAN_NAMES.name_of(close[0][0])}")
                 bahan_obj = Bahan(nama_bahan=nama, satuan_bahan=satuan)
                 session.add(bahan_obj); session.flush()
+                created_now[_normalize_bahan(nama)] = bahan_obj
             session.add(MenuBahan(id_menu=menu_obj.id_menu, id_bahan=bahan_obj.id_bahan,
                                   banyak_bahan=jumlah, catatan=None))
+            menu_bahan_pairs.append((bahan_obj.id_bahan, bahan_obj.nama_bahan))
         for i, step in enumerate(langkah_list, start=1):
             step_text = str(step).strip()
             if step_text:
                 session.add(MenuLangkah(id_menu=menu_obj.id_menu, langkah_no=i, deskripsi=step_text))
+        new_bahan = [(b.id_bahan, b.nama_bahan) for b in created_now.values()]
+        def _index_new_bahan():
+            for id_bahan, nama in new_bahan: BAHAN_NAMES.upsert(id_bahan, nama)
+        run_after_commit(session, _index_new_bahan)
+        menu_id, menu_nama = menu_obj.id_menu, menu_obj.nama_masakan
+        run_after_commit(session, lambda: MENU_INDEX.upsert(menu_id, menu_nama))
+        run_after_commit(session, lambda: MENU_NAMES.upsert(menu_id, menu_nama))
+        run_after_commit(session, lambda: RESPONSE_CACHE.invalidate_menu(menu_id))
+        run_after_commit(session, SCREEN_CACHE.bump)
+        run_after_commit(session, lambda: INGREDIENT_INDEX.update_menu(menu_id, menu_bahan_pairs))
+        run_after_commit(session, lambda: MENU_BM25.upsert(
+            menu_id, menu_document_text(menu_nama, [n for _, n in menu_bahan_pairs])))
+        if near:
+            log.info("Bahan baru mirip bahan lama (tidak digabung): %s", "; ".join(near))
+            msg_prefix += f" Bahan baru yang mirip bahan lama (cek report-duplicates): {'; '.join(near)}."
         return menu_obj, f"{msg_prefix} (ID {menu_obj.id_menu})"
     except Exception as e:
         log.exception("Simpan menu error: %s", e)
         return None, "Kesalahan saat menyimpan menu ke database."
 
+# ---------- Impor resep massal ----------
+class IngestResult(NamedTuple):
+    index: int                 # posisi resep di input (mulai 0)
+    nama_masakan: str
+    id_menu: Optional[int]
+    ok: bool
+    message: str
+
+def _clean_recipe(recipe: Any, default_source: Optional[str]) -> Tuple[Optional[dict], str]:
+    # validasi + normalisasi satu resep (skema sama dengan keluaran /addmenu)
+    if not isinstance(recipe, dict): return None, "Bukan objek JSON resep."
+    if "_error" in recipe: return None, recipe["_error"]
+    nama_masakan = str(recipe.get("nama_masakan") or "").strip()
+    if not nama_masakan: return None, "Nama masakan kosong di JSON resep."
+    if len(nama_masakan) > 200: return None, "Nama masakan terlalu panjang (maks 200)."
+    tingkat = str(recipe.get("tingkat_kesulitan") or "easy").strip().lower()
+    if tingkat not in ("easy","medium","hard"): tingkat = "easy"
+    bahan: Dict[str, Tuple[str, str, float]] = {}     # nama ternormalisasi -> (nama, satuan, jumlah)
+    for b in recipe.get("bahan") or []:
+        if not isinstance(b, dict): continue
+        nama = str(b.get("nama") or "").strip()[:120]
+        if not nama: continue
+        try: jumlah = float(b.get("jumlah") or 0)
+        except (TypeError, ValueError): jumlah = 0.0
+        satuan = str(b.get("satuan") or "").strip()[:30] or "unit"
+        bahan.setdefault(_normalize_bahan(nama), (nama, satuan, jumlah))   # bahan dobel: pakai yang pertama
+    langkah = [str(x).strip() for x in recipe.get("langkah") or [] if str(x).strip()]
+    return {"nama_masakan": nama_masakan, "tingkat_kesulitan": tingkat,
+            "source_url": (recipe.get("source_url") or default_source),
+            "bahan": bahan, "langkah": langkah}, ""
+
+def _ingest_batch(session: Session, batch: List[Tuple[int, dict]]) -> List[IngestResult]:
+    """
+    Simpan satu batch resep yang sudah dibersihkan dengan query berjumlah tetap
+    (bukan per bahan): lookup menu & bahan sekali, insert multi-row, executemany
+    untuk menu_bahan/menu_langkah.
+    """
+    # --- menu: yang sudah ada diperbarui, sisanya insert sekaligus ---
+    names = [r["nama_masakan"] for _, r in batch]
+    known_ids = {i for i in (MENU_NAMES.exact(n) for n in names) if i is not None}
+    menu_rows = (session.query(Menu.id_menu, Menu.nama_masakan)
+                 .filter(or_(Menu.nama_masakan.in_(names), Menu.id_menu.in_(known_ids))).all())
+    menu_by_key = {_normalize_bahan(nama): id_ for id_, nama in menu_rows}
+    existing_ids = set(menu_by_key.values())
+
+    new_menus = [r for _, r in batch if _normalize_bahan(r["nama_masakan"]) not in menu_by_key]
+    if new_menus:
+        session.execute(insert(Menu), [{"nama_masakan": r["nama_masakan"], "tingkat_kesulitan": r["tingkat_kesulitan"],
+                                        "source_url": r["source_url"]} for r in new_menus])
+        for id_, nama in (session.query(Menu.id_menu, Menu.nama_masakan)
+                          .filter(Menu.nama_masakan.in_([r["nama_masakan"] for r in new_menus])).all()):
+            menu_by_key[_normalize_bahan(nama)] = id_
+    updates = []
+    for _, r in batch:
+        id_menu = menu_by_key[_normalize_bahan(r["nama_masakan"])]
+        r["id_menu"] = id_menu
+        if id_menu in existing_ids:
+            row = {"id_menu": id_menu, "tingkat_kesulitan": r["tingkat_kesulitan"]}
+            if r["source_url"]: row["source_url"] = r["source_url"]
+            updates.append(row)
+    if updates:
+        session.execute(update(Menu), updates)
+        session.execute(delete(MenuBahan).where(MenuBahan.id_menu.in_(existing_ids)))
+        session.execute(delete(MenuLangkah).where(MenuLangkah.id_menu.in_(existing_ids)))
+
+    # --- bahan: index dulu, lalu satu query IN, sisanya insert multi-row (yang mirip bahan lama dilaporkan) ---
+    wanted: Dict[str, Tuple[str, str]] = {}
+    for _, r in batch:
+        for key, (nama, satuan, _j) in r["bahan"].items():
+            wanted.setdefault(key, (nama, satuan))
+    bahan_by_key: Dict[str, int] = {}
+    for key, (nama, _s) in wanted.items():
+        id_bahan = BAHAN_NAMES.exact(nama)
+        if id_bahan is not None: bahan_by_key[key] = id_bahan
+    rest = [nama for key, (nama, _s) in wanted.items() if key not in bahan_by_key]
+    if rest:
+        for id_, nama in session.query(Bahan.id_bahan, Bahan.nama_bahan).filter(Bahan.nama_bahan.in_(rest)).all():
+            bahan_by_key.setdefault(_normalize_bahan(nama), id_)
+    missing, near = [], {}
+    for key, (nama, satuan) in wanted.items():
+        if key in bahan_by_key: continue
+        close = BAHAN_NAMES.fuzzy(nama, limit=1, min_score=FUZZY_BAHAN_REPORT_SCORE)
+        if close: near[key] = f"{nama} ~ {BAHAN_NAMES.name_of(close[0][0])}"
+        missing.append({"nama_bahan": nama, "satuan_bahan": satuan})
+    created_bahan: List[Tuple[int, str]] = []
+    if missing:
+        session.execute(insert(Bahan), missing)
+        for id_, nama in (session.query(Bahan.id_bahan, Bahan.nama_bahan)
+                          .filter(Bahan.nama_bahan.in_([m["nama_bahan"] for m in missing])).all()):
+            bahan_by_key[_normalize_bahan(nama)] = id_
+            created_bahan.append((id_, nama))
+    bahan_nama = {v: wanted[k][0] for k, v in bahan_by_key.items()}
+    bahan_nama.update(dict(created_bahan))
+
+    # --- komponen menu (executemany) ---
+    mb_rows, ml_rows, menu_bahan_pairs = [], [], {}
+    for _, r in batch:
+        seen, pairs = set(), []
+        for key, (_n, _s, jumlah) in r["bahan"].items():
+            id_bahan = bahan_by_key[key]
+            if id_bahan in seen: continue   # dua nama berbeda yang jatuh ke bahan yang sama
+            seen.add(id_bahan)
+            mb_rows.append({"id_menu": r["id_menu"], "id_bahan": id_bahan, "banyak_bahan": jumlah, "catatan": None})
+            pairs.append((id_bahan, bahan_nama.get(id_bahan, "")))
+        menu_bahan_pairs[r["id_menu"]] = pairs
+        ml_rows.extend({"id_menu": r["id_menu"], "langkah_no": i, "deskripsi": step}
+                       for i, step in enumerate(r["langkah"], start=1))
+    if mb_rows: session.execute(insert(MenuBahan), mb_rows)
+    if ml_rows: session.execute(insert(MenuLangkah), ml_rows)
+
+    menus = [(r["id_menu"], r["nama_masakan"]) for _, r in batch]
+    def _refresh_indexes():
+        for id_bahan, nama in created_bahan: BAHAN_NAMES.upsert(id_bahan, nama)
+        for id_menu, nama in menus:
+            MENU_INDEX.upsert(id_menu, nama); MENU_NAMES.upsert(id_menu, nama)
+            RESPONSE_CACHE.invalidate_menu(id_menu)
+            INGREDIENT_INDEX.update_menu(id_menu, menu_bahan_pairs[id_menu])
+            MENU_BM25.upsert(id_menu, menu_document_text(nama, [n for _, n in menu_bahan_pairs[id_menu]]))
+        SCREEN_CACHE.bump()
+    run_after_commit(session, _refresh_indexes)
+    results = []
+    for idx, r in batch:
+        msg = "Menu sudah ada, komponen diperbarui." if r["id_menu"] in existing_ids else "Menu baru ditambahkan."
+        similar = [near[k] for k in r["bahan"] if k in near]
+        if similar: msg += f" Bahan baru yang mirip bahan lama (cek report-duplicates): {'; '.join(similar)}."
+        results.append(IngestResult(idx, r["nama_masakan"], r["id_menu"], True, msg))
+    return results
+
+def ingest_recipes(recipes, batch_size: int = 200, source_url: Optional[str] = None):
+    """
+    Impor massal resep (iterable dict, skema /addmenu). Tiap `batch_size` resep
+    di-commit sebagai satu transaksi; hasil per resep di-yield sebagai IngestResult.
+    Bila satu batch gagal di DB, batch itu diulang per resep supaya resep yang
+    bermasalah bisa dilaporkan tanpa menggagalkan yang lain.
+    """
+    def flush(batch: List[Tuple[int, dict]]):
+        try:
+            with get_session() as session:
+                return _ingest_batch(session, batch)
+        except Exception as e:
+            log.warning("Batch impor gagal (%s), diulang per resep", e)
+        out = []
+        for idx, r in batch:
+            raw = {"nama_masakan": r["nama_masakan"], "tingkat_kesulitan": r["tingkat_kesulitan"],
+                   "bahan": [{"nama": n, "satuan": s, "jumlah": j} for n, s, j in r["bahan"].values()],
+                   "langkah": r["langkah"]}
+            try:
+                with get_session() as session:
+                    menu_obj, msg = save_generated_menu_to_db(session, raw, source_url=r["source_url"])
+                    if menu_obj is None: session.rollback()
+                    out.append(IngestResult(idx, r["nama_masakan"], menu_obj.id_menu if menu_obj else None,
+                                            menu_obj is not None, msg))
+            except Exception as e:
+                out.append(IngestResult(idx, r["nama_masakan"], None, False, f"Gagal disimpan: {e}"))
+        return out
+
+    batch: List[Tuple[int, dict]] = []
+    batch_keys: Dict[str, int] = {}
+    for idx, recipe in enumerate(recipes):
+        cleaned, err = _clean_recipe(recipe, source_url)
+        if cleaned is None:
+            nama = str(recipe.get("nama_masakan") or "") if isinstance(recipe, dict) else ""
+            yield IngestResult(idx, nama, None, False, err)
+            continue
+        key = _normalize_bahan(cleaned["nama_masakan"])
+        if key in batch_keys:
+            # nama sama muncul lagi di batch yang sama: selesaikan batch dulu supaya yang terakhir menang
+            yield from flush(batch); batch, batch_keys = [], {}
+        batch_keys[key] = idx
+        batch.append((idx, cleaned))
+        if len(batch) >= batch_size:
+            yield from flush(batch); batch, batch_keys = [], {}
+    if batch:
+        yield from flush(batch)
+
 # ---------- /pantang (perbaikan) ----------
+def find_bahan_candidates(session: Session, nama_bahan_in: str) -> List[Bahan]:
+    # semua bahan yang memuat nama (setelah folding sinonim); bila kosong, kandidat fuzzy terbaik (typo)
+    ids = BAHAN_NAMES.contains(nama_bahan_in)
+    if not ids:
+        ids = [i for i, _ in BAHAN_NAMES.fuzzy(nama_bahan_in, limit=1, min_score=FUZZY_BAHAN_MIN_SCORE)]
+    if not ids: return []
+    rows = {b.id_bahan: b for b in session.query(Bahan).filter(Bahan.id_bahan.in_(ids)).all()}
+    return [rows[i] for i in ids if i in rows]
+
 def handle_pantang_command(session: Session, telegram_user_id:int, text:str) -> str:
     parts = text.strip().split(maxsplit=2)
     subcmd = parts[1].lower() if len(parts)>1 else "list"
-    user = ensure_user(session, telegram_user_id)
+    ensure_user(session, telegram_user_id)
 
     if subcmd in ("list",):
-        items=(session.query(UserBahanPantang)
-               .join(Bahan, UserBahanPantang.id_bahan==Bahan.id_bahan)
-               .filter(UserBahanPantang.telegram_user_id==user.telegram_user_id)
-               .order_by(Bahan.nama_bahan.asc()).all())
+        items=sorted(get_user_pantang_map(session, telegram_user_id).values(), key=lambda p: p.nama_bahan.lower())
         if not items:
             return ("Kamu belum punya data pantangan/alergi.\n"
                     "Gunakan: `/pantang tambah <nama_bahan> [pantangan|alergi]`")
         lines=["*Daftar pantangan/alergi kamu:*"]
         for p in items:
             note=f", catatan: {p.note}" if p.note else ""
-            lines.append(f"- {p.bahan.nama_bahan} ({p.jenis}{note})")
+            lines.append(f"- {p.nama_bahan} ({p.jenis}{note})")
         return "\n".join(lines)
 
     if subcmd in ("tambah","add","+"):
@@ -509,28 +2988,23 @@ def handle_pantang_command(session: Session, telegram_user_id:int, text:str) ->
         nama_bahan_in = raw if jenis=="pantangan" else " ".join(toks[:-1]).strip()
         if not nama_bahan_in: return "Nama bahan tidak boleh kosong."
 
-        candidates: List[Bahan] = (session.query(Bahan)
-            .filter(Bahan.nama_bahan.ilike(f"%{nama_bahan_in}%"))
-            .order_by(Bahan.nama_bahan.asc()).all())
+        candidates: List[Bahan] = find_bahan_candidates(session, nama_bahan_in)
         created=[]
         if not candidates:
             new_bahan=Bahan(nama_bahan=nama_bahan_in, satuan_bahan="unit")
             session.add(new_bahan); session.flush()
             candidates=[new_bahan]; created.append(new_bahan)
-
-        added, updated = 0, 0
-        for b in candidates:
-            existing=(session.query(UserBahanPantang)
-                      .filter(UserBahanPantang.telegram_user_id==user.telegram_user_id,
-                              UserBahanPantang.id_bahan==b.id_bahan).one_or_none())
-            if existing:
-                if existing.jenis != jenis:
-                    existing.jenis = jenis
-                updated+=1
-            else:
-                session.add(UserBahanPantang(telegram_user_id=user.telegram_user_id,
-                                             id_bahan=b.id_bahan, jenis=jenis))
-                added+=1
+            new_id, new_nama = new_bahan.id_bahan, new_bahan.nama_bahan
+            run_after_commit(session, lambda: BAHAN_NAMES.upsert(new_id, new_nama))
+
+        # hitungan ditambah/diperbarui dari map pantangan (cache), penulisan satu upsert untuk semua bahan
+        existing = get_user_pantang_map(session, telegram_user_id)
+        updated = sum(1 for b in candidates if b.id_bahan in existing)
+        added = len(candidates) - updated
+        upsert_rows(session, UserBahanPantang,
+                    [{"telegram_user_id": telegram_user_id, "id_bahan": b.id_bahan, "jenis": jenis}
+                     for b in candidates], ("jenis",))
+        run_after_commit(session, lambda: PANTANG_CACHE.invalidate(telegram_user_id))
 
         if created and len(candidates)==1:
             return (f"Bahan *{created[0].nama_bahan}* belum ada, sudah dibuat (satuan: unit) "
@@ -542,12 +3016,13 @@ def handle_pantang_command(session: Session, telegram_user_id:int, text:str) ->
     if subcmd in ("hapus","del","delete","-"):
         if len(parts)<3: return "Format: `/pantang hapus <nama_bahan>`"
         nama_bahan_in = parts[2].strip()
-        bahan_rows=(session.query(Bahan).filter(Bahan.nama_bahan.ilike(f"%{nama_bahan_in}%")).all())
+        bahan_rows=find_bahan_candidates(session, nama_bahan_in)
         if not bahan_rows: return f"Tidak ada bahan yang cocok dengan '{nama_bahan_in}'."
         deleted=(session.query(UserBahanPantang)
-                 .filter(UserBahanPantang.telegram_user_id==user.telegram_user_id,
+                 .filter(UserBahanPantang.telegram_user_id==telegram_user_id,
                          UserBahanPantang.id_bahan.in_([b.id_bahan for b in bahan_rows]))
                  .delete(synchronize_session=False))
+        run_after_commit(session, lambda: PANTANG_CACHE.invalidate(telegram_user_id))
         names=", ".join([b.nama_bahan for b in bahan_rows])
         return f"Pantangan untuk ({names}) dihapus. (baris terhapus: {deleted})"
 
@@ -571,19 +3046,11 @@ def handle_rating_command(session: Session, telegram_user_id:int, text:str)->str
     review = parts[3].strip() if len(parts)>=4 else None
     menu = session.get(Menu, id_menu)
     if not menu: return f"Menu id={id_menu} tidak ditemukan."
-    user=ensure_user(session, telegram_user_id)
-    existing=(session.query(UserMenuRating)
-              .filter(UserMenuRating.telegram_user_id==user.telegram_user_id,
-                      UserMenuRating.id_menu==id_menu).one_or_none())
-    if existing:
-        existing.rating_menu=nilai; existing.review=review; action="diperbarui"
-    else:
-        session.add(UserMenuRating(telegram_user_id=user.telegram_user_id,
-                                   id_menu=id_menu, rating_menu=nilai, review=review))
-        action="disimpan"
-    return f"Rating kamu untuk *{menu.nama_masakan}* (ID {menu.id_menu}) {action} dengan nilai *{nilai}*."
+    WRITE_BEHIND.add_rating(session, telegram_user_id, id_menu, nilai, review, set_review=True)
+    return f"Rating kamu untuk *{menu.nama_masakan}* (ID {menu.id_menu}) disimpan dengan nilai *{nilai}*."
 
 # ---------- HELP ----------
+@lru_cache(maxsize=None)
 def get_help_text()->str:
     return (
         "*Cara pakai ChefBot* 👩‍🍳\n\n"
@@ -605,91 +3072,157 @@ def get_help_text()->str:
     )
 
 # ---------- BUILD PROMPT (ringkas) ----------
-def build_chefbot_prompt(user_text:str, menu_context:str="")->str:
+def build_chefbot_prompt(user_text:str, menu_context:str="", knowledge_context:str="")->str:
+    knowledge = f"REFERENSI BUKU RESEP:\n{knowledge_context}\n\n" if knowledge_context else ""
     return (
         "Kamu adalah ChefBot, jawablah singkat, jelas, terstruktur, jangan jawab pertanyaan apapun kecuali terkait masakan atau makanan.\n\n"
         f"MENU DB:\n{menu_context}\n\n"
+        f"{knowledge}"
         f"USER: {user_text}\n"
         "Jika diminta resep, berikan bahan (dengan takaran wajar) dan langkah berurutan."
     )
 
 # ---------- Generate Answer ----------
-def generate_answer_for_user(session: Session, telegram_user_id:int, text:str):
+def generate_answer_for_user(session: Session, telegram_user_id:int, text:str, on_text=None):
     pantang_map = get_user_pantang_map(session, telegram_user_id)
-    menus = find_relevant_menus(session, text, limit=3)
-    # siapkan konteks menu
-    menu_context=""
-    if menus:
+    # daftar bahan ("aku punya telur, nasi, kecap") -> ranking menu berdasar cakupan bahan
+    ingredient_summary = ""
+    menus: List[MenuDetail] = []
+    bahan_query = parse_ingredient_list(text)
+    if bahan_query:
+        matches, _ = INGREDIENT_INDEX.match(bahan_query, max_missing=INGREDIENT_MAX_MISSING)
+        if matches:
+            ready = without_pantang_conflicts([m.id_menu for m in matches if not m.missing], pantang_map)[:5]
+            almost = without_pantang_conflicts([m.id_menu for m in matches if m.missing], pantang_map)[:5]
+            details = {d.id_menu: d for d in load_menu_details(session, ready + almost)}
+            menus = [details[i] for i in ready + almost if i in details][:3]
+            ingredient_summary = build_ingredient_summary(matches, details)
+    # menu (nama + BM25) dan referensi buku (BM25 + embedding) digabung RRF jadi satu konteks ringkas;
+    # referensi buku hanya berguna bila AI aktif
+    ctx = hybrid_retrieve(session, text, menu_ids=[m.id_menu for m in menus] if menus else None,
+                          chunk_limit=KNOWLEDGE_TOP_K, with_chunks=GEMINI_MODEL is not None,
+                          avoid_bahan=set(pantang_map))
+    if not menus:
+        menus = load_menu_details(session, ctx.menu_ids)
+    if not menus:
+        # salah ketik nama masakan ("nasi gorng") -> kandidat trigram terdekat
+        fuzzy = MENU_NAMES.fuzzy(_normalize_name(text), limit=3, min_score=FUZZY_MENU_MIN_SCORE)
+        menus = load_menu_details(session, [i for i, _ in fuzzy])
+    # siapkan konteks menu (satu blok per menu, dipakai juga sebagai versi untuk cache)
+    menu_blocks: List[Tuple[int, str]] = []
+    pieces: List[ContextPiece] = []
+    for rank, m in enumerate(menus):
         lines=[]
-        for m in menus:
-            src=f" | source: {m.source_url}" if m.source_url else ""
-            lines.append(f"Menu ID: {m.id_menu} | Nama: {m.nama_masakan} | Kesulitan: {m.tingkat_kesulitan}{src}")
-            lines.append("Bahan:")
-            for mb in m.bahan:
-                extra=""
-                if pantang_map and mb.id_bahan in pantang_map:
-                    p=pantang_map[mb.id_bahan]; note=f", catatan: {p.note}" if p.note else ""
-                    extra = f" [PANTANG_USER:{p.jenis}{note}]"
-                lines.append(f"- {mb.banyak_bahan} {mb.bahan.satuan_bahan} {mb.bahan.nama_bahan}{extra}")
-            langkah_sorted=sorted(m.langkah, key=lambda x:x.langkah_no)
-            lines.append("Langkah:")
-            for l in langkah_sorted: lines.append(f"{l.langkah_no}. {l.deskripsi}")
-            lines.append("")
-        menu_context="\n".join(lines)
+        src=f" | source: {m.source_url}" if m.source_url else ""
+        lines.append(f"Menu ID: {m.id_menu} | Nama: {m.nama_masakan} | Kesulitan: {m.tingkat_kesulitan}{src}")
+        lines.append("Bahan:")
+        for mb in m.bahan:
+            extra=""
+            if pantang_map and mb.id_bahan in pantang_map:
+                p=pantang_map[mb.id_bahan]; note=f", catatan: {p.note}" if p.note else ""
+                extra = f" [PANTANG_USER:{p.jenis}{note}]"
+            lines.append(f"- {mb.banyak_bahan} {mb.satuan_bahan} {mb.nama_bahan}{extra}")
+        steps = ["Langkah:"] + [f"{no}. {deskripsi}" for no, deskripsi in m.langkah] + [""]
+        group = f"menu:{m.id_menu}"
+        # prioritas: nama+bahan semua menu > langkah menu utama > referensi buku > langkah menu lain
+        pieces.append(ContextPiece(group, 0, 100 - rank, "\n".join(lines)))
+        pieces.append(ContextPiece(group, 1, 90 if rank == 0 else 70 - rank, "\n".join(steps), divisible=True))
+    for i, (c, score) in enumerate(ctx.chunks):
+        pieces.append(ContextPiece("ref", i, 80 - i, build_knowledge_context([(c, score)]), divisible=True))
+    full_tokens = sum(estimate_tokens(p.text) + 1 for p in pieces)
+    # budget hanya untuk prompt AI; ringkasan DB tanpa AI tetap utuh
+    budget = PROMPT_CONTEXT_TOKENS if GEMINI_MODEL else full_tokens
+    fitted, used_tokens, dropped_tokens = fit_context(pieces, budget)
+    menu_blocks = [(m.id_menu, fitted[f"menu:{m.id_menu}"]) for m in menus if f"menu:{m.id_menu}" in fitted]
+    menu_context="\n".join(block for _, block in menu_blocks)
+    knowledge_context = fitted.get("ref", "")
+    knowledge_chunks = ctx.chunks if knowledge_context else []
+    if dropped_tokens:
+        PROMPT_STATS["context_trimmed_tokens"] += dropped_tokens
+    log.info("Konteks prompt: ~%d token -> ~%d token (budget %d)", full_tokens, used_tokens, budget)
 
     no_context = not menus
-    prompt = build_chefbot_prompt(text, menu_context=menu_context)
-    answer = ask_gemini(prompt) if GEMINI_MODEL else (
-        "Berikut ringkasan resep dari database:\n\n"+menu_context if menu_context else
-        "Maaf, aku belum menemukan resep spesifik di database untuk pesanmu."
-    )
+    answer = None
+    if GEMINI_MODEL:
+        cache_key = response_cache_key(text, menu_blocks, [c.id for c, _ in knowledge_chunks])
+        answer = RESPONSE_CACHE.get(cache_key)
+        if answer is None:
+            if ADMISSION.allow_user(telegram_user_id):
+                prompt = build_chefbot_prompt(text, menu_context=menu_context, knowledge_context=knowledge_context)
+                answer = ask_gemini(prompt, on_text=on_text)
+                if answer not in GEMINI_FAILURE_REPLIES:
+                    RESPONSE_CACHE.put(cache_key, answer, [m.id_menu for m in menus])
+                elif answer == GEMINI_OVERLOADED_REPLY and menus:
+                    answer = None
+            elif menus:
+                log.info("User %s kena batas AI, jawab dari database", telegram_user_id)
+            else:
+                answer = "Kamu mengirim banyak permintaan AI dalam waktu singkat. Coba lagi sebentar lagi ya."
+            if answer is None:
+                # AI sibuk / kuota user habis: ringkasan DB utuh (tanpa budget prompt)
+                full_menu, _, _ = fit_context([p for p in pieces if p.group != "ref"], full_tokens)
+                menu_context = "\n".join(full_menu[f"menu:{m.id_menu}"] for m in menus)
+                answer = "(AI sedang sibuk, ini ringkasan dari database.)\n\n" + menu_context
+    else:
+        answer = ("Berikut ringkasan resep dari database:\n\n"+menu_context if menu_context else
+                  "Maaf, aku belum menemukan resep spesifik di database untuk pesanmu.")
 
     if menus and menus[0].source_url:
         answer += f"\n\n(Sumber asli resep: {menus[0].source_url})"
 
+    if ingredient_summary:
+        answer += "\n\n" + ingredient_summary
+
     warning_text = build_pantang_warning_for_menus(menus, pantang_map)
     if warning_text: answer = answer + "\n\n" + warning_text
 
     primary_menu = menus[0] if menus else None
     if primary_menu is not None:
-        session.add(UserMenuRiwayat(telegram_user_id=telegram_user_id,
-                                    id_menu=primary_menu.id_menu,
-                                    waktu=datetime.utcnow(), keterangan=text[:180]))
+        WRITE_BEHIND.add_history(session, telegram_user_id, primary_menu.id_menu, text[:180])
     return answer, primary_menu, no_context
 
 # ============================================================
 #  COMMAND HANDLER
 # ============================================================
+@lru_cache(maxsize=None)
+def start_screen() -> Dict[str, Any]:
+    keyboard = [
+        [{"text":"📖 Cara pakai","callback_data":"help_from_start"}],
+        [{"text":"🎲 Rekomendasi","callback_data":"rekomendasi"}],
+        [{"text":"📜 Riwayat resep","callback_data":"history"}],
+        [{"text":"⚙️ Atur pantangan/alergi","callback_data":"pantang_manage"}],
+        [{"text":"👀 Lihat pantangan/alergi","callback_data":"pantang_view"}],
+        [{"text":"📋 Daftar menu","callback_data":"menu_list"}],
+    ]
+    text_start=("Halo! 👋 Aku *ChefBot*.\n"
+                "Silakan pilih tombol atau kirim nama masakan/bahan yang kamu punya.")
+    return {"text": text_start, "inline_keyboard": keyboard}
+
 def handle_command(session: Session, telegram_user_id:int, text:str):
     lowered=text.strip().lower()
 
-    if lowered.startswith("/start"):
-        keyboard = [
-            [{"text":"📖 Cara pakai","callback_data":"help_from_start"}],
-            [{"text":"🎲 Rekomendasi","callback_data":"rekomendasi"}],
-            [{"text":"📜 Riwayat resep","callback_data":"history"}],
-            [{"text":"⚙️ Atur pantangan/alergi","callback_data":"pantang_manage"}],
-            [{"text":"👀 Lihat pantangan/alergi","callback_data":"pantang_view"}],
-            [{"text":"📋 Daftar menu","callback_data":"menu_list"}],
-        ]
-        text_start=("Halo! 👋 Aku *ChefBot*.\n"
-                    "Silakan pilih tombol atau kirim nama masakan/bahan yang kamu punya.")
-        return {"text": text_start, "inline_keyboard": keyboard}
-
+    if lowered.startswith("/start"):    return start_screen()
     if lowered.startswith("/help"):     return get_help_text()
     if lowered.startswith("/id"):       return f"Telegram user ID kamu: `{telegram_user_id}`"
-    if lowered.startswith("/history"):  return build_history_text(session, telegram_user_id)
+    if lowered.startswith("/history"):
+        text_hist, kb = build_history_page(session, telegram_user_id)
+        return {"text": text_hist, "inline_keyboard": kb} if kb else text_hist
     if lowered.startswith("/pantang"):  return handle_pantang_command(session, telegram_user_id, text)
     if lowered.startswith("/rating"):   return handle_rating_command(session, telegram_user_id, text)
-    if lowered.startswith("/menu"):     return build_menu_list_text(session)
+    if lowered.startswith("/menu"):
+        text_menu, kb = menu_list_screen()
+        return {"text": text_menu, "inline_keyboard": kb}
 
     # /addmenu (Gemini)
-    if lowered.startswith("/addmenu") or lowered.startswith("/buatmenu"):
+    is_link_cmd = lowered.startswith("/addmenulink") or lowered.startswith("/addmenufromlink")
+    if (lowered.startswith("/addmenu") and not is_link_cmd) or lowered.startswith("/buatmenu"):
         parts=text.split(maxsplit=1)
         if GEMINI_MODEL is None:
             return "Fitur AI belum aktif. Set GEMINI_API_KEY di .env untuk memakai /addmenu."
         if len(parts)<2:
             return ("Kirim: `/addmenu <deskripsi singkat>`\nContoh: `/addmenu sapi rica rica pedas`")
+        if not ADMISSION.allow_user(telegram_user_id):
+            return "Terlalu banyak permintaan AI dalam waktu singkat. Coba lagi sebentar lagi ya."
         try:
             user_instr = parts[1].strip()
             # prompt → JSON via Gemini
@@ -699,6 +3232,7 @@ def handle_command(session: Session, telegram_user_id:int, text:str):
                 f"Instruksi pengguna: {user_instr}"
             )
             raw = ask_gemini(prompt)
+            if raw == GEMINI_OVERLOADED_REPLY: return raw
             if raw.startswith("```"): raw=raw.strip("`"); raw = raw[4:].strip() if raw.lower().startswith("json") else raw
             recipe=json.loads(raw)
             menu_obj, msg = save_generated_menu_to_db(session, recipe, source_url="gemini:/addmenu")
@@ -711,23 +3245,41 @@ def handle_command(session: Session, telegram_user_id:int, text:str):
             return "Maaf, terjadi kesalahan saat membuat/menyimpan resep."
 
     # /addmenulink (Gemini)
-    if lowered.startswith("/addmenulink") or lowered.startswith("/addmenufromlink"):
+    if is_link_cmd:
         parts=text.split(maxsplit=1)
-        if GEMINI_MODEL is None:
-            return "Fitur AI belum aktif. Set GEMINI_API_KEY di .env untuk memakai /addmenulink."
         if len(parts)<2: return "Kirim: `/addmenulink <URL>`"
         url = parts[1].strip()
         if not (url.startswith("http://") or url.startswith("https://")):
             return "URL tidak valid. Harus diawali http:// atau https://"
         try:
-            resp = requests.get(url, timeout=20); resp.raise_for_status()
-            html = resp.text[:12000]
+            # koneksi dikembalikan ke pool begitu halaman (maks LINK_MAX_BYTES) terbaca, juga saat gagal
+            with requests.get(url, timeout=20, stream=True) as resp:
+                resp.raise_for_status()
+                page = resp.raw.read(LINK_MAX_BYTES, decode_content=True).decode(resp.encoding or "utf-8", "replace")
+            # jalur cepat: data resep terstruktur (JSON-LD / microdata) langsung disimpan tanpa AI
+            t0 = time.perf_counter()
+            recipe = extract_structured_recipe(page)
+            if recipe is not None:
+                menu_obj, msg = save_generated_menu_to_db(session, recipe, source_url=url)
+                log.info("/addmenulink %s: data terstruktur, %d bahan, %d langkah (%.0f ms, tanpa Gemini)",
+                         url, len(recipe["bahan"]), len(recipe["langkah"]), (time.perf_counter() - t0) * 1000)
+                if not menu_obj: return "Maaf, menu belum berhasil disimpan: "+msg
+                return (f"{msg}\n\n*Ringkasan dari link:*\n- Nama: {menu_obj.nama_masakan}\n"
+                        f"- Kesulitan: {menu_obj.tingkat_kesulitan}\n- Sumber: {menu_obj.source_url}")
+            if GEMINI_MODEL is None:
+                return ("Halaman itu tidak punya data resep terstruktur, dan fitur AI belum aktif. "
+                        "Set GEMINI_API_KEY di .env untuk mengekstrak resep dari halaman biasa.")
+            if not ADMISSION.allow_user(telegram_user_id):
+                return "Terlalu banyak permintaan AI dalam waktu singkat. Coba lagi sebentar lagi ya."
+            kind, page_text = build_link_context(page, LINK_CONTEXT_TOKENS)
+            log.info("/addmenulink %s: HTML %d karakter -> konteks %s %d karakter", url, len(page), kind, len(page_text))
             prompt = (
-                "Ambil SATU resep utama dari HTML berikut dan kembalikan JSON:\n"
+                "Ambil SATU resep utama dari isi halaman berikut dan kembalikan JSON:\n"
                 '{"nama_masakan":"","tingkat_kesulitan":"easy|medium|hard","bahan":[{"nama":"","jumlah":0,"satuan":""}],"langkah":["",""]}\n'
-                f"URL: {url}\nHTML:\n\"\"\"{html}\"\"\""
+                f"URL: {url}\nISI HALAMAN ({kind}):\n\"\"\"{page_text}\"\"\""
             )
             raw = ask_gemini(prompt)
+            if raw == GEMINI_OVERLOADED_REPLY: return raw
             if raw.startswith("```"): raw=raw.strip("`"); raw = raw[4:].strip() if raw.lower().startswith("json") else raw
             recipe=json.loads(raw)
             menu_obj, msg = save_generated_menu_to_db(session, recipe, source_url=url)
@@ -753,10 +3305,17 @@ def handle_callback_query(update: Dict[str,Any]) -> None:
     if chat_id is None or telegram_user_id is None:
         if callback_id: answer_callback_query(callback_id); return
 
-    if data == "history":
+    if data == "history" or data.startswith("history:"):
+        before_id = None
+        if data.startswith("history:"):
+            try: before_id = int(data.split(":", 1)[1])
+            except ValueError:
+                if callback_id: answer_callback_query(callback_id)
+                return
         with get_session() as session:
-            text = build_history_text(session, telegram_user_id)
-        send_message(chat_id, text); 
+            text, kb = build_history_page(session, telegram_user_id, before_id=before_id)
+        if kb: send_message_with_inline_keyboard(chat_id, text, kb)
+        else:  send_message(chat_id, text)
         if callback_id: answer_callback_query(callback_id, "Riwayat ditampilkan."); 
         return
 
@@ -781,13 +3340,14 @@ def handle_callback_query(update: Dict[str,Any]) -> None:
         if callback_id: answer_callback_query(callback_id); 
         return
 
-    if data == "menu_list":
-        with get_session() as session:
-            text = build_menu_list_text(session)
-        keyboard = [
-            [{"text":"➕ Tambah menu (Gemini)","callback_data":"menu_add"}],
-            [{"text":"➕ Tambah dari link","callback_data":"menu_add_link"}],
-        ]
+    if data == "menu_list" or data.startswith("menu_list:"):
+        after_id = 0
+        if data.startswith("menu_list:"):
+            try: after_id = int(data.split(":", 1)[1])
+            except ValueError:
+                if callback_id: answer_callback_query(callback_id)
+                return
+        text, keyboard = menu_list_screen(after_id)
         send_message_with_inline_keyboard(chat_id, text, keyboard)
         if callback_id: answer_callback_query(callback_id); 
         return
@@ -804,8 +3364,8 @@ def handle_callback_query(update: Dict[str,Any]) -> None:
 
     if data == "rekomendasi":
         with get_session() as session:
-            menus = get_recommendation_list(session, limit=5)
-        msg, kb = build_recommendation_message(menus)
+            menus = get_recommendation_list(session, limit=5, telegram_user_id=telegram_user_id)
+            msg, kb = build_recommendation_message(menus)
         send_message_with_inline_keyboard(chat_id, msg, kb)
         if callback_id: answer_callback_query(callback_id); 
         return
@@ -825,61 +3385,261 @@ def handle_callback_query(update: Dict[str,Any]) -> None:
             return
         with get_session() as session:
             menu=session.get(Menu, id_menu)
-            if not menu:
-                msg="Menu tidak ditemukan untuk rating."
-            else:
-                user=ensure_user(session, telegram_user_id)
-                existing=(session.query(UserMenuRating)
-                          .filter(UserMenuRating.telegram_user_id==user.telegram_user_id,
-                                  UserMenuRating.id_menu==id_menu).one_or_none())
-                if existing:
-                    existing.rating_menu=nilai; msg=f"Rating kamu untuk *{menu.nama_masakan}* diperbarui menjadi *{nilai}*."
-                else:
-                    session.add(UserMenuRating(telegram_user_id=user.telegram_user_id,
-                                               id_menu=id_menu, rating_menu=nilai))
-                    msg=f"Rating *{nilai}* untuk *{menu.nama_masakan}* disimpan."
+            nama=menu.nama_masakan if menu else None
+        if nama is None:
+            msg="Menu tidak ditemukan untuk rating."
+        else:
+            # konfirmasi langsung; baris rating ditulis oleh write-behind (tak ada transaksi terbuka di sini)
+            WRITE_BEHIND.add_rating(None, telegram_user_id, id_menu, nilai)
+            msg=f"Rating *{nilai}* untuk *{nama}* disimpan."
         send_message(chat_id, msg)
         if callback_id: answer_callback_query(callback_id, "Terima kasih atas ratingnya!")
         return
 
     if callback_id: answer_callback_query(callback_id)
 
+# ============================================================
+#  UPDATE PROCESSOR (webhook fast-ack)
+# ============================================================
+def _update_chat_id(update: Dict[str,Any]) -> Optional[int]:
+    cq = update.get("callback_query")
+    if cq: return ((cq.get("message") or {}).get("chat") or {}).get("id")
+    message = update.get("message") or update.get("edited_message") or {}
+    return (message.get("chat") or {}).get("id")
+
+def _process_worker_init() -> None:
+    # proses anak hasil fork tidak boleh memakai koneksi DB milik parent
+    engine.dispose(close=False)
+    # proses worker keluar lewat os._exit (atexit tidak jalan); finalizer multiprocessing tetap jalan
+    mp_util.Finalize(None, WRITE_BEHIND.flush, exitpriority=10)
+
+class UpdateProcessor:
+    """
+    Pool pemroses update Telegram. Tiap shard adalah executor ber-worker
+    tunggal dan update di-shard per chat_id, jadi update satu chat tetap
+    diproses berurutan sementara chat berbeda berjalan paralel. Jumlah
+    update tertunda dibatasi (backpressure) dan dicatat di stats.
+    """
+    def __init__(self, workers: int, kind: str, max_pending: int):
+        self.workers = max(1, workers)
+        self.kind = kind
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._pid = None
+        self._shards: List[Any] = []
+        self._pending: List[int] = []
+        self.stats = {"accepted": 0, "rejected": 0, "processed": 0, "errors": 0,
+                      "total_ms": 0.0, "max_ms": 0.0}
+
+    def _ensure_started(self) -> None:
+        if self._pid == os.getpid(): return
+        with self._lock:
+            if self._pid == os.getpid(): return
+            if self.kind == "process":
+                self._shards = [ProcessPoolExecutor(max_workers=1, initializer=_process_worker_init)
+                                for _ in range(self.workers)]
+            else:
+                self._shards = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"update-{i}")
+                                for i in range(self.workers)]
+            self._pending = [0] * self.workers
+            self._pid = os.getpid()
+
+    def submit(self, update: Dict[str,Any]) -> bool:
+        self._ensure_started()
+        chat_id = _update_chat_id(update)
+        shard = hash(chat_id if chat_id is not None else update.get("update_id")) % self.workers
+        with self._lock:
+            if sum(self._pending) >= self.max_pending:
+                self.stats["rejected"] += 1
+                return False
+            self._pending[shard] += 1
+            self.stats["accepted"] += 1
+        started = time.perf_counter()
+        fut = self._shards[shard].submit(process_update, update)
+        fut.add_done_callback(lambda f: self._done(f, shard, started))
+        return True
+
+    def _done(self, fut, shard: int, started: float) -> None:
+        ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self._pending[shard] -= 1
+            self.stats["processed"] += 1
+            self.stats["total_ms"] += ms
+            self.stats["max_ms"] = max(self.stats["max_ms"], ms)
+            if fut.exception() is not None: self.stats["errors"] += 1
+        if fut.exception() is not None:
+            log.error("Proses update gagal: %s", fut.exception())
+
+    def snapshot(self) -> Dict[str,Any]:
+        with self._lock:
+            st = dict(self.stats)
+            st["pending"] = sum(self._pending)
+            st["pending_per_shard"] = list(self._pending)
+        st["avg_ms"] = round(st.pop("total_ms") / st["processed"], 1) if st["processed"] else 0.0
+        st["max_ms"] = round(st["max_ms"], 1)
+        st.update(mode=WEBHOOK_MODE, kind=self.kind, workers=self.workers, max_pending=self.max_pending)
+        return st
+
+    def shutdown(self) -> None:
+        if self._pid != os.getpid(): return
+        for ex in self._shards: ex.shutdown(wait=True)
+
+UPDATES = UpdateProcessor(UPDATE_WORKERS, UPDATE_WORKER_KIND, UPDATE_MAX_PENDING)
+atexit.register(UPDATES.shutdown)
+
+class UpdateDeduplicator:
+    """
+    Idempotensi update Telegram: set TTL terbatas di memori, opsional tabel
+    telegram_update_seen (UPDATE_DEDUP_BACKEND=db) supaya beberapa proses
+    berbagi status. Update yang sudah pernah dilihat cukup di-ack.
+    """
+    def __init__(self, backend: str, ttl_sec: int, max_items: int):
+        self.backend = backend
+        self.ttl_sec = ttl_sec
+        self.max_items = max_items
+        self._seen: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self.stats = {"new": 0, "duplicates": 0, "db_errors": 0}
+
+    @staticmethod
+    def keys(update: Dict[str,Any]) -> List[str]:
+        keys = [f"u:{update.get('update_id')}"]
+        cq = update.get("callback_query") or {}
+        if cq.get("id"): keys.append(f"cq:{cq['id']}")
+        return keys
+
+    def _expire(self, now: float) -> None:
+        while self._seen:
+            key, ts = next(iter(self._seen.items()))
+            if now - ts <= self.ttl_sec and len(self._seen) <= self.max_items: break
+            self._seen.popitem(last=False)
+
+    def check_and_mark(self, update: Dict[str,Any]) -> bool:
+        # True bila update baru (dan sekarang ditandai), False bila duplikat
+        keys, now = self.keys(update), time.time()
+        with self._lock:
+            self._expire(now)
+            if any(k in self._seen for k in keys):
+                self.stats["duplicates"] += 1
+                return False
+            for k in keys: self._seen[k] = now
+        if self.backend == "db" and not self._mark_db(keys, now):
+            self.stats["duplicates"] += 1
+            return False
+        self.stats["new"] += 1
+        return True
+
+    def _mark_db(self, keys: List[str], now: float) -> bool:
+        # kolom seen_at menyimpan UTC tanpa tzinfo
+        seen_at = datetime.fromtimestamp(now, timezone.utc).replace(tzinfo=None)
+        try:
+            with engine.begin() as conn:
+                conn.execute(insert(TelegramUpdateSeen),
+                             [{"update_key": k, "seen_at": seen_at} for k in keys])
+                if now - self._last_purge > 300:
+                    self._last_purge = now
+                    cutoff = datetime.fromtimestamp(now - self.ttl_sec, timezone.utc).replace(tzinfo=None)
+                    conn.execute(delete(TelegramUpdateSeen).where(TelegramUpdateSeen.seen_at < cutoff))
+            return True
+        except IntegrityError:
+            return False   # sudah dicatat proses lain
+        except Exception as e:
+            # fail-open: lebih baik memproses ulang daripada menelan update
+            self.stats["db_errors"] += 1
+            log.warning("Dedup DB gagal: %s", e)
+            return True
+
+    def forget(self, update: Dict[str,Any]) -> None:
+        # dipakai bila update ditolak (503) supaya redelivery tetap diproses
+        keys = self.keys(update)
+        with self._lock:
+            for k in keys: self._seen.pop(k, None)
+        if self.backend == "db":
+            try:
+                with engine.begin() as conn:
+                    conn.execute(delete(TelegramUpdateSeen).where(TelegramUpdateSeen.update_key.in_(keys)))
+            except Exception as e:
+                log.warning("Dedup DB forget gagal: %s", e)
+
+DEDUP = UpdateDeduplicator(UPDATE_DEDUP_BACKEND, UPDATE_DEDUP_TTL_SEC, UPDATE_DEDUP_MAX)
+
 # ============================================================
 #  FLASK APP
 # ============================================================
 app = Flask(__name__)
 
+_warmed_up = False
+
+@app.before_request
+def _warm_up_once():
+    # untuk server WSGI (gunicorn dsb.) yang tidak melewati __main__
+    global _warmed_up
+    if not _warmed_up:
+        _warmed_up = True
+        warm_up()
+
 @app.get("/")
 def index():
     return jsonify(ok=True, message="ChefBot server is running.", webhook=f"/webhook/{WEBHOOK_SECRET}")
 
+@app.get("/stats")
+def stats():
+    return jsonify(updates=UPDATES.snapshot(), dedup=DEDUP.stats, response_cache=RESPONSE_CACHE.stats,
+                   screen_cache=SCREEN_CACHE.stats, write_behind=WRITE_BEHIND.stats,
+                   embed_cache=EMBED_CACHE.snapshot(), hybrid=HYBRID_STATS, prompts=PROMPT_STATS,
+                   streaming=STREAM_STATS, admission=ADMISSION.snapshot(), pantang_cache=PANTANG_CACHE.stats,
+                   queries=dict(QUERY_STATS, cap=MAX_QUERIES_PER_MESSAGE),
+                   telegram=dict(TELEGRAM.stats, queue_depth=TELEGRAM.queue_depth()))
+
 @app.post(f"/webhook/{WEBHOOK_SECRET}")
 def telegram_webhook():
     update = request.get_json(force=True, silent=True) or {}
     log.debug("Update: %s", json.dumps(update, ensure_ascii=False))
+    if not isinstance(update, dict) or not isinstance(update.get("update_id"), int):
+        return jsonify(ok=True)
+    if not DEDUP.check_and_mark(update):
+        log.info("Update %s duplikat (redelivery), diabaikan", update.get("update_id"))
+        return jsonify(ok=True)
 
+    if WEBHOOK_MODE == "async":
+        if not UPDATES.submit(update):
+            # antrian penuh: biarkan Telegram mengirim ulang nanti
+            log.warning("Antrian update penuh, update %s ditolak", update.get("update_id"))
+            DEDUP.forget(update)
+            return jsonify(ok=False, error="overloaded"), 503
+        return jsonify(ok=True)
+
+    process_update(update)
+    return jsonify(ok=True)
+
+def process_update(update: Dict[str,Any]) -> None:
     callback_query = update.get("callback_query")
     if callback_query:
-        handle_callback_query(callback_query)
-        return jsonify(ok=True)
+        with telegram_batch(_update_chat_id(update)), count_queries("callback"):
+            handle_callback_query(callback_query)
+        return
 
     message = update.get("message") or update.get("edited_message")
-    if not message: return jsonify(ok=True)
+    if not message: return
+    with telegram_batch(_update_chat_id(update)), count_queries("pesan"):
+        handle_message(message)
 
+def handle_message(message: Dict[str,Any]) -> None:
     chat_id = message["chat"]["id"]
     from_user = message.get("from", {})
     telegram_user_id = from_user.get("id")
     text = message.get("text", "")
 
     if telegram_user_id is None or not isinstance(telegram_user_id, int):
-        send_message(chat_id, "Maaf, aku tidak bisa mengenali user ID kamu."); return jsonify(ok=True)
+        send_message(chat_id, "Maaf, aku tidak bisa mengenali user ID kamu."); return
     if not isinstance(text, str):
-        send_message(chat_id, "Saat ini aku hanya bisa memproses pesan teks."); return jsonify(ok=True)
+        send_message(chat_id, "Saat ini aku hanya bisa memproses pesan teks."); return
 
     text = text.strip()
     if not text:
         send_message(chat_id, "Kirimkan pesan teks ya, misalnya nama masakan atau bahan 😊")
-        return jsonify(ok=True)
+        return
 
     send_chat_action(chat_id, "typing")
 
@@ -896,26 +3656,31 @@ def telegram_webhook():
                     send_message_with_inline_keyboard(chat_id, result.get("text",""), result.get("inline_keyboard",[]))
                 else:
                     send_message(chat_id, str(result))
-                return jsonify(ok=True)
+                return
+
+            intent = classify_intent(text)
 
             # 2) RECOMMENDATION intent
-            if is_recommendation_intent(text):
-                menus = get_recommendation_list(session, limit=5)
+            if intent == "rekomendasi":
+                menus = get_recommendation_list(session, limit=5, telegram_user_id=telegram_user_id)
                 msg, kb = build_recommendation_message(menus)
                 send_message_with_inline_keyboard(chat_id, msg, kb)
-                return jsonify(ok=True)
+                return
 
             # 3) SMALLTALK intent (tanpa fallback)
-            st_label = is_smalltalk(text)
+            st_label = intent if intent in SMALLTALK_PATTERNS else None
             if st_label:
                 msg, kb = smalltalk_reply(st_label)
                 if kb: send_message_with_inline_keyboard(chat_id, msg, kb)
                 else:  send_message(chat_id, msg)
-                return jsonify(ok=True)
+                return
 
             # 4) GENERATE (DB + AI opsional)
-            reply, primary_menu, no_context = generate_answer_for_user(session, telegram_user_id, text)
-            send_message(chat_id, reply, parse_mode=None)
+            stream = StreamingReply(chat_id, GEMINI_STREAM_EDIT_SEC) if GEMINI_STREAM and GEMINI_MODEL else None
+            reply, primary_menu, no_context = generate_answer_for_user(
+                session, telegram_user_id, text, on_text=stream.update if stream else None)
+            if stream is None or not stream.finish(reply):
+                send_message(chat_id, reply, parse_mode=None)
 
             # tombol lanjutan
             if primary_menu is not None:
@@ -945,9 +3710,205 @@ def telegram_webhook():
         log.exception("Webhook handler error: %s", e)
         send_message(chat_id, "Maaf, terjadi kesalahan di server. Coba lagi sebentar lagi ya.")
 
-    return jsonify(ok=True)
+# ============================================================
+#  CLI (flask --app app <perintah>)
+# ============================================================
+@app.cli.command("ensure-schema")
+def cli_ensure_schema():
+    """Tambahkan tabel/kolom baru yang belum ada di database."""
+    ensure_schema()
+    click.echo("Skema OK.")
+
+@app.cli.command("migrate-embeddings")
+@click.option("--batch", default=500, show_default=True, help="Jumlah baris per transaksi.")
+@click.option("--int8", "use_int8", is_flag=True, help="Simpan sebagai int8 terkuantisasi (4x lebih kecil dari float32).")
+@click.option("--drop-json", is_flag=True, help="Kosongkan embedding_json setelah dikonversi.")
+def cli_migrate_embeddings(batch: int, use_int8: bool, drop_json: bool):
+    """Konversi knowledge_chunks.embedding_json ke kolom biner embedding_bin."""
+    if np is None:
+        raise click.ClickException("NumPy dibutuhkan untuk migrasi embedding.")
+    ensure_schema()
+    fmt = "i8" if use_int8 else "f32"
+    last_id, converted, failed, json_bytes, bin_bytes = 0, 0, 0, 0, 0
+    while True:
+        with get_session() as session:
+            rows = (session.query(KnowledgeChunk.id, KnowledgeChunk.embedding_json)
+                    .filter(KnowledgeChunk.id > last_id,
+                            KnowledgeChunk.embedding_bin.is_(None),
+                            KnowledgeChunk.embedding_json.isnot(None))
+                    .order_by(KnowledgeChunk.id.asc()).limit(batch).all())
+            if not rows: break
+            updates = []
+            for chunk_id, emb_json in rows:
+                try:
+                    blob, dim = encode_embedding(json.loads(emb_json), fmt)
+                except Exception as e:
+                    log.warning("Chunk %s gagal dikonversi: %s", chunk_id, e); failed += 1
+                    continue
+                row = {"id": chunk_id, "embedding_bin": blob, "embedding_dim": dim, "embedding_fmt": fmt}
+                if drop_json: row["embedding_json"] = None
+                updates.append(row)
+                json_bytes += len(emb_json); bin_bytes += len(blob)
+            if updates:
+                session.execute(update(KnowledgeChunk), updates)
+            converted += len(updates); last_id = rows[-1][0]
+        click.echo(f"... {converted} chunk dikonversi (id terakhir {last_id})")
+    ratio = (json_bytes / bin_bytes) if bin_bytes else 0
+    click.echo(f"Selesai: {converted} chunk ({fmt}), gagal {failed}. "
+               f"JSON {json_bytes/1024:.1f} KB -> biner {bin_bytes/1024:.1f} KB ({ratio:.1f}x lebih kecil).")
+
+@app.cli.command("bench-recommend")
+@click.option("--menus", "n_menus", default=100000, show_default=True, help="Jumlah menu sintetis.")
+@click.option("--rounds", default=10000, show_default=True, help="Jumlah rekomendasi yang diambil.")
+@click.option("--limit", default=5, show_default=True)
+def cli_bench_recommend(n_menus: int, rounds: int, limit: int):
+    """Benchmark sampling rekomendasi pada katalog sintetis (tanpa DB)."""
+    engine_ = RecommendationEngine()
+    ids = list(range(1, n_menus + 1))
+    weights = [random.uniform(1.0, 5.0) ** 2 for _ in ids]
+    t0 = time.perf_counter()
+    engine_.set_table(ids, weights); engine_._built_at = time.time()
+    build_ms = (time.perf_counter() - t0) * 1000
+    exclude = set(random.sample(ids, min(10, n_menus)))
+    t0 = time.perf_counter()
+    for _ in range(rounds): engine_.sample(limit * 2, exclude=exclude)
+    per_call_us = (time.perf_counter() - t0) / rounds * 1e6
+    click.echo(f"{n_menus} menu: build tabel {build_ms:.1f} ms, sampling {per_call_us:.1f} µs/rekomendasi "
+               f"(limit={limit}, {rounds} kali)")
+
+@app.cli.command("bench-intent")
+@click.argument("path", type=click.File("r", encoding="utf-8"), required=False)
+@click.option("--repeat", default=20, show_default=True, help="Berapa kali korpus diulang.")
+def cli_bench_intent(path, repeat: int):
+    """Benchmark routing intent (pesan/detik) atas korpus pesan, satu pesan per baris."""
+    if path is not None:
+        corpus = [ln.strip() for ln in path if ln.strip()]
+    else:
+        with get_session() as session:
+            corpus = [r[0] for r in session.query(Menu.nama_masakan).all()]
+        corpus += ["halo", "haiii min", "met pagi kak", "makasiiih ya", "thx", "dadah", "bingung mau masak apa",
+                   "kasih ide dong", "rekomin menu", "aku punya telur, nasi, dan kecap", "resep soto ayam"]
+    if not corpus:
+        click.echo("Korpus kosong."); return
+    # pembanding: scan berurutan per pola seperti sebelumnya
+    legacy = [(label, [re.compile(p) for p in pats]) for label, pats in INTENT_PATTERNS]
+    def legacy_classify(text: str) -> Optional[str]:
+        t = INTENT_REPEAT_RE.sub(r"\1", text.lower())
+        for label, pats in legacy:
+            if any(p.search(t) for p in pats): return label
+        return None
+    n = len(corpus) * repeat
+    for name, fn in (("router", INTENT_ROUTER.classify), ("sekuensial", legacy_classify)):
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            for msg in corpus: fn(msg)
+        dt = time.perf_counter() - t0
+        click.echo(f"{name:>10}: {n / dt:,.0f} pesan/detik ({dt / n * 1e6:.2f} µs/pesan)")
+    counts: Dict[str, int] = {}
+    diff = 0
+    for msg in corpus:
+        label = INTENT_ROUTER.classify(msg)
+        counts[label or "-"] = counts.get(label or "-", 0) + 1
+        diff += label != legacy_classify(msg)
+    click.echo(f"{len(corpus)} pesan, intent: {counts}, beda dengan sekuensial: {diff}")
+
+@app.cli.command("report-duplicates")
+@click.option("--threshold", default=0.75, show_default=True, help="Skor kemiripan trigram minimum (0-1).")
+@click.option("--menus", "include_menus", is_flag=True, help="Laporkan juga nama menu yang mirip.")
+def cli_report_duplicates(threshold: float, include_menus: bool):
+    """Laporan kelompok nama bahan (dan menu) yang hampir sama untuk dirapikan admin."""
+    indexes = [("bahan", BAHAN_NAMES)] + ([("menu", MENU_NAMES)] if include_menus else [])
+    for label, idx in indexes:
+        groups = idx.clusters(threshold)
+        click.echo(f"== {label}: {len(groups)} kelompok mirip (threshold {threshold}) ==")
+        for g in groups:
+            click.echo("  - " + " | ".join(f"[{i}] {idx.name_of(i)}" for i in g))
+
+@app.cli.command("ingest-knowledge")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--source", required=True, help="Nama sumber di knowledge_chunks, mis. buku_sup_soto_sisca.")
+@click.option("--embedder", "embedder_name", default=None, help="gemini / local (default: KNOWLEDGE_EMBEDDER).")
+@click.option("--chunk-chars", default=KNOWLEDGE_CHUNK_CHARS, show_default=True)
+@click.option("--overlap", default=KNOWLEDGE_CHUNK_OVERLAP, show_default=True)
+@click.option("--batch", default=KNOWLEDGE_EMBED_BATCH, show_default=True, help="Jumlah chunk per panggilan embed.")
+@click.option("--int8", "use_int8", is_flag=True, help="Simpan embedding int8 terkuantisasi.")
+def cli_ingest_knowledge(path: str, source: str, embedder_name: Optional[str], chunk_chars: int,
+                         overlap: int, batch: int, use_int8: bool):
+    """Chunk + embed dokumen (PDF/teks/JSONL) ke knowledge_chunks; chunk yang tidak berubah dilewati."""
+    if np is None:
+        raise click.ClickException("NumPy dibutuhkan untuk menyimpan embedding.")
+    try:
+        embedder = get_embedder(embedder_name)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    if not embedder.available:
+        raise click.ClickException(f"Embedder {embedder.name} tidak tersedia.")
+    ensure_schema()
+    t0 = time.perf_counter()
+    try:
+        stats = ingest_knowledge_document(source, iter_document_pages(path), embedder, batch_size=batch,
+                                          max_chars=chunk_chars, overlap=overlap,
+                                          fmt="i8" if use_int8 else "f32")
+    except Exception as e:
+        # batch yang sudah ditulis tetap tersimpan; jalankan ulang untuk melanjutkan
+        raise click.ClickException(f"Ingest berhenti: {e}")
+    click.echo(f"{source}: {stats['pages']} halaman, {stats['chunks']} chunk, {stats['unchanged']} tidak berubah, "
+               f"{stats['embedded']} di-embed, {stats['deleted']} dihapus ({time.perf_counter() - t0:.1f} s, "
+               f"{embedder.name}). Index server diperbarui saat refresh berikutnya.")
+
+def _iter_recipe_file(fh):
+    # JSON array atau JSON Lines (satu resep per baris, dibaca bertahap)
+    first = fh.readline()
+    if first.lstrip().startswith("["):
+        data = json.loads(first + fh.read())
+        yield from (data if isinstance(data, list) else [data])
+        return
+    for n, line in enumerate((first, *fh), start=1):
+        line = line.strip()
+        if not line: continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            yield {"_error": f"JSON tidak valid di baris {n}: {e}"}
+
+@app.cli.command("ingest-recipes")
+@click.argument("path", type=click.File("r", encoding="utf-8"), default="-")
+@click.option("--batch", default=200, show_default=True, help="Jumlah resep per transaksi.")
+@click.option("--source", "source_url", default=None, help="source_url untuk resep yang tidak menyertakannya.")
+@click.option("--quiet", is_flag=True, help="Hanya tampilkan resep yang gagal + ringkasan.")
+def cli_ingest_recipes(path, batch: int, source_url: Optional[str], quiet: bool):
+    """Impor massal resep dari file JSON / JSON Lines (skema sama dengan /addmenu)."""
+    ensure_schema()
+    ok = failed = 0
+    t0 = time.perf_counter()
+    q0 = QUERY_STATS["queries"]
+    with count_queries("ingest-recipes", cap=10**9):
+        for res in ingest_recipes(_iter_recipe_file(path), batch_size=batch, source_url=source_url):
+            if res.ok: ok += 1
+            else: failed += 1
+            if not res.ok or not quiet:
+                status = f"ID {res.id_menu}" if res.ok else "GAGAL"
+                click.echo(f"[{res.index}] {res.nama_masakan or '-'}: {status} - {res.message}")
+    dt = time.perf_counter() - t0
+    rate = (ok + failed) / dt * 60 if dt > 0 else 0
+    click.echo(f"Selesai: {ok} berhasil, {failed} gagal dalam {dt:.1f} s "
+               f"({rate:.0f} resep/menit, {QUERY_STATS['queries'] - q0} query DB).")
+
+def warm_up() -> None:
+    # bangun index in-process di awal supaya request pertama tidak menanggungnya
+    try:
+        ensure_schema()
+        MENU_INDEX.ensure_fresh()
+        KNOWLEDGE_INDEX.ensure_fresh()
+        RECOMMENDER.ensure_fresh()
+        INGREDIENT_INDEX.ensure_fresh()
+        BAHAN_NAMES.ensure_fresh(); MENU_NAMES.ensure_fresh()
+        MENU_BM25.ensure_fresh(); CHUNK_BM25.ensure_fresh()
+    except Exception as e:
+        log.warning("Warm-up index gagal (akan dibangun saat request pertama): %s", e)
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "8080"))
+    warm_up()
     log.info("Starting ChefBot server on port %s ...", port)
     app.run(host="0.0.0.0", port=port, debug=True)
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# app.py membaca konfigurasi saat di-import: pakai SQLite di memori, tanpa Telegram/Gemini
+os.environ["DB_URL"] = "sqlite://"
+os.environ["BOT_TOKEN"] = ""
+os.environ["GEMINI_API_KEY"] = ""
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
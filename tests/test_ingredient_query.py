@@ -0,0 +1,54 @@
+import re
+
+import pytest
+
+import app
+
+MENUS = {
+    1: ("Nasi Uduk", ["nasi", "santan", "daun salam"]),
+    2: ("Nasi Goreng Telur", ["nasi", "telur", "kecap manis"]),
+    3: ("Telur Dadar", ["telur", "daun bawang"]),
+}
+
+
+@pytest.fixture(scope="module", autouse=True)
+def seeded_db():
+    app.Base.metadata.create_all(app.engine)
+    bahan_ids = {}
+    with app.get_session() as session:
+        for id_menu, (nama, bahan) in MENUS.items():
+            session.add(app.Menu(id_menu=id_menu, nama_masakan=nama, tingkat_kesulitan="easy"))
+            for nama_bahan in bahan:
+                if nama_bahan not in bahan_ids:
+                    bahan_ids[nama_bahan] = len(bahan_ids) + 1
+                    session.add(app.Bahan(id_bahan=bahan_ids[nama_bahan], nama_bahan=nama_bahan,
+                                          satuan_bahan="gram"))
+        session.flush()
+        for id_menu, (_, bahan) in MENUS.items():
+            for nama_bahan in bahan:
+                session.add(app.MenuBahan(id_menu=id_menu, id_bahan=bahan_ids[nama_bahan], banyak_bahan=1))
+    for index in (app.MENU_INDEX, app.INGREDIENT_INDEX, app.BAHAN_NAMES, app.MENU_NAMES):
+        index.build()
+    yield
+
+
+def first_menu(text):
+    with app.get_session() as session:
+        answer = app.generate_answer_for_user(session, 1, text)[0]
+    return re.search(r"Nama: ([^|]+?) \|", answer).group(1)
+
+
+@pytest.mark.parametrize("text", ["ada resep nasi goreng ga", "sisa nasi kemarin enaknya dibikin apa"])
+def test_plain_question_is_not_an_ingredient_list(text):
+    # pertanyaan biasa tetap lewat pencarian nama menu, bukan pencocokan bahan
+    assert app.parse_ingredient_list(text) == []
+    assert first_menu(text) == MENUS[app.MENU_INDEX.search(text)[0]][0] == "Nasi Goreng Telur"
+
+
+@pytest.mark.parametrize("text, items", [
+    ("aku punya telur, nasi, kecap manis", ["telur", "nasi", "kecap manis"]),
+    ("ada bahan telur sama daun bawang", ["telur", "daun bawang"]),
+    ("bahannya: nasi, santan", ["nasi", "santan"]),
+])
+def test_explicit_ingredient_list(text, items):
+    assert app.parse_ingredient_list(text) == items
@@ -0,0 +1,72 @@
+import itertools
+import re
+
+import pytest
+
+import app
+
+# pola sebelum router (if-chain: rekomendasi dulu, lalu smalltalk berurutan)
+OLD_RECOM = [r"\bbingung\b.*\bmasak\b", r"\bkasih(kan)?\s*ide\b", r"\brekom(endasi)?\b", r"\bmasak apa\b"]
+OLD_SMALLTALK = {
+    "halo": [r"\bhalo+\b", r"\bhai+\b", r"\bhallo+\b", r"\bselamat\s*(pagi|siang|sore|malam)\b"],
+    "bye": [r"\bbye+\b", r"\bdada(h)?\b", r"\bsampai jumpa\b", r"\bsee you\b"],
+    "thanks": [r"\bterima kasih\b", r"\bmakasih\b", r"\bthank(s| you)\b"],
+}
+
+OLD_PHRASES = {
+    "rekomendasi": ["bingung mau masak", "kasih ide", "kasihkan ide", "rekom", "rekomendasi", "masak apa"],
+    "halo": ["halo", "haloo", "hai", "haii", "hallo", "selamat pagi", "selamat malam"],
+    "bye": ["bye", "byee", "dada", "dadah", "sampai jumpa", "see you"],
+    "thanks": ["terima kasih", "makasih", "thanks", "thank you"],
+}
+
+
+def old_classify(text):
+    t = (text or "").lower()
+    if any(re.search(p, t) for p in OLD_RECOM):
+        return "rekomendasi"
+    for label, pats in OLD_SMALLTALK.items():
+        if any(re.search(p, t) for p in pats):
+            return label
+    return None
+
+
+def sequential_classify(text):
+    t = app.INTENT_REPEAT_RE.sub(r"\1", (text or "").lower())
+    for label, pats in app.INTENT_PATTERNS:
+        if any(re.search(p, t) for p in pats):
+            return label
+    return None
+
+
+def corpus():
+    phrases = [p for ps in OLD_PHRASES.values() for p in ps]
+    msgs = list(phrases)
+    for a, b in itertools.permutations(phrases, 2):
+        msgs.append(f"{a} {b}")
+        msgs.append(f"{a.capitalize()}, aku {b} dong")
+    msgs += ["soto ayam", "resep nasi goreng", "aku punya telur, nasi, dan kecap", ""]
+    return msgs
+
+
+def test_router_matches_old_if_chain_on_old_keywords():
+    for msg in corpus():
+        old = old_classify(msg)
+        if old is not None:
+            assert app.classify_intent(msg) == old, msg
+
+
+def test_router_matches_sequential_scan_of_current_patterns():
+    for msg in corpus():
+        assert app.classify_intent(msg) == sequential_classify(msg), msg
+
+
+@pytest.mark.parametrize("msg,label", [
+    ("terima kasih ide masakan", "rekomendasi"),
+    ("halo, rekomendasi dong", "rekomendasi"),
+    ("makasiiih ya", "thanks"),
+    ("met pagi kak", "halo"),
+    ("resep soto ayam", None),
+])
+def test_classify_examples(msg, label):
+    assert app.classify_intent(msg) == label
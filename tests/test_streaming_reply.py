@@ -0,0 +1,120 @@
+import threading
+import time
+
+import pytest
+
+import app
+
+
+class FakeTelegram:
+    """Pengganti TELEGRAM.call: mencatat panggilan, bisa diperlambat / digagalkan per method."""
+
+    def __init__(self, delay=0.0, fail=None):
+        self.calls = []
+        self.delay = delay
+        self.fail = fail or (lambda method, payload: False)
+        self._lock = threading.Lock()
+
+    def call(self, method, payload, timeout=15, retries=None):
+        time.sleep(self.delay)
+        with self._lock:
+            self.calls.append((time.perf_counter(), method, dict(payload)))
+        if self.fail(method, payload):
+            return None
+        return {"ok": True, "result": {"message_id": 42}}
+
+    def methods(self):
+        return [m for _, m, _ in self.calls]
+
+
+@pytest.fixture
+def telegram(monkeypatch):
+    fake = FakeTelegram()
+    sent = []
+    monkeypatch.setattr(app, "BOT_TOKEN", "test-token")
+    monkeypatch.setattr(app.TELEGRAM, "call", fake.call)
+    monkeypatch.setattr(app, "send_message", lambda chat_id, text, parse_mode="Markdown": sent.append(text))
+    fake.sent = sent
+    return fake
+
+
+def stream(reply, chunks, pause):
+    text = ""
+    for c in chunks:
+        text += c
+        reply.update(text)
+        time.sleep(pause)
+    return text
+
+
+def test_edits_are_throttled_and_final_text_is_flushed(telegram):
+    reply = app.StreamingReply(1, min_interval=0.2)
+    final = stream(reply, [f"kata{i} " for i in range(30)], 0.02)
+    assert reply.finish(final + "*selesai*")
+
+    assert telegram.methods()[0] == "sendMessage"
+    assert telegram.calls[0][2]["text"].endswith(app.StreamingReply.CURSOR)
+    middle = [t for t, m, p in telegram.calls[1:-1]]
+    assert all(m == "editMessageText" for m in telegram.methods()[1:])
+    assert len(middle) <= 4   # ~0.6 s stream, paling sering tiap 0.2 s
+    gaps = [b - a for a, b in zip([telegram.calls[0][0]] + middle, middle)]
+    assert all(g >= 0.18 for g in gaps)
+
+    last = telegram.calls[-1][2]
+    assert last["parse_mode"] == "Markdown" and last["message_id"] == 42
+    assert last["text"].startswith("kata0") and app.StreamingReply.CURSOR not in last["text"]
+
+
+def test_update_does_not_wait_for_telegram(telegram):
+    telegram.delay = 0.3
+    reply = app.StreamingReply(1, min_interval=0.0)
+    t0 = time.perf_counter()
+    for i in range(5):
+        reply.update("potongan " * (i + 1))
+    assert time.perf_counter() - t0 < 0.1
+    assert reply.finish("jawaban akhir")
+    # potongan yang menumpuk selama sendMessage lambat digabung jadi satu edit
+    assert telegram.methods().count("editMessageText") <= 3
+
+
+def test_markdown_rejected_falls_back_to_plain_text(telegram):
+    telegram.fail = lambda method, payload: method == "editMessageText" and payload.get("parse_mode")
+    reply = app.StreamingReply(1, min_interval=0.0)
+    reply.update("halo")
+    assert reply.finish("**Soto** [ayam")
+    method, payload = telegram.methods()[-1], telegram.calls[-1][2]
+    assert method == "editMessageText" and "parse_mode" not in payload
+    assert payload["text"] == "**Soto** [ayam"
+
+
+def test_long_answer_overflow_is_sent_as_new_message(telegram):
+    reply = app.StreamingReply(1, min_interval=0.0)
+    reply.update("awal")
+    text = "a" * app.TELEGRAM_TEXT_LIMIT + "sisa"
+    assert reply.finish(text)
+    assert telegram.sent == ["sisa"]
+
+
+def test_failed_first_message_hands_reply_back_to_caller(telegram):
+    telegram.fail = lambda method, payload: method == "sendMessage"
+    reply = app.StreamingReply(1, min_interval=0.0)
+    stream(reply, ["a", "b", "c"], 0.01)
+    assert reply.finish("abc") is False
+    assert telegram.methods() == ["sendMessage"]
+
+
+def test_finish_without_updates(telegram):
+    assert app.StreamingReply(1).finish("jawaban") is False
+    assert telegram.calls == []
+
+
+def test_stream_waits_for_replies_already_queued_for_the_chat(telegram):
+    # balasan update sebelumnya masih antre (lambat): pesan stream tidak boleh menyalipnya
+    telegram.delay = 0.1
+    app.TELEGRAM.submit(1, [("sendMessage", {"chat_id": 1, "text": "balasan lama"}, 15)] * 3)
+    reply = app.StreamingReply(1, min_interval=0.0)
+    reply.update("jawaban baru")
+    assert reply.finish("jawaban baru")
+    texts = [p["text"] for _, _, p in telegram.calls]
+    assert texts[:3] == ["balasan lama"] * 3
+    assert texts[3].startswith("jawaban baru")
@@ -0,0 +1,52 @@
+import os
+
+import pytest
+
+import app
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def load(name):
+    with open(os.path.join(FIXTURES, name), encoding="utf-8") as fh:
+        return fh.read()
+
+
+def test_jsonld_recipe_inside_graph():
+    recipe = app.extract_structured_recipe(load("recipe_jsonld.html"))
+    assert recipe["nama_masakan"] == "Soto Ayam Lamongan & Koya"
+    assert recipe["tingkat_kesulitan"] == "medium"   # PT1H15M
+    bahan = {b["nama"]: (b["jumlah"], b["satuan"]) for b in recipe["bahan"]}
+    assert bahan["ayam kampung"] == (1.0, "ekor")
+    assert bahan["air"] == (1.5, "liter")            # "1 1/2 liter"
+    assert bahan["bawang putih"] == (2.0, "siung")   # rentang "2-3" -> angka pertama
+    assert bahan["merica bubuk"] == (0.5, "sdt")     # pecahan unicode
+    assert bahan["soun"] == (100.0, "gram")          # keterangan dalam kurung dibuang
+    assert bahan["minyak"] == (2.0, "sdm")           # "sendok makan"
+    assert bahan["tulang sapi"] == (1.5, "kg")       # koma desimal
+    assert bahan["garam"] == (0.0, "secukupnya")
+    assert recipe["langkah"] == ["Rebus ayam hingga empuk.", "Tumis bumbu halus sampai harum.",
+                                 "Sajikan dengan koya."]
+
+
+def test_microdata_recipe_ignores_nested_and_outside_items():
+    recipe = app.extract_structured_recipe(load("recipe_microdata.html"))
+    assert recipe["nama_masakan"] == "Nasi Uduk Betawi"   # bukan nama author / footer
+    assert [(b["nama"], b["jumlah"], b["satuan"]) for b in recipe["bahan"]] == [
+        ("beras", 500.0, "gram"), ("santan", 400.0, "ml"), ("daun salam", 2.0, "lembar")]
+    assert recipe["langkah"] == ["Cuci beras.", "Masak dengan santan.", "Kukus 20 menit."]
+
+
+@pytest.mark.parametrize("name", ["no_recipe.html", "incomplete_recipe.html"])
+def test_pages_without_usable_recipe_are_rejected(name):
+    assert app.extract_structured_recipe(load(name)) is None
+
+
+@pytest.mark.parametrize("line,expected", [
+    ("1 1/2 sdm kecap manis", {"nama": "kecap manis", "jumlah": 1.5, "satuan": "sdm"}),
+    ("500 gr daging sapi, potong dadu", {"nama": "daging sapi", "jumlah": 500.0, "satuan": "gram"}),
+    ("garam secukupnya", {"nama": "garam", "jumlah": 0.0, "satuan": "secukupnya"}),
+    ("", None),
+])
+def test_parse_ingredient_line(line, expected):
+    assert app.parse_ingredient_line(line) == expected